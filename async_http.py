@@ -0,0 +1,138 @@
+# aiohttp counterpart of http_session.py for the async crawl mode, paced by the same per-host governors
+
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+from dotenv import load_dotenv
+
+import metrics
+from http_session import HTTP_TIMEOUT
+from rate_limit import RATE_MAX_RETRIES, RETRY_STATUSES, backoff, get_governor
+
+# logger setup
+logger = logging.getLogger("async http")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+# Requests in flight per host; the governor still decides how often they may start
+ASYNC_HOST_CONCURRENCY = int(os.environ.get("ASYNC_HOST_CONCURRENCY", 32))
+ASYNC_CHAN_HOST_CONCURRENCY = int(os.environ.get("ASYNC_CHAN_HOST_CONCURRENCY", 4))
+
+HOST_CONCURRENCY = {
+    "a.4cdn.org": ASYNC_CHAN_HOST_CONCURRENCY,
+}
+
+
+class HTTPStatusError(aiohttp.ClientError):
+    pass
+
+
+class Response:
+    """
+    A fully read response. Has the status_code/headers/json() the clients use, so
+    ValidatorCache and RateGovernor.update take it like a requests response.
+    """
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPStatusError(f"HTTP {self.status_code}")
+
+
+class AsyncHttp:
+    """
+    One aiohttp session for the process, with a semaphore per host capping requests in flight.
+    Use as `async with AsyncHttp() as http:`.
+    """
+    def __init__(self, host_concurrency=ASYNC_HOST_CONCURRENCY, timeout=HTTP_TIMEOUT):
+        self.host_concurrency = host_concurrency
+        self.timeout = timeout
+        self.semaphores = {}
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.host_concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def semaphore(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(HOST_CONCURRENCY.get(host, self.host_concurrency))
+        return self.semaphores[host]
+
+    """
+    governed_request for coroutines: the governor's slot is awaited instead of slept on,
+    with the same retries on 429/5xx and connection errors. Returns a Response.
+    The governor's state is flock'd across processes, so it is read and updated in a
+    thread rather than blocking every other coroutine while another process holds it.
+    """
+    async def request(self, method, url, max_retries=RATE_MAX_RETRIES, **kwargs):
+        governor = get_governor(url)
+        semaphore = self.semaphore(urlsplit(url).netloc)
+
+        for attempt in range(max_retries + 1):
+            wait = await asyncio.to_thread(governor.reserve)
+            if wait > 0:
+                metrics.observe("http_throttle_seconds", wait, host=governor.host)
+                await asyncio.sleep(wait)
+
+            started = time.perf_counter()
+            try:
+                async with semaphore:
+                    async with self.session.request(method, url, **kwargs) as resp:
+                        response = Response(resp.status, resp.headers, await resp.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc("http_requests_total", host=governor.host, status="error")
+                if attempt == max_retries:
+                    raise
+                delay = backoff(attempt)
+                logger.warning(f"{method} {url} failed ({e!r}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            metrics.observe("http_request_seconds", time.perf_counter() - started, host=governor.host)
+            metrics.inc("http_requests_total", host=governor.host, status=response.status_code)
+
+            retry_after = await asyncio.to_thread(governor.update, response)
+            if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                return response
+
+            delay = retry_after if retry_after is not None else backoff(attempt)
+            logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            if retry_after is None:
+                await asyncio.sleep(delay)
+
+    """
+    conditional_get for coroutines, sharing the sync clients' ValidatorCache; callers
+    forget the URL when they fail to store the response, as with conditional_get
+    """
+    async def conditional_get(self, validators, url, headers=None, **kwargs):
+        request_headers = dict(headers or {})
+        request_headers.update(validators.headers_for(url))
+
+        response = await self.request("GET", url, headers=request_headers, **kwargs)
+        if response.status_code == 200:
+            validators.remember(url, response)
+        return response
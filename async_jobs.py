@@ -0,0 +1,87 @@
+# Bounded in-process job queues and worker coroutines for the async crawl mode
+
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+import metrics
+from score_worker import push_score_jobs
+
+# logger setup
+logger = logging.getLogger("async jobs")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+# Crawl coroutines per queue, and how many jobs a queue holds before producers wait on it
+ASYNC_WORKERS = int(os.environ.get("ASYNC_WORKERS", 200))
+ASYNC_QUEUE_SIZE = int(os.environ.get("ASYNC_QUEUE_SIZE", 1000))
+# score-posts jobs are pushed at most this often per target instead of after every insert
+ASYNC_SCORE_PUSH_INTERVAL = float(os.environ.get("ASYNC_SCORE_PUSH_INTERVAL", 5))
+
+
+def job_queue(name, size=ASYNC_QUEUE_SIZE):
+    queue = asyncio.Queue(maxsize=size)
+    metrics.register_collector(lambda: metrics.set_gauge("queue_depth", queue.qsize(), queue=name))
+    return queue
+
+
+"""
+Run `count` coroutines that take argument tuples off the queue and await handle(*args).
+A job that raises is logged and dropped, like a failed Faktory job without retries.
+Runs until cancelled.
+"""
+async def run_workers(queue, jobtype, handle, count=ASYNC_WORKERS):
+    handle = metrics.track_job(jobtype, handle)
+
+    async def worker():
+        while True:
+            args = await queue.get()
+            try:
+                await handle(*args)
+            except Exception as e:
+                logger.error(f"{jobtype} job {args} failed: {e!r}")
+            finally:
+                queue.task_done()
+
+    await asyncio.gather(*(worker() for _ in range(count)))
+
+
+class ScoreNotifier:
+    """
+    Collects "rows were inserted" notices from the crawl coroutines and pushes one
+    score-posts job per target every ASYNC_SCORE_PUSH_INTERVAL seconds. A score-posts
+    job keeps claiming batches until nothing is left, so one job covers every insert
+    since the last push.
+    """
+    def __init__(self, interval=ASYNC_SCORE_PUSH_INTERVAL):
+        self.interval = interval
+        self.pending = set()
+
+    def notify(self, target):
+        self.pending.add(target)
+
+    async def flush(self):
+        pending, self.pending = self.pending, set()
+        for target in pending:
+            try:
+                # pyfaktory is blocking, keep it off the event loop
+                await asyncio.to_thread(push_score_jobs, target)
+            except Exception as e:
+                logger.error(f"Could not push score-posts job for {target}: {e}")
+                self.pending.add(target)
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            await self.flush()
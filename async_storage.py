@@ -0,0 +1,247 @@
+# asyncpg counterpart of storage.py and catalog_state.py for the async crawl mode
+# Rows are built by the same storage.py helpers, so both write paths store the same columns
+
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import asyncpg
+from dotenv import load_dotenv
+from psycopg2.extras import Json
+
+import metrics
+from catalog_state import diff_threads, thread_snapshot
+from storage import (
+    CHAN_POST_COLUMNS, REDDIT_COMMENT_COLUMNS, REDDIT_POST_COLUMNS, chan_post_rows, reddit_comment_rows,
+    reddit_post_rows
+)
+
+# logger setup
+logger = logging.getLogger("async storage")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+ASYNC_DB_POOL_SIZE = int(os.environ.get("ASYNC_DB_POOL_SIZE", 20))
+
+
+def create_pool(dsn=None, size=ASYNC_DB_POOL_SIZE):
+    return asyncpg.create_pool(dsn or os.environ.get("DATABASE_URL"), min_size=1, max_size=size)
+
+
+def encode_value(value):
+    if isinstance(value, Json):
+        return value.adapted
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+"""
+Insert rows with ON CONFLICT DO NOTHING in one statement. asyncpg has no execute_values,
+so the batch goes over as a single jsonb array and is unpacked by jsonb_to_recordset.
+Returns (inserted, skipped) like storage.bulk_insert.
+"""
+async def bulk_insert(conn, table, columns, conflict, rows, target="rows"):
+    if not rows:
+        return 0, 0
+
+    names = ", ".join(name for name, _ in columns)
+    record = ", ".join(f"{name} {sql_type}" for name, sql_type in columns)
+    records = json.dumps([dict(zip((name for name, _ in columns), row)) for row in rows], default=encode_value)
+    with metrics.timer("db_write_seconds", target=target):
+        inserted = await conn.fetch(
+            f"""
+            INSERT INTO {table} ({names})
+            SELECT {names} FROM jsonb_to_recordset($1::jsonb) AS r({record})
+            ON CONFLICT ({conflict}) DO NOTHING
+            RETURNING id
+            """,
+            records,
+        )
+    metrics.inc("db_rows_inserted_total", len(inserted), target=target)
+    metrics.inc("db_rows_skipped_total", len(rows) - len(inserted), target=target)
+    return len(inserted), len(rows) - len(inserted)
+
+
+async def insert_chan_posts(conn, board, thread_number, posts, keywords=None):
+    rows = chan_post_rows(board, thread_number, posts, keywords)
+    return await bulk_insert(
+        conn, "posts", CHAN_POST_COLUMNS, "board, thread_number, post_number, posted_at", rows, "chan-posts"
+    )
+
+
+async def latest_chan_post_number(conn, board, thread_number):
+    return await conn.fetchval(
+        "SELECT last_post_number FROM catalog_threads WHERE board = $1 AND thread_number = $2", board, thread_number
+    )
+
+
+async def save_chan_watermark(conn, board, thread_number, post_number):
+    await conn.execute(
+        """
+        INSERT INTO catalog_threads (board, thread_number, last_post_number)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (board, thread_number) DO UPDATE SET
+            last_post_number = greatest(catalog_threads.last_post_number, EXCLUDED.last_post_number)
+        """,
+        board, thread_number, post_number,
+    )
+
+
+async def get_thread_state(conn, board, thread_number):
+    return await conn.fetchval(
+        "SELECT state FROM catalog_threads WHERE board = $1 AND thread_number = $2", board, thread_number
+    )
+
+
+async def set_thread_state(conn, board, thread_numbers, state):
+    if not thread_numbers:
+        return
+    await conn.execute(
+        """
+        UPDATE catalog_threads SET state = $1, updated_at = now()
+        WHERE board = $2 AND thread_number = ANY($3::bigint[])
+        """,
+        state, board, list(thread_numbers),
+    )
+
+
+async def changed_threads(conn, board, threads):
+    if not threads:
+        return [], 0
+    rows = await conn.fetch(
+        """
+        SELECT thread_number, replies, last_modified FROM catalog_threads
+        WHERE board = $1 AND thread_number = ANY($2::bigint[])
+        """,
+        board, [thread["no"] for thread in threads],
+    )
+    return diff_threads(threads, {row[0]: (row[1], row[2]) for row in rows})
+
+
+async def departed_threads(conn, board, live_thread_numbers):
+    rows = await conn.fetch(
+        """
+        SELECT thread_number FROM catalog_threads
+        WHERE board = $1 AND state = 'active' AND NOT (thread_number = ANY($2::bigint[]))
+        """,
+        board, list(live_thread_numbers),
+    )
+    return [row[0] for row in rows]
+
+
+"""
+catalog_state.catalog_lock on an asyncpg connection; the same advisory lock key,
+so async and Faktory producers never crawl one board's catalog at the same time
+"""
+@asynccontextmanager
+async def catalog_lock(conn, board):
+    locked = await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", f"crawl-catalog:{board}")
+    try:
+        yield locked
+    finally:
+        if locked:
+            await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", f"crawl-catalog:{board}")
+
+
+async def save_snapshots(conn, board, threads):
+    if not threads:
+        return
+    await conn.executemany(
+        """
+        INSERT INTO catalog_threads (board, thread_number, replies, last_modified, bumped_at)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (board, thread_number) DO UPDATE SET
+            replies = EXCLUDED.replies,
+            last_modified = EXCLUDED.last_modified,
+            bumped_at = EXCLUDED.bumped_at,
+            updated_at = now()
+        """,
+        [(board,) + thread_snapshot(thread) for thread in threads],
+    )
+
+
+async def insert_reddit_posts(conn, subreddit, posts, keywords=None):
+    rows = reddit_post_rows(subreddit, posts, keywords)
+    return await bulk_insert(conn, "posts", REDDIT_POST_COLUMNS, "subreddit, post_id, posted_at", rows, "reddit-posts")
+
+
+# Comments stored before the tree harvester are skipped by id, see storage.legacy_comment_ids
+async def insert_reddit_comments(conn, subreddit, post_id, comments):
+    legacy = {
+        row[0] for row in await conn.fetch(
+            "SELECT comment_id FROM comments WHERE post_id = $1 AND data IS NULL", post_id
+        )
+    }
+    fresh = [comment for comment in comments if comment["id"] not in legacy]
+    rows = reddit_comment_rows(subreddit, post_id, fresh)
+    inserted, skipped = await bulk_insert(
+        conn, "comments", REDDIT_COMMENT_COLUMNS, "post_id, comment_id, posted_at", rows, "reddit-comments"
+    )
+    return inserted, skipped + len(comments) - len(fresh)
+
+
+async def recent_reddit_posts(conn, subreddit, since_utc, queued_timeout):
+    rows = await conn.fetch(
+        """
+        SELECT post_id, comments_seen FROM posts
+        WHERE subreddit = $1 AND posted_at >= to_timestamp($2)
+          AND (comments_queued_at IS NULL OR comments_queued_at < now() - make_interval(secs => $3))
+        """,
+        subreddit, since_utc, float(queued_timeout),
+    )
+    return {row[0]: row[1] for row in rows}
+
+
+async def mark_comments_queued(conn, subreddit, post_ids, since_utc):
+    if not post_ids:
+        return
+    await conn.execute(
+        """
+        UPDATE posts SET comments_queued_at = now()
+        WHERE subreddit = $1 AND post_id = ANY($2) AND posted_at >= to_timestamp($3)
+        """,
+        subreddit, list(post_ids), since_utc,
+    )
+
+
+async def save_comments_seen(conn, subreddit, post_id, num_comments):
+    await conn.execute(
+        "UPDATE posts SET comments_seen = $1, comments_queued_at = NULL WHERE subreddit = $2 AND post_id = $3",
+        num_comments, subreddit, post_id,
+    )
+
+
+async def clear_comments_queued(conn, subreddit, post_id):
+    await conn.execute(
+        "UPDATE posts SET comments_queued_at = NULL WHERE subreddit = $1 AND post_id = $2", subreddit, post_id
+    )
+
+
+async def get_subreddit_watermark(conn, subreddit):
+    row = await conn.fetchrow(
+        "SELECT last_created_utc, last_fullname FROM subreddit_watermarks WHERE subreddit = $1", subreddit
+    )
+    return tuple(row) if row else (None, None)
+
+
+async def save_subreddit_watermark(conn, subreddit, created_utc, fullname):
+    await conn.execute(
+        """
+        INSERT INTO subreddit_watermarks (subreddit, last_created_utc, last_fullname)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (subreddit) DO UPDATE SET
+            last_created_utc = EXCLUDED.last_created_utc,
+            last_fullname = EXCLUDED.last_fullname,
+            updated_at = now()
+        """,
+        subreddit, created_utc, fullname,
+    )
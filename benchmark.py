@@ -0,0 +1,518 @@
+# Offline end-to-end throughput benchmark: local stand-ins for 4chan, Reddit, ModerateHateSpeech and Faktory
+#
+# python benchmark.py [chan|reddit|all] [--latency 0.05] [--error-rate 0.01] [--threads 50] ...
+#
+# Needs a migrated Postgres for each crawler: BENCHMARK_CHAN_DATABASE_URL and BENCHMARK_REDDIT_DATABASE_URL
+# (falling back to CHAN_DATABASE_URL / REDDIT_DATABASE_URL). Every run writes to a fresh board and
+# subreddit name, so runs never collide with each other or with crawled data.
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from dotenv import load_dotenv
+
+# logger setup
+logger = logging.getLogger("benchmark")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+WORDS = (
+    "climate change global warming crisis carbon emissions policy energy weather record heat "
+    "science models data ice sea level temperature fossil fuel solar wind tax debate thread"
+).split()
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+class FakeApis:
+    """
+    One HTTP server standing in for the 4chan read API, Reddit OAuth/listings/comments and
+    the moderation API. Every response waits `latency` seconds, and `error_rate` of them
+    are 503s. Payload sizes come from the benchmark arguments.
+    """
+    def __init__(self, args, run_id):
+        self.args = args
+        self.run_id = run_id
+        self.rng = random.Random(args.seed)
+        self.rng_lock = threading.Lock()
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+        self.now = int(time.time())
+        # Post numbers and ids start from the run id so repeated runs never hit ON CONFLICT
+        self.first_thread = run_id * 1_000_000
+
+        apis = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                apis.handle(self, "GET")
+
+            def do_POST(self):
+                apis.handle(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def routes(self):
+        return [
+            ("chan catalog", r"^/[^/]+/catalog\.json$", self.chan_catalog),
+            ("chan thread tail", r"^/[^/]+/thread/\d+-tail\.json$", None),
+            ("chan thread", r"^/[^/]+/thread/(\d+)\.json$", self.chan_thread),
+            ("chan archive", r"^/[^/]+/archive\.json$", lambda match, query, body: []),
+            ("reddit token", r"^/api/v1/access_token$", lambda match, query, body: {
+                "access_token": "benchmark", "expires_in": 3600,
+            }),
+            ("reddit listing", r"^/r/[^/]+/new\.json$", self.reddit_listing),
+            ("reddit by_id", r"^/by_id/([^/]+)\.json$", self.reddit_by_id),
+            ("reddit comments", r"^/r/[^/]+/comments/(\w+)(?:/_/\w+)?\.json$", self.reddit_comments),
+            ("reddit morechildren", r"^/api/morechildren\.json$", self.reddit_more_children),
+            ("moderation", r"^/moderate/?$", self.moderate),
+        ]
+
+    def handle(self, request, method):
+        url = urlsplit(request.path)
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+
+        for name, pattern, handler in self.routes():
+            match = re.match(pattern, url.path)
+            if match:
+                break
+        else:
+            name, handler = "unknown", None
+
+        with self.calls_lock:
+            self.calls[name] += 1
+        time.sleep(self.args.latency)
+
+        with self.rng_lock:
+            failed = self.rng.random() < self.args.error_rate
+        if handler is None or failed:
+            request.send_response(404 if handler is None else 503)
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+
+        payload = json.dumps(handler(match, parse_qs(url.query), body)).encode("utf-8")
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def random_text(self, words):
+        with self.rng_lock:
+            return sentence(self.rng, words)
+
+    def chan_catalog(self, match, query, body):
+        threads = []
+        for offset in range(self.args.threads):
+            number = self.first_thread + offset * 1000
+            threads.append({
+                "no": number,
+                "sub": f"climate change thread {offset}",
+                "com": self.random_text(self.args.words),
+                "time": self.now - offset,
+                "replies": self.args.posts - 1,
+                "last_modified": self.now,
+            })
+        return [{"page": 1, "threads": threads}]
+
+    def chan_thread(self, match, query, body):
+        thread_number = int(match.group(1))
+        posts = []
+        for offset in range(self.args.posts):
+            posts.append({
+                "no": thread_number + offset,
+                "resto": 0 if offset == 0 else thread_number,
+                "time": self.now - 3600 + offset,
+                "com": f"<a href=\"#p{thread_number}\" class=\"quotelink\">&gt;&gt;{thread_number}</a><br>"
+                       + self.random_text(self.args.words),
+            })
+        posts[0]["sub"] = "climate change"
+        return {"posts": posts}
+
+    def reddit_post(self, index):
+        post_id = f"{self.run_id:x}{index:05x}"
+        return {"kind": "t3", "data": {
+            "id": post_id,
+            "name": f"t3_{post_id}",
+            "title": self.random_text(8),
+            "selftext": self.random_text(self.args.words),
+            "created_utc": self.now - index,
+            "num_comments": self.args.comments,
+        }}
+
+    def reddit_listing(self, match, query, body):
+        after = query.get("after", [None])[0]
+        start = 0
+        if after:
+            start = int(after[3:], 16) - (self.run_id << 20) + 1
+        end = min(start + 100, self.args.reddit_posts)
+        children = [self.reddit_post(index) for index in range(start, end)]
+        return {"kind": "Listing", "data": {
+            "children": children,
+            "after": children[-1]["data"]["name"] if end < self.args.reddit_posts and children else None,
+        }}
+
+    def reddit_by_id(self, match, query, body):
+        children = []
+        for fullname in match.group(1).split(","):
+            children.append(self.reddit_post(int(fullname[3:], 16) - (self.run_id << 20)))
+        return {"kind": "Listing", "data": {"children": children}}
+
+    def reddit_comment(self, post_id, comment_id, parent_id, depth):
+        return {"kind": "t1", "data": {
+            "id": comment_id,
+            "name": f"t1_{comment_id}",
+            "parent_id": parent_id,
+            "link_id": f"t3_{post_id}",
+            "body": self.random_text(self.args.words),
+            "created_utc": self.now - 60,
+            "depth": depth,
+            "replies": "",
+        }}
+
+    def reddit_comments(self, match, query, body):
+        # Three quarters of the comments come inline, one reply level deep; the rest sit behind a "more" stub
+        post_id = match.group(1)
+        inline = self.args.comments * 3 // 4
+        children = []
+        for index in range(0, inline, 2):
+            comment = self.reddit_comment(post_id, f"{post_id}c{index}", f"t3_{post_id}", 0)
+            if index + 1 < inline:
+                reply = self.reddit_comment(post_id, f"{post_id}c{index + 1}", f"t1_{post_id}c{index}", 1)
+                comment["data"]["replies"] = {"kind": "Listing", "data": {"children": [reply]}}
+            children.append(comment)
+        more = [f"{post_id}c{index}" for index in range(inline, self.args.comments)]
+        if more:
+            children.append({"kind": "more", "data": {"parent_id": f"t3_{post_id}", "children": more}})
+        return [{"kind": "Listing", "data": {"children": []}}, {"kind": "Listing", "data": {"children": children}}]
+
+    def reddit_more_children(self, match, query, body):
+        post_id = query["link_id"][0][3:]
+        things = [
+            self.reddit_comment(post_id, comment_id, f"t3_{post_id}", 0)
+            for comment_id in query["children"][0].split(",")
+        ]
+        return {"json": {"data": {"things": things}}}
+
+    def moderate(self, match, query, body):
+        with self.rng_lock:
+            toxic = self.rng.random() < 0.2
+        return {"class": "flag" if toxic else "normal", "confidence": 0.9}
+
+
+class LocalJob:
+    def __init__(self, job, pushed_at):
+        self.job = job
+        self.pushed_at = pushed_at
+
+
+class LocalFaktory:
+    """
+    In-process stand-in for the Faktory server and consumer: pushed jobs go to in-memory
+    queues and `concurrency` threads run them with the registered functions, taking
+    queues in the given order (strict priority) like the real consumers.
+    """
+    def __init__(self, queues, concurrency):
+        self.queues = {queue: deque() for queue in queues}
+        self.concurrency = concurrency
+        self.functions = {}
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.latencies = {}
+        self.failures = Counter()
+
+    def register(self, jobtype, function):
+        self.functions[jobtype] = function
+
+    def push(self, job):
+        with self.condition:
+            self.queues.setdefault(job.queue, deque()).append(LocalJob(job, time.monotonic()))
+            self.condition.notify()
+
+    def next_job(self):
+        for queue in self.queues.values():
+            if queue:
+                return queue.popleft()
+        return None
+
+    def idle(self):
+        return self.in_flight == 0 and not any(self.queues.values())
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while True:
+                    local_job = self.next_job()
+                    if local_job is not None:
+                        self.in_flight += 1
+                        break
+                    if self.idle():
+                        self.condition.notify_all()
+                        return
+                    self.condition.wait()
+
+            job = local_job.job
+            try:
+                self.functions[job.jobtype](*job.args)
+            except Exception as e:
+                logger.error(f"{job.jobtype} failed: {e}")
+                self.failures[job.jobtype] += 1
+
+            with self.condition:
+                self.in_flight -= 1
+                self.latencies.setdefault(job.jobtype, []).append(time.monotonic() - local_job.pushed_at)
+                self.condition.notify_all()
+
+    """
+    Run jobs until every queue is empty and nothing is in flight
+    """
+    def run_until_idle(self):
+        workers = [threading.Thread(target=self.worker) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    """
+    Client and Producer classes with pyfaktory's interface, bound to this stand-in
+    """
+    def client_classes(self):
+        faktory = self
+
+        class LocalClient:
+            def __init__(self, faktory_url=None, role=None, **kwargs):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+        class LocalProducer:
+            def __init__(self, client=None):
+                pass
+
+            def push(self, job):
+                faktory.push(job)
+
+            def push_bulk(self, jobs):
+                for job in jobs:
+                    faktory.push(job)
+
+        return LocalClient, LocalProducer
+
+
+def counting_connection_factory(counter, lock):
+    """
+    psycopg2 connection class that counts statements and commits/rollbacks that reach the server
+    """
+    import psycopg2.extensions
+
+    def count():
+        with lock:
+            counter["db round trips"] += 1
+
+    class CountingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, vars=None):
+            count()
+            return super().execute(query, vars)
+
+        def executemany(self, query, vars_list):
+            # psycopg2 sends one statement per parameter set
+            vars_list = list(vars_list)
+            for _ in vars_list:
+                count()
+            return super().executemany(query, vars_list)
+
+    class CountingConnection(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            kwargs.setdefault("cursor_factory", CountingCursor)
+            return super().cursor(*args, **kwargs)
+
+        def commit(self):
+            if self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                count()
+            return super().commit()
+
+        def rollback(self):
+            if self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                count()
+            return super().rollback()
+
+    return CountingConnection
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def count_rows(pool, query, params):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            rows = cur.fetchone()[0]
+        conn.rollback()
+    return rows
+
+
+def report(name, rows, elapsed, apis, db_counter, faktory):
+    http_calls = sum(apis.calls.values())
+    print(f"\n== {name} ==")
+    print(f"rows stored          {rows}")
+    print(f"wall time            {elapsed:.2f}s")
+    print(f"rows/sec             {rows / elapsed if elapsed else 0.0:.1f}")
+    print(f"HTTP calls per row   {http_calls / rows if rows else 0.0:.3f}  ({dict(apis.calls)})")
+    print(f"DB round trips/row   {db_counter['db round trips'] / rows if rows else 0.0:.3f}")
+    for jobtype, latencies in sorted(faktory.latencies.items()):
+        print(
+            f"{jobtype:<20} {len(latencies)} jobs, p50 {percentile(latencies, 0.5) * 1000:.0f}ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.0f}ms, {faktory.failures[jobtype]} failed"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline crawler throughput benchmark")
+    parser.add_argument("crawler", nargs="?", default="all", choices=["chan", "reddit", "all"])
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every fake response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake responses that are 503s")
+    parser.add_argument("--threads", type=int, default=50, help="matching threads in the catalog")
+    parser.add_argument("--posts", type=int, default=100, help="posts per thread")
+    parser.add_argument("--reddit-posts", type=int, default=200, help="posts in the subreddit listing")
+    parser.add_argument("--comments", type=int, default=40, help="comments per reddit post")
+    parser.add_argument("--words", type=int, default=30, help="words per post/comment body")
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("CONSUMER_CONCURRENCY", 5)))
+    parser.add_argument("--seed", type=int, default=415)
+    parser.add_argument("--verbose", action="store_true", help="keep the crawlers' INFO logging")
+    args = parser.parse_args()
+
+    run_id = int(time.time()) % 100_000
+    apis = FakeApis(args, run_id)
+    apis.start()
+
+    # Module-level settings are read at import, so everything is pointed at the stand-ins first
+    cache_dir = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ.update({
+        "CHAN_API_BASE": apis.base_url,
+        "REDDIT_API_BASE": apis.base_url,
+        "REDDIT_TOKEN_URL": f"{apis.base_url}/api/v1/access_token",
+        "MODERATE_HATESPEECH_API_URL": f"{apis.base_url}/moderate/",
+        "MODERATE_HATESPEECH_API_KEY": "benchmark",
+        "TOXICITY_CACHE_PATH": os.path.join(cache_dir, "toxicity_cache.sqlite3"),
+        "RATE_STATE_DIR": os.path.join(cache_dir, "rate_limits"),
+        # Archiving is part of the write path, but bench boards don't belong in the real archive
+        "RAW_ARCHIVE_DIR": os.path.join(cache_dir, "raw_archive"),
+        "KEYWORDS": "climate change",
+        "RATE_BACKOFF_BASE": os.environ.get("RATE_BACKOFF_BASE", "0.05"),
+    })
+    os.environ.pop("REDDIT_TOKEN_CACHE", None)
+    chan_dsn = os.environ.get("BENCHMARK_CHAN_DATABASE_URL") or os.environ.get("CHAN_DATABASE_URL")
+    reddit_dsn = os.environ.get("BENCHMARK_REDDIT_DATABASE_URL") or os.environ.get("REDDIT_DATABASE_URL")
+    os.environ["CHAN_DATABASE_URL"] = chan_dsn or ""
+    os.environ["REDDIT_DATABASE_URL"] = reddit_dsn or ""
+
+    import chan_crawler
+    import reddit_crawler
+    import score_worker
+    from db_pool import get_pool
+
+    if not args.verbose:
+        for name in list(logging.Logger.manager.loggerDict):
+            if name != "benchmark":
+                logging.getLogger(name).setLevel(logging.WARNING)
+
+    db_counter = Counter()
+    db_lock = threading.Lock()
+    connection_factory = counting_connection_factory(db_counter, db_lock)
+
+    def new_faktory(queues):
+        faktory = LocalFaktory(queues, args.concurrency)
+        Client, Producer = faktory.client_classes()
+        for module in (chan_crawler, reddit_crawler, score_worker):
+            module.Client = Client
+            module.Producer = Producer
+        faktory.register("score-posts", score_worker.score_posts)
+        return faktory
+
+    def reset_counters():
+        apis.calls.clear()
+        db_counter.clear()
+
+    try:
+        if args.crawler in ("chan", "all"):
+            if not chan_dsn:
+                raise SystemExit("Set BENCHMARK_CHAN_DATABASE_URL to a migrated 4chan database")
+            os.environ["DATABASE_URL"] = chan_dsn
+            pool = get_pool(chan_dsn, size=args.concurrency, connection_factory=connection_factory)
+            board = f"bench{run_id}"
+            faktory = new_faktory(["crawl-thread", "score-posts"])
+            faktory.register("crawl-thread", chan_crawler.crawl_thread)
+
+            reset_counters()
+            started = time.monotonic()
+            chan_crawler.crawl_catalog(board)
+            faktory.run_until_idle()
+            elapsed = time.monotonic() - started
+
+            rows = count_rows(pool, "SELECT count(*) FROM posts WHERE board = %s", (board,))
+            report(f"4chan /{board}/", rows, elapsed, apis, db_counter, faktory)
+
+        if args.crawler in ("reddit", "all"):
+            if not reddit_dsn:
+                raise SystemExit("Set BENCHMARK_REDDIT_DATABASE_URL to a migrated Reddit database")
+            os.environ["DATABASE_URL"] = reddit_dsn
+            pool = get_pool(reddit_dsn, size=args.concurrency, connection_factory=connection_factory)
+            subreddit = f"bench{run_id}"
+            faktory = new_faktory(["crawl-subreddit", "crawl-comments", "score-posts"])
+            faktory.register("crawl-subreddit", reddit_crawler.crawl_subreddit)
+            faktory.register("crawl-comments", reddit_crawler.crawl_comments)
+
+            reset_counters()
+            started = time.monotonic()
+            reddit_crawler.produce_jobs([subreddit])
+            faktory.run_until_idle()
+            elapsed = time.monotonic() - started
+
+            rows = count_rows(pool, "SELECT count(*) FROM posts WHERE subreddit = %s", (subreddit,))
+            rows += count_rows(pool, "SELECT count(*) FROM comments WHERE subreddit = %s", (subreddit,))
+            report(f"r/{subreddit}", rows, elapsed, apis, db_counter, faktory)
+    finally:
+        apis.stop()
+
+
+if __name__ == "__main__":
+    main()
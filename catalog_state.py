@@ -0,0 +1,154 @@
+# Per-thread catalog snapshots and lifecycle state used to decide which 4chan threads need a crawl
+
+import logging
+from contextlib import contextmanager
+
+from psycopg2.extras import execute_values
+
+# logger setup
+logger = logging.getLogger("catalog state")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+
+"""
+Pull the fields we compare between catalog fetches out of a catalog thread object.
+The bump time is the time of the newest reply shown in the catalog, or the OP time.
+"""
+def thread_snapshot(thread):
+    last_replies = thread.get("last_replies") or []
+    bumped_at = last_replies[-1].get("time") if last_replies else thread.get("time")
+    return (thread["no"], thread.get("replies", 0), thread.get("last_modified"), bumped_at)
+
+
+"""
+Return the catalog threads that are new or whose reply count or last_modified moved
+since the last saved snapshot, plus how many posts appeared in them (churn)
+"""
+def changed_threads(conn, board, threads):
+    if not threads:
+        return [], 0
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT thread_number, replies, last_modified FROM catalog_threads
+            WHERE board = %s AND thread_number = ANY(%s)
+            """,
+            (board, [thread["no"] for thread in threads]),
+        )
+        previous = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+    conn.rollback()
+    return diff_threads(threads, previous)
+
+
+"""
+Compare catalog threads with their previous snapshots, {thread_number: (replies, last_modified)}.
+Shared with the asyncpg queries in async_storage.py.
+"""
+def diff_threads(threads, previous):
+    changed = []
+    new_posts = 0
+    for thread in threads:
+        thread_number, replies, last_modified, _ = thread_snapshot(thread)
+        if thread_number not in previous:
+            changed.append(thread)
+            new_posts += replies + 1
+        elif previous[thread_number] != (replies, last_modified):
+            changed.append(thread)
+            new_posts += max(0, replies - previous[thread_number][0])
+    return changed, new_posts
+
+
+"""
+Threads we still consider active that are no longer in the board's catalog
+"""
+def departed_threads(conn, board, live_thread_numbers):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT thread_number FROM catalog_threads
+            WHERE board = %s AND state = 'active' AND NOT (thread_number = ANY(%s))
+            """,
+            (board, list(live_thread_numbers)),
+        )
+        departed = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    return departed
+
+
+"""
+Lifecycle state of a thread: active, archived, dead, or None if we never tracked it
+"""
+def get_thread_state(conn, board, thread_number):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT state FROM catalog_threads WHERE board = %s AND thread_number = %s",
+            (board, thread_number),
+        )
+        row = cur.fetchone()
+    conn.rollback()
+    return row[0] if row else None
+
+
+def set_thread_state(conn, board, thread_numbers, state):
+    if not thread_numbers:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE catalog_threads SET state = %s, updated_at = now()
+            WHERE board = %s AND thread_number = ANY(%s)
+            """,
+            (state, board, list(thread_numbers)),
+        )
+    conn.commit()
+
+
+"""
+Session advisory lock so only one catalog crawl per board runs at a time, across
+every producer process. Yields False when another crawl already holds it.
+"""
+@contextmanager
+def catalog_lock(conn, board):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"crawl-catalog:{board}",))
+        locked = cur.fetchone()[0]
+    conn.commit()
+    try:
+        yield locked
+    finally:
+        if locked:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (f"crawl-catalog:{board}",))
+            conn.commit()
+
+
+"""
+Record the snapshot of threads we have enqueued, so the next catalog fetch skips them
+unless they change again
+"""
+def save_snapshots(conn, board, threads):
+    if not threads:
+        return
+
+    rows = [(board,) + thread_snapshot(thread) for thread in threads]
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            INSERT INTO catalog_threads (board, thread_number, replies, last_modified, bumped_at)
+            VALUES %s
+            ON CONFLICT (board, thread_number) DO UPDATE SET
+                replies = EXCLUDED.replies,
+                last_modified = EXCLUDED.last_modified,
+                bumped_at = EXCLUDED.bumped_at,
+                updated_at = now()
+            """,
+            rows,
+        )
+    conn.commit()
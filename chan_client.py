@@ -1,7 +1,10 @@
 # 4chan API client that has minimal functionality to collect data
 
 import logging
-import requests
+import os
+from dotenv import load_dotenv
+from http_session import HTTP_TIMEOUT, NOT_FOUND, NOT_MODIFIED, ValidatorCache, build_session, conditional_get
+from rate_limit import governed_request
 
 # logger setup
 logger = logging.getLogger("4chan client")
@@ -17,8 +20,15 @@ fh.setLevel(logging.INFO)
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+load_dotenv()
+
+# Shared by every ChanClient in the process so connections and validators outlive a single job
+session = build_session()
+validators = ValidatorCache()
+
 class ChanClient:
-    API_BASE = "http://a.4cdn.org"
+    # Overridable so benchmark.py can point the client at a local stand-in
+    API_BASE = os.environ.get("CHAN_API_BASE", "http://a.4cdn.org")
 
     """
     Get json for a given thread
@@ -30,6 +40,16 @@ class ChanClient:
         api_call = self.build_request(request_pieces)
         return self.execute_request(api_call)
 
+    """
+    Get the tail json for a given thread: the OP plus only the last posts.
+    4chan only serves this for long threads, so None means fall back to get_thread.
+    """
+    def get_thread_tail(self, board, thread_number):
+        # Sample API call: http://a.4cdn.org/pol/thread/124205675-tail.json
+        request_pieces = [board, "thread", f"{thread_number}-tail.json"]
+        api_call = self.build_request(request_pieces)
+        return self.execute_request(api_call, not_found=None)
+
     """
     Get catalog json for a given board
     """
@@ -38,6 +58,27 @@ class ChanClient:
         api_call = self.build_request(request_pieces)
         return self.execute_request(api_call)
 
+    """
+    Get the list of archived thread numbers for a given board.
+    Boards without an archive 404, which we treat as an empty archive.
+    Fetched without validators: callers need the list itself, never NOT_MODIFIED.
+    """
+    def get_archive(self, board):
+        request_pieces = [board, "archive.json"]
+        api_call = self.build_request(request_pieces)
+        return self.execute_request(api_call, not_found=[], conditional=False)
+
+    """
+    Forget the validators of a thread's json and tail json so the next fetch is a full 200.
+    Crawlers call this when they could not store what they fetched.
+    """
+    def forget_thread(self, board, thread_number):
+        for name in (f"{thread_number}.json", f"{thread_number}-tail.json"):
+            validators.forget(self.build_request([board, "thread", name]))
+
+    def forget_catalog(self, board):
+        validators.forget(self.build_request([board, "catalog.json"]))
+
     """
     Build a request from pieces
     """
@@ -46,22 +87,59 @@ class ChanClient:
         return api_call
 
     """
-    This executes an HTTP request and returns json
+    This executes an HTTP request and returns json, NOT_MODIFIED when the
+    data hasn't changed since we last fetched it, or not_found on a 404.
+    With conditional=False no validators are sent, so the answer is never NOT_MODIFIED.
     """
-    def execute_request(self, api_call):
+    def execute_request(self, api_call, not_found=NOT_FOUND, conditional=True):
         try:
-            resp = requests.get(api_call)
-            if resp.status_code == 200:
-                json_data = resp.json()  # Successfully retrieved JSON data
-                logger.info(f"Successfully retrieved data from: {api_call}")
-                return json_data
+            if conditional:
+                resp = conditional_get(session, validators, api_call)
             else:
-                logger.error(f"Failed request with status code: {resp.status_code}")
-                return None
+                resp = governed_request(session, "GET", api_call, timeout=HTTP_TIMEOUT)
+            return self.read_response(api_call, resp, not_found)
         except Exception as e:
             logger.error(f"Request error: {e}")
             return None
 
+    """
+    Turn a response into what execute_request returns; shared with AsyncChanClient
+    """
+    def read_response(self, api_call, resp, not_found=NOT_FOUND):
+        if resp.status_code == 304:
+            logger.info(f"Not modified since last fetch: {api_call}")
+            return NOT_MODIFIED
+        if resp.status_code == 404:
+            logger.info(f"Not found: {api_call}")
+            return not_found
+        if resp.status_code == 200:
+            json_data = resp.json()  # Successfully retrieved JSON data
+            logger.info(f"Successfully retrieved data from: {api_call}")
+            return json_data
+        else:
+            logger.error(f"Failed request with status code: {resp.status_code}")
+            return None
+
+class AsyncChanClient(ChanClient):
+    """
+    ChanClient for the async crawl mode. Only the request itself differs, so every
+    ChanClient method returns a coroutine here, with the same return values.
+    http is an open async_http.AsyncHttp.
+    """
+    def __init__(self, http):
+        self.http = http
+
+    async def execute_request(self, api_call, not_found=NOT_FOUND, conditional=True):
+        try:
+            if conditional:
+                resp = await self.http.conditional_get(validators, api_call)
+            else:
+                resp = await self.http.request("GET", api_call)
+            return self.read_response(api_call, resp, not_found)
+        except Exception as e:
+            logger.error(f"Request error: {e!r}")
+            return None
+
 if __name__ == "__main__":
     client = ChanClient()
 
@@ -1,14 +1,26 @@
-from chan_client import ChanClient
+from chan_client import AsyncChanClient, ChanClient
+from async_http import AsyncHttp
+from async_jobs import ScoreNotifier, job_queue, run_workers
+import async_storage
+from http_session import NOT_FOUND, NOT_MODIFIED
+from score_worker import push_score_jobs
+from storage import chan_post_has_text, insert_chan_posts, latest_chan_post_number, save_chan_watermark
+from db_pool import CONSUMER_CONCURRENCY, get_pool
+from catalog_state import (
+    catalog_lock, changed_threads, departed_threads, get_thread_state, save_snapshots, set_thread_state
+)
+from scheduler import Scheduler, Source, parse_sources
+from keyword_matcher import get_matcher
+from text_normalize import clean_chan_comment
+from raw_archive import archive_chan_posts
+import metrics
+import asyncio
 import logging
 from pyfaktory import Client, Consumer, Job, Producer
-import datetime
-import psycopg2
 from psycopg2.extras import Json
 from psycopg2.extensions import register_adapter
 from dotenv import load_dotenv
 import os
-import time
-import requests
 
 
 # Register psycopg2 adapter for JSON data insertion
@@ -21,9 +33,8 @@ FAKTORY_SERVER_URL = os.environ.get("FAKTORY_SERVER_URL")
 DATABASE_URL = os.environ.get("DATABASE_URL")
 MODERATE_HATESPEECH_API_KEY = os.environ.get("MODERATE_HATESPEECH_API_KEY")
 
-KEYWORDS = os.environ.get("KEYWORDS", "climate change,global warming,climate crisis").split(",")
-# Define keywords to filter threads
-#KEYWORDS = ["climate change", "global warming", "climate crisis"]
+# Catalog fields matched against the KEYWORDS list (see keyword_matcher.py)
+CHAN_KEYWORD_FIELDS = [field.strip() for field in os.environ.get("CHAN_KEYWORD_FIELDS", "sub,com").split(",")]
 
 # Logger setup
 logger = logging.getLogger("4chan client")
@@ -49,178 +60,381 @@ def thread_numbers_from_catalog(catalog):
     for page in catalog:
         for thread in page["threads"]:
             thread_number = thread["no"]
-            thread_subject = thread.get("sub", "")
 
 
-            # Check only the 'sub' (subject) field for keywords
-            if any(keyword.lower() in thread_subject.lower() for keyword in KEYWORDS):
+            # Check the subject and OP comment (CHAN_KEYWORD_FIELDS) for keywords
+            if thread_keywords_match(thread):
                 thread_numbers.append(thread_number)
 
 
     return thread_numbers
 
+"""
+Whether a catalog thread (or a thread's OP) mentions any keyword
+"""
+def thread_keywords_match(thread):
+    return get_matcher().search(*thread_texts(thread))
+
+
+"""
+Keywords a thread matched, stored with each of its posts for the per-keyword rollups
+"""
+def thread_keywords(thread):
+    return get_matcher().matches(*thread_texts(thread))
+
+
+# sub and com are HTML, matched as plain text so "climate<br>change" still hits
+def thread_texts(thread):
+    return [clean_chan_comment(thread.get(field)) for field in CHAN_KEYWORD_FIELDS]
+
+
 """
 Return thread numbers that existed in previous but don't exist in current
 """
 
 
-def get_toxicity_score(text):
-    API_URL = "https://api.moderatehatespeech.com/api/v1/moderate/"
-    payload = {
-        "token": os.environ.get("MODERATE_HATESPEECH_API_KEY"),
-        "text": text,
-    }
-    try:
-        response = requests.post(API_URL, json=payload)
-        logger.debug(f"API Request Payload: {payload}")
-        logger.debug(f"API Response: {response.status_code} - {response.text}")
-        response_data = response.json()
-
-
-        # Log and return the "class" field or default to "normal"
-        toxicity_class = response_data.get("class", "normal")
-        logger.debug(f"Toxicity Class from API: {toxicity_class}")
-        return toxicity_class
-    except ValueError as e:
-        logger.error(f"Failed to parse JSON response: {e}")
-        return "normal"
-    except Exception as e:
-        logger.error(f"Failed to fetch toxicity score: {e}")
-        return "normal"
+"""
+Check whether a -tail.json response reaches back to a post we already stored.
+If its first reply is newer than the watermark, posts may have been missed in between.
+"""
+def tail_covers_watermark(tail_data, watermark):
+    tail_posts = tail_data.get("posts", [])
+    if len(tail_posts) < 2:
+        return False
+    return tail_posts[1]["no"] <= watermark
 
 
 """
-Crawl a given thread and get its json. Insert the posts into db
+Crawl a given thread and get its json. Insert only the posts newer than what is already in the db.
+final is set for the one last crawl of a thread that left the catalog; otherwise archived
+and dead threads are skipped.
 """
-def crawl_thread(board, thread_number):
+def crawl_thread(board, thread_number, final=False):
     chan_client = ChanClient()
-    thread_data = chan_client.get_thread(board, thread_number)
 
+    with get_pool().connection() as conn:
+        state = get_thread_state(conn, board, thread_number)
+        if state in ("archived", "dead") and not final:
+            logger.info(f"Skipping {state} thread: {board}/{thread_number}")
+            return
+        watermark = latest_chan_post_number(conn, board, thread_number)
+
+    # Long threads we've seen before only need their tail
+    thread_data = None
+    if watermark is not None:
+        tail_data = chan_client.get_thread_tail(board, thread_number)
+        if tail_data is NOT_MODIFIED:
+            logger.info(f"No new posts in thread: {board}/{thread_number}")
+            return
+        if tail_data and tail_covers_watermark(tail_data, watermark):
+            thread_data = tail_data
+            logger.info(f"Using tail for thread: {board}/{thread_number}")
+    if thread_data is None:
+        thread_data = chan_client.get_thread(board, thread_number)
+
+    if thread_data is NOT_MODIFIED:
+        logger.info(f"No new posts in thread: {board}/{thread_number}")
+        return
+    if thread_data is NOT_FOUND:
+        logger.info(f"Thread is gone, marking dead: {board}/{thread_number}")
+        with get_pool().connection() as conn:
+            set_thread_state(conn, board, [thread_number], "dead")
+        return
     if not thread_data:
         logger.error(f"Failed to retrieve thread data for: {board}/{thread_number}")
         return
 
-    conn = psycopg2.connect(dsn=DATABASE_URL)
-    cur = conn.cursor()
-
-    for post in thread_data.get("posts", []):
-        post_number = post["no"]
-        post_content = post.get("com", "")
-
-
-        if not post_content:
-            logger.info(f"Skipping empty post content for post {post_number}")
-            continue
+    fetched = posts_after(thread_data, watermark)
+    posts = posts_with_text(fetched)
+    # Tail and full thread json both start with the OP
+    keywords = thread_keywords(thread_data["posts"][0])
+    # Everything new goes to the archive, including the image-only posts we don't store
+    archive_chan_posts(board, thread_number, fetched, keywords)
 
+    # Posts go in unscored; the score-posts workers fill in toxicity_score
+    try:
+        with get_pool().connection() as conn:
+            inserted, skipped = insert_chan_posts(conn, board, thread_number, posts, keywords)
+            save_chan_watermark(conn, board, thread_number, thread_data["posts"][-1]["no"])
+            # An archived thread can't get new posts, so this was its last crawl
+            if thread_data["posts"][0].get("archived") and state != "archived":
+                set_thread_state(conn, board, [thread_number], "archived")
+        logger.info(f"Inserted {inserted} posts, skipped {skipped} existing for thread: {board}/{thread_number}")
+    except Exception as e:
+        logger.error(f"Error inserting into database: {e}")
+        # Otherwise the next crawl gets a 304 and these posts are never stored
+        chan_client.forget_thread(board, thread_number)
+        return
 
-        toxicity_score = get_toxicity_score(post_content)
-        post["toxicity_score"] = toxicity_score  
+    if inserted:
+        push_score_jobs("chan-posts")
 
+"""
+Posts of a thread json newer than the watermark
+"""
+def posts_after(thread_data, watermark):
+    return [post for post in thread_data.get("posts", []) if watermark is None or post["no"] > watermark]
 
-        logger.debug(f"Post Content: {post_content[:50]}... | Toxicity: {toxicity_score}")
 
-        # Check if post already exists in the database
-        cur.execute(
-            "SELECT 1 FROM posts WHERE board = %s AND thread_number = %s AND post_number = %s",
-            (board, thread_number, post_number),
-        )
-        if cur.fetchone():
-            logger.info(f"Post already exists: {board}/{thread_number}/{post_number}")
+"""
+The posts that have a comment
+"""
+def posts_with_text(posts):
+    kept = []
+    for post in posts:
+        if not chan_post_has_text(post):
+            logger.info(f"Skipping empty post content for post {post['no']}")
             continue
+        kept.append(post)
+    return kept
 
 
-        try:
-            query = """
-            INSERT INTO posts (board, thread_number, post_number, data, toxicity_score)
-            VALUES (%s, %s, %s, %s, %s) RETURNING id
-            """
-            cur.execute(query, (board, thread_number, post_number, Json(post), toxicity_score))
-            conn.commit()
-            db_id = cur.fetchone()[0]
-            logger.info(f"Inserted DB id: {db_id} for thread: {board}/{thread_number}")
-        except Exception as e:
-            logger.error(f"Error inserting into database: {e}")
-
-
-    cur.close()
-    conn.close()
-
 """
 Go out, grab the catalog for a given board, and figure out what threads we need to collect.
-For each thread to collect, enqueue a new job to crawl the thread.
-Schedule catalog crawl to run again at some point in the future.
+For each thread that is new or changed since the last catalog, enqueue a new job to crawl the thread.
+Returns how many new posts showed up in matching threads (the scheduler's churn signal),
+or None if the catalog could not be fetched. The scheduler decides when to run it again.
+previous_catalog_thread_numbers is only kept for old queued crawl-catalog jobs; the
+catalog_threads table now tracks what we saw last time.
 """
 def crawl_catalog(board, previous_catalog_thread_numbers=[]):
-    chan_client = ChanClient()
+    with get_pool().connection() as conn, catalog_lock(conn, board) as locked:
+        if not locked:
+            logger.info(f"Catalog crawl already running for board: {board}")
+            return 0
+        try:
+            return collect_catalog(conn, board)
+        except Exception:
+            # Changed threads were not queued; without this the next poll gets a 304 and skips them
+            ChanClient().forget_catalog(board)
+            raise
 
 
-    current_catalog = chan_client.get_catalog(board)
+"""
+Threads of a catalog that match the keywords, and the numbers of every thread still in it
+"""
+def catalog_threads(catalog):
+    matching_threads = []
+    for page in catalog:
+        for thread in page["threads"]:
+            if thread_keywords_match(thread):
+                matching_threads.append(thread)
 
+    logger.info(f"Collected threads: {[thread['no'] for thread in matching_threads]}")
+    live_thread_numbers = [thread["no"] for page in catalog for thread in page["threads"]]
+    return matching_threads, live_thread_numbers
 
-    if not current_catalog:
-        logger.error(f"Failed to fetch catalog for board: {board}")
-        return
 
-    # Get thread numbers that match the keywords
-    matching_thread_numbers = []
-    for page in current_catalog:
-        for thread in page["threads"]:
-            thread_number = thread["no"]
-            thread_subject = thread.get("sub", "")
+"""
+Split threads that left the catalog into (archived, pruned) by the board's archive list.
+Returns (None, None) when the archive could not be fetched, since an empty list would
+count every departed thread as pruned.
+"""
+def classify_departed(departed, archive):
+    if archive is None:
+        return None, None
+    archive = set(archive)
+    archived = [thread_number for thread_number in departed if thread_number in archive]
+    pruned = [thread_number for thread_number in departed if thread_number not in archive]
+    return archived, pruned
 
 
-            if thread_subject:
-                toxicity_score = get_toxicity_score(thread_subject)
-                logger.debug(f"Thread Subject: {thread_subject[:50]}... | Toxicity: {toxicity_score}")
+def collect_catalog(conn, board):
+    chan_client = ChanClient()
 
 
-            if any(keyword.lower() in thread_subject.lower() for keyword in KEYWORDS):
-                matching_thread_numbers.append(thread_number)
+    current_catalog = chan_client.get_catalog(board)
 
 
-    logger.info(f"Collected threads: {matching_thread_numbers}")
+    if current_catalog is NOT_MODIFIED:
+        logger.info(f"Catalog unchanged for board: {board}")
+        return 0
+    if current_catalog is NOT_FOUND or not current_catalog:
+        logger.error(f"Failed to fetch catalog for board: {board}")
+        return None
+
+    matching_threads, live_thread_numbers = catalog_threads(current_catalog)
+
+    # Threads we were following that fell off the catalog get one final crawl
+    departed = departed_threads(conn, board, live_thread_numbers)
+    if departed:
+        archived, pruned = classify_departed(departed, chan_client.get_archive(board))
+        if archived is None:
+            # Leave them active so the next catalog crawl tries again
+            logger.error(f"Failed to fetch archive for board: {board}; {len(departed)} departed threads wait")
+            departed = []
+        else:
+            logger.info(f"Threads left the catalog: {len(archived)} archived, {len(pruned)} pruned")
 
 
-    if not matching_thread_numbers:
+    if not matching_threads and not departed:
         logger.info("No matching threads found.")
-        return
+        return 0
 
 
-    logger.info(f"Collected threads: {matching_thread_numbers}")
+    # Only threads that are new or whose reply count / last_modified moved need a crawl
+    changed, new_posts = changed_threads(conn, board, matching_threads)
+    logger.info(f"{len(changed)} of {len(matching_threads)} matching threads changed since the last catalog")
 
 
-    # Enqueue jobs for matching threads
+    # Enqueue jobs for changed threads and final crawls for departed ones
     crawl_thread_jobs = []
     with Client(faktory_url=FAKTORY_SERVER_URL, role="producer") as client:
         producer = Producer(client=client)
-        for thread_number in matching_thread_numbers:
+        for thread_number in [thread["no"] for thread in changed]:
             job = Job(
                 jobtype="crawl-thread", args=(board, thread_number), queue="crawl-thread"
             )
             crawl_thread_jobs.append(job)
+        for thread_number in departed:
+            job = Job(
+                jobtype="crawl-thread", args=(board, thread_number, True), queue="crawl-thread"
+            )
+            crawl_thread_jobs.append(job)
 
 
         if crawl_thread_jobs:
-            producer.push_bulk(crawl_thread_jobs)
+            with metrics.timer("faktory_push_seconds", queue="crawl-thread"):
+                producer.push_bulk(crawl_thread_jobs)
+            metrics.inc("faktory_jobs_pushed_total", len(crawl_thread_jobs), queue="crawl-thread")
             logger.info(f"Pushed {len(crawl_thread_jobs)} jobs to 'crawl-thread' queue.")
         else:
             logger.info("No jobs to push to 'crawl-thread'.")
 
+    # Snapshots and states are saved only after the push so a failed push gets retried next time
+    save_snapshots(conn, board, changed)
+    if departed:
+        set_thread_state(conn, board, archived, "archived")
+        set_thread_state(conn, board, pruned, "dead")
+    return new_posts
 
-    # Schedule another catalog crawl to happen in the future (was gone for some reason??)
-    with Client(faktory_url=FAKTORY_SERVER_URL, role="producer") as client:
-        producer = Producer(client=client)
-        run_at = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
-        run_at = run_at.isoformat()[:-7] + "Z"
-        logger.info(f"run_at = {run_at}")
-        job = Job(
-            jobtype="crawl-catalog",
-            #args=(board, current_catalog_thread_numbers),
-            args=(board, matching_thread_numbers),
-            queue="crawl-catalog",
-            at=str(run_at),
+
+"""
+crawl_thread for the async mode: the same steps on AsyncChanClient and asyncpg
+"""
+async def crawl_thread_async(chan_client, pool, scores, board, thread_number, final=False):
+    async with pool.acquire() as conn:
+        state = await async_storage.get_thread_state(conn, board, thread_number)
+        if state in ("archived", "dead") and not final:
+            logger.info(f"Skipping {state} thread: {board}/{thread_number}")
+            return
+        watermark = await async_storage.latest_chan_post_number(conn, board, thread_number)
+
+    thread_data = None
+    if watermark is not None:
+        tail_data = await chan_client.get_thread_tail(board, thread_number)
+        if tail_data is NOT_MODIFIED:
+            logger.info(f"No new posts in thread: {board}/{thread_number}")
+            return
+        if tail_data and tail_covers_watermark(tail_data, watermark):
+            thread_data = tail_data
+            logger.info(f"Using tail for thread: {board}/{thread_number}")
+    if thread_data is None:
+        thread_data = await chan_client.get_thread(board, thread_number)
+
+    if thread_data is NOT_MODIFIED:
+        logger.info(f"No new posts in thread: {board}/{thread_number}")
+        return
+    if thread_data is NOT_FOUND:
+        logger.info(f"Thread is gone, marking dead: {board}/{thread_number}")
+        async with pool.acquire() as conn:
+            await async_storage.set_thread_state(conn, board, [thread_number], "dead")
+        return
+    if not thread_data:
+        logger.error(f"Failed to retrieve thread data for: {board}/{thread_number}")
+        return
+
+    fetched = posts_after(thread_data, watermark)
+    posts = posts_with_text(fetched)
+    keywords = thread_keywords(thread_data["posts"][0])
+    await asyncio.to_thread(archive_chan_posts, board, thread_number, fetched, keywords)
+    try:
+        async with pool.acquire() as conn:
+            inserted, skipped = await async_storage.insert_chan_posts(conn, board, thread_number, posts, keywords)
+            await async_storage.save_chan_watermark(conn, board, thread_number, thread_data["posts"][-1]["no"])
+            if thread_data["posts"][0].get("archived") and state != "archived":
+                await async_storage.set_thread_state(conn, board, [thread_number], "archived")
+    except Exception:
+        chan_client.forget_thread(board, thread_number)
+        raise
+    logger.info(f"Inserted {inserted} posts, skipped {skipped} existing for thread: {board}/{thread_number}")
+
+    if inserted:
+        scores.notify("chan-posts")
+
+
+"""
+crawl_catalog for the async mode. Changed and departed threads go onto the in-process
+thread queue instead of Faktory; a full queue holds the catalog crawl back.
+"""
+async def crawl_catalog_async(chan_client, pool, threads, board):
+    async with pool.acquire() as conn, async_storage.catalog_lock(conn, board) as locked:
+        if not locked:
+            logger.info(f"Catalog crawl already running for board: {board}")
+            return 0
+
+        current_catalog = await chan_client.get_catalog(board)
+        if current_catalog is NOT_MODIFIED:
+            logger.info(f"Catalog unchanged for board: {board}")
+            return 0
+        if current_catalog is NOT_FOUND or not current_catalog:
+            logger.error(f"Failed to fetch catalog for board: {board}")
+            return None
+
+        matching_threads, live_thread_numbers = catalog_threads(current_catalog)
+        departed = await async_storage.departed_threads(conn, board, live_thread_numbers)
+        archived, pruned = [], []
+        if departed:
+            archived, pruned = classify_departed(departed, await chan_client.get_archive(board))
+            if archived is None:
+                logger.error(f"Failed to fetch archive for board: {board}; {len(departed)} departed threads wait")
+                departed, archived, pruned = [], [], []
+            else:
+                logger.info(f"Threads left the catalog: {len(archived)} archived, {len(pruned)} pruned")
+
+        changed, new_posts = await async_storage.changed_threads(conn, board, matching_threads)
+        logger.info(f"{len(changed)} of {len(matching_threads)} matching threads changed since the last catalog")
+
+        for thread in changed:
+            await threads.put((board, thread["no"]))
+        for thread_number in departed:
+            await threads.put((board, thread_number, True))
+
+        await async_storage.save_snapshots(conn, board, changed)
+        await async_storage.set_thread_state(conn, board, archived, "archived")
+        await async_storage.set_thread_state(conn, board, pruned, "dead")
+    return new_posts
+
+
+"""
+Catalog polling and thread crawling in one process: the scheduler polls each board's
+catalog and ASYNC_WORKERS coroutines crawl threads off a queue of ASYNC_QUEUE_SIZE
+"""
+async def run_async(boards):
+    async with AsyncHttp() as http, async_storage.create_pool() as pool:
+        chan_client = AsyncChanClient(http)
+        scores = ScoreNotifier()
+        threads = job_queue("crawl-thread")
+
+        async def poll(board):
+            try:
+                return await crawl_catalog_async(chan_client, pool, threads, board)
+            except Exception:
+                chan_client.forget_catalog(board)
+                raise
+
+        async def crawl(*args):
+            await crawl_thread_async(chan_client, pool, scores, *args)
+
+        scheduler = Scheduler([
+            Source(name, poll, min_interval, max_interval)
+            for name, min_interval, max_interval in boards
+        ])
+        await asyncio.gather(
+            scheduler.run_async(),
+            run_workers(threads, "crawl-thread", crawl),
+            scores.run(),
         )
-        producer.push(job)
 
 
 if __name__ == "__main__":
@@ -229,28 +443,46 @@ if __name__ == "__main__":
     # Continuous catalog crawling and job enqueuing
     if "produce" in sys.argv:
         logger.info("Starting continuous catalog crawling and job enqueuing...")
+        metrics.start_server()
+        metrics.register_queue_depth(FAKTORY_SERVER_URL, ["crawl-thread", "score-posts"])
+
+        # Boards come from CHAN_BOARDS, e.g. "pol,sci:120:1800" (name:min_interval:max_interval)
+        boards = parse_sources(os.environ.get("CHAN_BOARDS", "pol"))
+        scheduler = Scheduler([
+            Source(name, crawl_catalog, min_interval, max_interval)
+            for name, min_interval, max_interval in boards
+        ])
 
         try:
-            while True:
-                # Fetch the catalog and enqueue jobs
-                crawl_catalog("pol")
-                time.sleep(300)  # Wait for 5 minutes before the next fetch
+            scheduler.run()
         except Exception as e:
             logger.error(f"Error in producer loop: {e}")
         except KeyboardInterrupt:
             logger.info("Producer stopped manually.")
 
+    # Catalogs and threads crawled by coroutines in this process, without Faktory
+    elif "async" in sys.argv:
+        logger.info("Starting async catalog and thread crawling...")
+        metrics.start_server()
+
+        boards = parse_sources(os.environ.get("CHAN_BOARDS", "pol"))
+        try:
+            asyncio.run(run_async(boards))
+        except KeyboardInterrupt:
+            logger.info("Async crawler stopped manually.")
+
     # Continuous Faktory consumer
     elif "consume" in sys.argv:
         logger.info("Starting continuous Faktory consumer...")
+        metrics.start_server()
 
         with Client(faktory_url=FAKTORY_SERVER_URL, role="consumer") as client:
             consumer = Consumer(
                 client=client,
                 queues=["crawl-thread"],
-                concurrency=5  # Adjust concurrency as needed
+                concurrency=CONSUMER_CONCURRENCY  # Adjust with CONSUMER_CONCURRENCY
             )
-            consumer.register("crawl-thread", crawl_thread)
+            consumer.register("crawl-thread", metrics.track_job("crawl-thread", crawl_thread))
 
             try:
                 consumer.run()  # runs continuously
@@ -258,7 +490,7 @@ if __name__ == "__main__":
                 logger.info("Consumer stopped manually.")
 
     else:
-        print("Usage: python chan_crawler.py [produce|consume]")
+        print("Usage: python chan_crawler.py [produce|consume|async]")
 
 
 
@@ -1,8 +1,6 @@
 import logging
-from pyfaktory import Client, Consumer, Job, Producer
-import time
-import random
 import sys
+from chan_crawler import crawl_catalog
 
 logger = logging.getLogger("faktory test")
 logger.propagate = False
@@ -16,10 +14,7 @@ logger.addHandler(sh)
 if __name__ == "__main__":
     board = sys.argv[1]
     print(f"Cold starting catalog crawl for board {board}")
-    # Default url for a Faktory server running locally
-    faktory_server_url = "tcp://:password@localhost:7419"
-
-    with Client(faktory_url=faktory_server_url, role="producer") as client:
-        producer = Producer(client=client)
-        job = Job(jobtype="crawl-catalog", args=(board,), queue="crawl-catalog")
-        producer.push(job)
+    # Runs one catalog crawl right away instead of queueing a crawl-catalog job, so it can't
+    # stack up behind the producer's own schedule. Add the board to CHAN_BOARDS to keep polling it.
+    new_posts = crawl_catalog(board)
+    print(f"Found {new_posts} new posts in matching threads")
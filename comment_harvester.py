@@ -0,0 +1,139 @@
+# Walks a reddit post's whole comment tree, expanding "more" stubs, into flat comment records
+
+import logging
+
+from http_session import NOT_MODIFIED
+from reddit_client import Fetch, run_walk, run_walk_async
+
+# logger setup
+logger = logging.getLogger("comment harvester")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# /api/morechildren accepts at most 100 ids per call
+MORE_CHILDREN_BATCH = 100
+
+
+class Incomplete:
+    """
+    Yielded last by a harvest when some part of the tree could not be fetched
+    """
+    def __repr__(self):
+        return "INCOMPLETE"
+
+
+INCOMPLETE = Incomplete()
+
+
+"""
+Flat record for one comment, ready for bulk insertion
+"""
+def comment_record(data, depth):
+    record = dict(data)
+    record.pop("replies", None)
+    record["depth"] = depth
+    return record
+
+
+"""
+Yield every comment of a post as a flat record with parent_id and depth.
+The tree is walked with an explicit stack (no recursion limit), ids from "more" stubs
+are expanded through /api/morechildren in batches of 100, and "continue this thread"
+stubs are expanded by fetching the parent comment's subtree.
+Yields only NOT_MODIFIED if the comment listing is unchanged since the last fetch, and
+INCOMPLETE after the comments it did get if any fetch failed.
+"""
+def harvest_comments(reddit_client, subreddit, post_id):
+    return run_walk(reddit_client, walk_comments(subreddit, post_id))
+
+
+"""
+harvest_comments for AsyncRedditClient, as an async generator
+"""
+def harvest_comments_async(reddit_client, subreddit, post_id):
+    return run_walk_async(reddit_client, walk_comments(subreddit, post_id))
+
+
+"""
+The walk behind both harvesters, run by reddit_client.run_walk: yields Fetch requests
+and comment records
+"""
+def walk_comments(subreddit, post_id):
+    children = yield Fetch("get_post_comments", subreddit, post_id)
+    if children is NOT_MODIFIED:
+        yield NOT_MODIFIED
+        return
+    if children is None:
+        yield INCOMPLETE
+        return
+
+    stack = list(reversed(children))
+    pending_more = []
+    # Depth of every comment yielded so far; parents are always yielded before their replies,
+    # and computing depth from the parent works the same for nested, expanded and subtree comments
+    depths = {}
+    queued_more = set()
+    expanded_threads = set()
+    complete = True
+
+    while stack or pending_more:
+        if not stack:
+            batch, pending_more = pending_more[:MORE_CHILDREN_BATCH], pending_more[MORE_CHILDREN_BATCH:]
+            things = yield Fetch("get_more_children", post_id, batch)
+            if things is None:
+                # Keep walking so the rest of the tree is still collected
+                complete = False
+                continue
+            logger.debug(f"Expanded {len(batch)} more ids into {len(things)} things for post {post_id}")
+            stack = list(reversed(things))
+            continue
+
+        thing = stack.pop()
+        data = thing.get("data", {})
+
+        if thing.get("kind") == "more":
+            if data.get("children"):
+                # Never queue an id twice, so a stub that keeps coming back can't loop forever
+                new_ids = [child for child in data["children"] if child not in depths and child not in queued_more]
+                queued_more.update(new_ids)
+                pending_more.extend(new_ids)
+            elif data.get("parent_id", "").startswith("t1_"):
+                # "continue this thread": the replies hang off the parent comment's own page
+                parent = data["parent_id"][3:]
+                if parent in expanded_threads:
+                    continue
+                expanded_threads.add(parent)
+                subtree = yield Fetch("get_post_comments", subreddit, post_id, comment=parent)
+                if subtree is NOT_MODIFIED:
+                    continue
+                if subtree is None:
+                    complete = False
+                    continue
+                for root in subtree:
+                    replies = root.get("data", {}).get("replies") or {}
+                    stack.extend(reversed(replies.get("data", {}).get("children", [])))
+            continue
+
+        if thing.get("kind") != "t1" or data.get("id") in depths:
+            continue
+
+        parent_id = data.get("parent_id", "")
+        if parent_id.startswith("t1_") and parent_id[3:] in depths:
+            depth = depths[parent_id[3:]] + 1
+        elif parent_id.startswith("t3_"):
+            depth = 0
+        else:
+            depth = data.get("depth", 0)
+        depths[data["id"]] = depth
+        yield comment_record(data, depth)
+
+        replies = data.get("replies") or {}
+        stack.extend(reversed(replies.get("data", {}).get("children", [])))
+
+    if not complete:
+        logger.warning(f"Comment tree of post {post_id} was only partly fetched")
+        yield INCOMPLETE
@@ -0,0 +1,223 @@
+# Process-wide Postgres connection pool shared by the crawler consumers
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+import metrics
+
+# logger setup
+logger = logging.getLogger("db pool")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+CONSUMER_CONCURRENCY = int(os.environ.get("CONSUMER_CONCURRENCY", 5))
+# pyfaktory runs each job in a pool process that handles one job at a time, and a job holds at
+# most one connection at a time, so every process needs one. Raise it for callers that run jobs
+# in threads of one process (benchmark.py sizes its pools itself).
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 1))
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", 300))
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", 3600))
+DB_POOL_HEALTH_CHECK_AFTER = float(os.environ.get("DB_POOL_HEALTH_CHECK_AFTER", 30))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get("DB_POOL_CHECKOUT_TIMEOUT", 30))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """
+    Blocking, thread-safe pool. Checkouts wait up to `checkout_timeout` seconds for a
+    free slot. Connections idle longer than `health_check_after` are pinged before use,
+    and connections past `max_idle` or `max_lifetime` are closed instead of reused.
+    """
+    def __init__(self, dsn, size=DB_POOL_SIZE, max_idle=DB_POOL_MAX_IDLE,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, health_check_after=DB_POOL_HEALTH_CHECK_AFTER,
+                 checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT, connection_factory=None):
+        self.dsn = dsn
+        self.connection_factory = connection_factory
+        self.size = size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.checkout_timeout = checkout_timeout
+
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.created = 0
+        self.closed = 0
+        self.failed_health_checks = 0
+
+    """
+    Borrow a connection for the duration of a with-block. Uncommitted work is rolled
+    back when the connection is returned.
+    """
+    @contextmanager
+    def connection(self):
+        started = time.monotonic()
+        if not self.slots.acquire(timeout=self.checkout_timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"No database connection available after {self.checkout_timeout}s")
+
+        pooled = None
+        try:
+            pooled = self._checkout()
+            waited = time.monotonic() - started
+            with self.lock:
+                self.checkouts += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            yield pooled.conn
+        finally:
+            if pooled is not None:
+                self._checkin(pooled)
+            self.slots.release()
+
+    def _checkout(self):
+        while True:
+            with self.lock:
+                pooled = self.idle.pop() if self.idle else None
+            if pooled is None:
+                return self._connect()
+
+            now = time.monotonic()
+            if pooled.conn.closed or now - pooled.created_at > self.max_lifetime or now - pooled.last_used > self.max_idle:
+                self._close(pooled)
+                continue
+            if now - pooled.last_used > self.health_check_after and not self._is_healthy(pooled):
+                with self.lock:
+                    self.failed_health_checks += 1
+                self._close(pooled)
+                continue
+            return pooled
+
+    def _checkin(self, pooled):
+        conn = pooled.conn
+        try:
+            if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+
+        if conn.closed:
+            self._close(pooled)
+            return
+
+        pooled.last_used = time.monotonic()
+        with self.lock:
+            # Most recently used goes on top so rarely needed connections age out
+            self.idle.append(pooled)
+        self.recycle_idle()
+
+    def _connect(self):
+        conn = psycopg2.connect(dsn=self.dsn, connection_factory=self.connection_factory)
+        with self.lock:
+            self.created += 1
+        return PooledConnection(conn)
+
+    def _is_healthy(self, pooled):
+        try:
+            with pooled.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            pooled.conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.info(f"Dropping unhealthy database connection: {e}")
+            return False
+
+    def _close(self, pooled):
+        try:
+            pooled.conn.close()
+        except psycopg2.Error:
+            pass
+        with self.lock:
+            self.closed += 1
+
+    """
+    Close idle connections that have sat unused longer than max_idle
+    """
+    def recycle_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [pooled for pooled in self.idle if now - pooled.last_used > self.max_idle]
+            self.idle = [pooled for pooled in self.idle if now - pooled.last_used <= self.max_idle]
+        for pooled in expired:
+            self._close(pooled)
+
+    """
+    Checkout wait time and connection churn counters
+    """
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait": self.max_wait,
+                "created": self.created,
+                "closed": self.closed,
+                "failed_health_checks": self.failed_health_checks,
+            }
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for pooled in idle:
+            self._close(pooled)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+"""
+Process-wide pool for a DSN (DATABASE_URL by default), created on first use.
+Keyword arguments only apply when the pool is created.
+"""
+def get_pool(dsn=None, **kwargs):
+    dsn = dsn or os.environ.get("DATABASE_URL")
+    with _pools_lock:
+        if dsn not in _pools:
+            _pools[dsn] = ConnectionPool(dsn, **kwargs)
+            metrics.register_collector(lambda pool=_pools[dsn]: pool_metrics(pool))
+        return _pools[dsn]
+
+
+"""
+Copy a pool's stats into gauges, labelled by database name so the password never leaves the DSN
+"""
+def pool_metrics(pool):
+    database = urlsplit(pool.dsn).path.lstrip("/") or "default"
+    stats = pool.stats()
+    for name in ("size", "idle", "checkouts", "timeouts", "avg_wait", "max_wait"):
+        metrics.set_gauge(f"db_pool_{name}", stats[name], database=database)
@@ -0,0 +1,130 @@
+# Shared keep-alive HTTP sessions and conditional GET support for the API clients
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from rate_limit import governed_request
+
+# logger setup
+logger = logging.getLogger("http session")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 4))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 10))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+HTTP_VALIDATOR_CACHE_SIZE = int(os.environ.get("HTTP_VALIDATOR_CACHE_SIZE", 10_000))
+
+
+class NotModified:
+    """
+    Returned by the clients instead of json when the server answered 304
+    """
+    def __repr__(self):
+        return "NOT_MODIFIED"
+
+
+NOT_MODIFIED = NotModified()
+
+
+class NotFound:
+    """
+    Returned by the clients instead of json when the server answered 404
+    """
+    def __repr__(self):
+        return "NOT_FOUND"
+
+
+NOT_FOUND = NotFound()
+
+
+"""
+Build a requests session whose connection pools are kept alive between jobs.
+pool_connections is the number of hosts to keep pools for, pool_maxsize the
+connections per host (should be at least the consumer concurrency).
+"""
+def build_session(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ValidatorCache:
+    """
+    Last-Modified / ETag seen per URL, bounded LRU so long-gone threads drop out
+    """
+    def __init__(self, max_size=HTTP_VALIDATOR_CACHE_SIZE):
+        self.max_size = max_size
+        self.validators = OrderedDict()
+        self.lock = threading.Lock()
+
+    """
+    Conditional request headers for a URL we've fetched before
+    """
+    def headers_for(self, url):
+        with self.lock:
+            etag, last_modified = self.validators.get(url, (None, None))
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def remember(self, url, response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        with self.lock:
+            self.validators[url] = (etag, last_modified)
+            self.validators.move_to_end(url)
+            while len(self.validators) > self.max_size:
+                self.validators.popitem(last=False)
+
+    """
+    Drop what we know about a URL so the next request fetches it in full
+    """
+    def forget(self, url):
+        with self.lock:
+            self.validators.pop(url, None)
+
+    """
+    forget every URL starting with a prefix (or any of a tuple of prefixes)
+    """
+    def forget_prefix(self, prefix):
+        with self.lock:
+            for url in [url for url in self.validators if url.startswith(prefix)]:
+                del self.validators[url]
+
+
+"""
+GET a URL, sending If-None-Match / If-Modified-Since when we have validators for it.
+Validators are recorded from every 200 response; the caller checks for 304, and
+forgets the URL if it could not store what came back, or the next fetch would be a
+304 and the data would never be collected.
+Requests are paced and retried per host by rate_limit.governed_request.
+"""
+def conditional_get(session, validators, url, headers=None, **kwargs):
+    request_headers = dict(headers or {})
+    request_headers.update(validators.headers_for(url))
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+
+    response = governed_request(session, "GET", url, headers=request_headers, **kwargs)
+    if response.status_code == 200:
+        validators.remember(url, response)
+    return response
@@ -0,0 +1,98 @@
+# Compiled keyword matching for catalog threads and reddit posts
+
+import os
+import re
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+KEYWORDS = [
+    keyword.strip()
+    for keyword in os.environ.get("KEYWORDS", "climate change,global warming,climate crisis").split(",")
+    if keyword.strip()
+]
+# Only match whole words ("ice" won't hit "police")
+KEYWORD_WORD_BOUNDARY = os.environ.get("KEYWORD_WORD_BOUNDARY", "false").lower() in ("1", "true", "yes")
+# Unicode case-insensitive matching (str.casefold, so "STRASSE" hits "straße")
+KEYWORD_CASEFOLD = os.environ.get("KEYWORD_CASEFOLD", "true").lower() in ("1", "true", "yes")
+
+
+"""
+Regex for a character trie of keywords, so matching costs about the same for
+three keywords as for three hundred: shared prefixes are only tried once
+"""
+def trie_pattern(node):
+    alternatives = [re.escape(char) + trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not alternatives:
+        return ""
+    optional = "" in node
+    if len(alternatives) == 1 and not optional:
+        return alternatives[0]
+    # Greedy, so the longest keyword is tried first and shorter ones on backtracking
+    return "(?:" + "|".join(alternatives) + ")" + ("?" if optional else "")
+
+
+class KeywordMatcher:
+    """
+    Compiles a keyword list once into a single regex. matches() returns every keyword
+    that occurs in any of the given texts, search() only whether one does.
+    """
+    def __init__(self, keywords, word_boundary=KEYWORD_WORD_BOUNDARY, casefold=KEYWORD_CASEFOLD):
+        self.keywords = list(keywords)
+        self.word_boundary = word_boundary
+        self.casefold = casefold
+        # casefolded (or as-is) spelling of every keyword
+        self.forms = set()
+        trie = {}
+        for keyword in self.keywords:
+            form = self.normalize(keyword)
+            self.forms.add(form)
+            node = trie
+            for char in form:
+                node = node.setdefault(char, {})
+            node[""] = {}
+
+        body = trie_pattern(trie) if trie else "(?!)"
+        if word_boundary:
+            # Lookarounds instead of \b so keywords that start or end with punctuation still work
+            body = rf"(?<!\w)(?:{body})(?!\w)"
+        self.pattern = re.compile(body)
+        # The lookahead matches at every position, so keywords that overlap are all reported
+        self.all_pattern = re.compile(rf"(?=({body}))")
+
+    def normalize(self, text):
+        return text.casefold() if self.casefold else text
+
+    def join(self, texts):
+        return self.normalize("\n".join(text for text in texts if text))
+
+    def search(self, *texts):
+        return self.pattern.search(self.join(texts)) is not None
+
+    def matches(self, *texts):
+        text = self.join(texts)
+        found = set()
+        for match in self.all_pattern.finditer(text):
+            # Only the longest keyword at a position is captured; shorter ones are its prefixes
+            start, matched = match.start(1), match.group(1)
+            for end in range(1, len(matched) + 1):
+                if matched[:end] in self.forms and self.ends_word(text, start + end):
+                    found.add(matched[:end])
+        return [keyword for keyword in self.keywords if self.normalize(keyword) in found]
+
+    def ends_word(self, text, end):
+        return not self.word_boundary or end == len(text) or not re.match(r"\w", text[end])
+
+
+_matcher = None
+
+
+"""
+Process-wide matcher for the KEYWORDS environment list
+"""
+def get_matcher():
+    global _matcher
+    if _matcher is None:
+        _matcher = KeywordMatcher(KEYWORDS)
+    return _matcher
@@ -0,0 +1,388 @@
+# Counters, gauges and latency histograms per crawl stage, served in Prometheus text format
+
+import atexit
+import inspect
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+# logger setup
+logger = logging.getLogger("metrics")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+# Metrics are only recorded when a port is set; otherwise every call returns right away
+METRICS_PORT = int(os.environ.get("METRICS_PORT") or 0)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+ENABLED = METRICS_PORT > 0
+
+PREFIX = "crawler_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+# name -> {sorted label items -> value}
+_counters = {}
+_gauges = {}
+# name -> {sorted label items -> [bucket counts..., sum, count]}
+_histograms = {}
+# called on every scrape to refresh gauges that are cheaper to read than to track
+_collectors = []
+_server = None
+# Set by start_server; processes forked from the serving one spool their metrics to _spool_dir
+_server_pid = None
+_spool_dir = None
+
+
+# A forked process starts from empty metrics, or the parent's values would be counted twice
+def _reset_after_fork():
+    global _lock, _server
+    _lock = threading.Lock()
+    _counters.clear()
+    _gauges.clear()
+    _histograms.clear()
+    _collectors.clear()
+    _server = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def inc(name, amount=1, **labels):
+    if not ENABLED:
+        return
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    if not ENABLED:
+        return
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        _gauges.setdefault(name, {})[key] = value
+
+
+def add_gauge(name, amount, **labels):
+    if not ENABLED:
+        return
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _gauges.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    if not ENABLED:
+        return
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        values = series.get(key)
+        if values is None:
+            values = series[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                values[index] += 1
+                break
+        values[-2] += seconds
+        values[-1] += 1
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+@contextmanager
+def _timer(name, labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+"""
+Time a with-block into a histogram. A shared no-op context manager when metrics are off.
+"""
+def timer(name, **labels):
+    if not ENABLED:
+        return _NO_TIMER
+    return _timer(name, labels)
+
+
+"""
+Wrap a Faktory job function (or an async crawl coroutine function) to track in-flight
+jobs, job latency and failures. Returns the function itself when metrics are off.
+"""
+def track_job(jobtype, function):
+    if not ENABLED:
+        return function
+
+    if inspect.iscoroutinefunction(function):
+        async def tracked_async(*args, **kwargs):
+            add_gauge("jobs_in_flight", 1, jobtype=jobtype)
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                inc("jobs_failed_total", jobtype=jobtype)
+                raise
+            finally:
+                observe("job_seconds", time.perf_counter() - started, jobtype=jobtype)
+                add_gauge("jobs_in_flight", -1, jobtype=jobtype)
+
+        return tracked_async
+
+    return TrackedJob(jobtype, function)
+
+
+class TrackedJob:
+    """
+    A class rather than a closure because pyfaktory runs jobs in a pebble process pool,
+    which pickles the function it is given. The job runs in a pool process, so its
+    metrics are spooled to disk for the serving process when it starts (or the job
+    would never show as in flight) and again when it ends.
+    """
+    def __init__(self, jobtype, function):
+        self.jobtype = jobtype
+        self.function = function
+        self.__name__ = getattr(function, "__name__", jobtype)
+
+    def __call__(self, *args, **kwargs):
+        add_gauge("jobs_in_flight", 1, jobtype=self.jobtype)
+        spool()
+        started = time.perf_counter()
+        try:
+            return self.function(*args, **kwargs)
+        except Exception:
+            inc("jobs_failed_total", jobtype=self.jobtype)
+            raise
+        finally:
+            observe("job_seconds", time.perf_counter() - started, jobtype=self.jobtype)
+            add_gauge("jobs_in_flight", -1, jobtype=self.jobtype)
+            spool()
+
+
+"""
+Register a function called before every scrape, e.g. to copy pool or cache stats into gauges
+"""
+def register_collector(collector):
+    if ENABLED:
+        _collectors.append(collector)
+
+
+"""
+Report the Faktory queue sizes as gauges on every scrape
+"""
+def register_queue_depth(faktory_url, queues):
+    if not ENABLED:
+        return
+
+    def collect():
+        from pyfaktory import Client
+
+        with Client(faktory_url=faktory_url, role="producer") as client:
+            sizes = client.info().get("faktory", {}).get("queues", {})
+        for queue in queues:
+            set_gauge("queue_depth", sizes.get(queue, 0), queue=queue)
+
+    register_collector(collect)
+
+
+def _snapshot():
+    with _lock:
+        return {
+            "counters": [[name, list(key), value] for name, series in _counters.items() for key, value in series.items()],
+            "gauges": [[name, list(key), value] for name, series in _gauges.items() for key, value in series.items()],
+            "histograms": [[name, list(key), values] for name, series in _histograms.items() for key, values in series.items()],
+        }
+
+
+"""
+Write this process's metrics where the serving process (the one that called start_server,
+which this process was forked from) picks them up. Does nothing in the serving process.
+"""
+def spool():
+    if not ENABLED or _spool_dir is None or os.getpid() == _server_pid:
+        return
+    for collector in list(_collectors):
+        try:
+            collector()
+        except Exception as e:
+            logger.debug(f"Metrics collector failed: {e}")
+
+    path = os.path.join(_spool_dir, f"{os.getpid()}.json")
+    try:
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(_snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.debug(f"Could not spool metrics: {e}")
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add_snapshot(counters, gauges, histograms, snapshot):
+    for merged, kind in ((counters, "counters"), (gauges, "gauges")):
+        if merged is None:
+            continue
+        for name, key, value in snapshot[kind]:
+            series = merged.setdefault(name, {})
+            key = tuple(tuple(item) for item in key)
+            series[key] = series.get(key, 0) + value
+    for name, key, values in snapshot["histograms"]:
+        series = histograms.setdefault(name, {})
+        key = tuple(tuple(item) for item in key)
+        if key in series:
+            series[key] = [mine + theirs for mine, theirs in zip(series[key], values)]
+        else:
+            series[key] = list(values)
+
+
+"""
+Counters and histograms from spooled processes add up; so do their gauges (in-flight jobs,
+pool sizes). The spool of a process that has exited is folded into this process's own
+counters and histograms, so totals never go backwards, and its gauges are dropped.
+Called with _lock held.
+"""
+def _merged():
+    if _spool_dir is not None:
+        for filename in os.listdir(_spool_dir):
+            if not filename.endswith(".json") or _is_running(int(filename[:-len(".json")])):
+                continue
+            path = os.path.join(_spool_dir, filename)
+            try:
+                with open(path) as f:
+                    _add_snapshot(_counters, None, _histograms, json.load(f))
+            except (OSError, ValueError):
+                pass
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    counters = {name: dict(series) for name, series in _counters.items()}
+    gauges = {name: dict(series) for name, series in _gauges.items()}
+    histograms = {name: {key: list(values) for key, values in series.items()} for name, series in _histograms.items()}
+    if _spool_dir is None:
+        return counters, gauges, histograms
+
+    for filename in os.listdir(_spool_dir):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(_spool_dir, filename)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        _add_snapshot(counters, gauges, histograms, snapshot)
+    return counters, gauges, histograms
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+
+def render():
+    for collector in list(_collectors):
+        try:
+            collector()
+        except Exception as e:
+            logger.debug(f"Metrics collector failed: {e}")
+
+    lines = []
+    with _lock:
+        counters, gauges, histograms = _merged()
+    for kind, metrics in (("counter", counters), ("gauge", gauges)):
+        for name, series in sorted(metrics.items()):
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for key, value in series.items():
+                lines.append(f"{PREFIX}{name}{_labels(key)} {value}")
+    for name, series in sorted(histograms.items()):
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for key, values in series.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, values):
+                cumulative += count
+                lines.append(f"{PREFIX}{name}_bucket{_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{PREFIX}{name}_bucket{_labels(key, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(key)} {values[-2]}")
+            lines.append(f"{PREFIX}{name}_count{_labels(key)} {values[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+Serve /metrics on METRICS_PORT (plus offset, for several processes on one host) from a
+daemon thread. Called by the produce/consume entry points; does nothing when metrics are off.
+"""
+def start_server(port_offset=0):
+    global _server, _server_pid, _spool_dir
+    if not ENABLED or _server is not None:
+        return
+    port = METRICS_PORT + port_offset
+    try:
+        _server = ThreadingHTTPServer((METRICS_HOST, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Could not serve metrics on {METRICS_HOST}:{port}: {e}")
+        return
+    _server_pid = os.getpid()
+    _spool_dir = tempfile.mkdtemp(prefix="crawler-metrics-")
+    atexit.register(shutil.rmtree, _spool_dir, True)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
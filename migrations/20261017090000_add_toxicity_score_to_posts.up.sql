@@ -0,0 +1,2 @@
+-- Add up migration script here
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS toxicity_score TEXT;
@@ -0,0 +1,11 @@
+-- Add up migration script here
+-- last seen catalog state of every thread we enqueued, used to skip unchanged threads
+CREATE TABLE catalog_threads (
+   board TEXT NOT NULL,
+   thread_number BIGINT NOT NULL,
+   replies INTEGER NOT NULL DEFAULT 0,
+   last_modified BIGINT, -- unix time from the catalog json
+   bumped_at BIGINT, -- unix time of the newest reply shown in the catalog
+   updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+   PRIMARY KEY (board, thread_number)
+);
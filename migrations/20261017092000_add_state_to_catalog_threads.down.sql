@@ -0,0 +1,3 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS catalog_threads_board_state_idx;
+ALTER TABLE catalog_threads DROP COLUMN IF EXISTS state;
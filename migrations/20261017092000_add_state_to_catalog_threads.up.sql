@@ -0,0 +1,4 @@
+-- Add up migration script here
+-- active threads are in the catalog, archived/dead ones got their final crawl and are never polled again
+ALTER TABLE catalog_threads ADD COLUMN state TEXT NOT NULL DEFAULT 'active';
+CREATE INDEX ON catalog_threads (board, state);
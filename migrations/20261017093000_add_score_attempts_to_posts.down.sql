@@ -0,0 +1,3 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS posts_pending_score_idx;
+ALTER TABLE posts DROP COLUMN IF EXISTS score_attempts;
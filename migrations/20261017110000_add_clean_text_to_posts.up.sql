@@ -0,0 +1,3 @@
+-- Add up migration script here
+-- plain text of data->>'com' (markup, quote links and entities stripped), this is what gets scored
+ALTER TABLE posts ADD COLUMN clean_text TEXT;
@@ -0,0 +1,6 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS posts_board_thread_post_posted_at_idx;
+CREATE UNIQUE INDEX posts_board_thread_number_post_number_idx1 ON posts (board, thread_number, post_number);
+ALTER TABLE posts DROP CONSTRAINT posts_pkey;
+ALTER TABLE posts ADD PRIMARY KEY (id);
+ALTER TABLE posts DROP COLUMN IF EXISTS posted_at;
@@ -0,0 +1,12 @@
+-- Add up migration script here
+-- typed post time, so time-range queries don't have to parse data->>'time'
+ALTER TABLE posts ADD COLUMN posted_at TIMESTAMPTZ;
+UPDATE posts SET posted_at = to_timestamp((data->>'time')::bigint);
+ALTER TABLE posts ALTER COLUMN posted_at SET NOT NULL;
+
+-- a hypertable's unique indexes must include the time column; a post's time never
+-- changes, so (board, thread_number, post_number, posted_at) is still one row per post
+ALTER TABLE posts DROP CONSTRAINT posts_pkey;
+ALTER TABLE posts ADD PRIMARY KEY (id, posted_at);
+DROP INDEX IF EXISTS posts_board_thread_number_post_number_idx1;
+CREATE UNIQUE INDEX posts_board_thread_post_posted_at_idx ON posts (board, thread_number, post_number, posted_at);
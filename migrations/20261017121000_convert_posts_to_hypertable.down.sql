@@ -0,0 +1,27 @@
+-- Add down migration script here
+-- a hypertable can't be turned back in place, so copy the rows into a plain table
+DO $$
+BEGIN
+   IF NOT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'timescaledb') THEN
+      RETURN;
+   END IF;
+   IF EXISTS (SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = 'posts') THEN
+      PERFORM remove_retention_policy('posts', if_exists => true);
+      PERFORM remove_compression_policy('posts', if_exists => true);
+
+      ALTER SEQUENCE posts_id_seq OWNED BY NONE;
+      CREATE TABLE posts_plain (LIKE posts INCLUDING DEFAULTS);
+      INSERT INTO posts_plain SELECT * FROM posts;
+      DROP TABLE posts;
+      ALTER TABLE posts_plain RENAME TO posts;
+      ALTER SEQUENCE posts_id_seq OWNED BY posts.id;
+
+      ALTER TABLE posts ADD PRIMARY KEY (id, posted_at);
+      CREATE INDEX ON posts (post_number);
+      CREATE INDEX ON posts (thread_number, post_number);
+      CREATE UNIQUE INDEX posts_board_thread_post_posted_at_idx ON posts (board, thread_number, post_number, posted_at);
+      CREATE INDEX posts_pending_score_idx ON posts (id) WHERE toxicity_score IS NULL;
+      CREATE INDEX posts_keywords_idx ON posts USING GIN (keywords);
+   END IF;
+END
+$$;
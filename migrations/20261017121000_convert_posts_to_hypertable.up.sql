@@ -0,0 +1,21 @@
+-- Add up migration script here
+-- partition posts by posted_at, compress chunks once they stop changing and drop the oldest ones.
+-- skipped on a plain Postgres without the timescaledb extension
+DO $$
+BEGIN
+   IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb') THEN
+      CREATE EXTENSION IF NOT EXISTS timescaledb;
+      PERFORM create_hypertable('posts', 'posted_at', chunk_time_interval => INTERVAL '7 days', migrate_data => true);
+      EXECUTE $sql$
+         ALTER TABLE posts SET (
+            timescaledb.compress,
+            timescaledb.compress_segmentby = 'board',
+            timescaledb.compress_orderby = 'posted_at DESC, thread_number, post_number'
+         )
+      $sql$;
+      -- threads on the busiest boards are archived within days, and scoring is done well before this
+      PERFORM add_compression_policy('posts', INTERVAL '30 days');
+      PERFORM add_retention_policy('posts', INTERVAL '730 days');
+   END IF;
+END
+$$;
@@ -0,0 +1,10 @@
+-- Add down migration script here
+DROP FUNCTION IF EXISTS refresh_toxicity_hourly(TIMESTAMPTZ, TIMESTAMPTZ);
+DO $$
+BEGIN
+   IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'toxicity_hourly' AND relkind = 'v') THEN
+      DROP MATERIALIZED VIEW toxicity_hourly;
+   END IF;
+END
+$$;
+DROP TABLE IF EXISTS toxicity_hourly;
@@ -0,0 +1,2 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS posts_search_idx;
@@ -0,0 +1,6 @@
+-- Add up migration script here
+-- full-text search over post text (search.py must use this exact expression to hit the index).
+-- an expression index rather than a generated column, because compressed hypertables
+-- can't take new computed columns
+CREATE INDEX posts_search_idx ON posts
+   USING GIN (to_tsvector('english', coalesce(clean_text, data->>'com', '')));
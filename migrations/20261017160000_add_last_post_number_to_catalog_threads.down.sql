@@ -0,0 +1,2 @@
+-- Add down migration script here
+ALTER TABLE catalog_threads DROP COLUMN IF EXISTS last_post_number;
@@ -0,0 +1,6 @@
+-- Add up migration script here
+-- highest post number crawled per thread, so the crawler's watermark lookup doesn't scan every posts chunk
+ALTER TABLE catalog_threads ADD COLUMN last_post_number BIGINT;
+UPDATE catalog_threads c SET last_post_number = p.last_post_number
+FROM (SELECT board, thread_number, max(post_number) AS last_post_number FROM posts GROUP BY board, thread_number) p
+WHERE c.board = p.board AND c.thread_number = p.thread_number;
@@ -0,0 +1,2 @@
+-- Add down migration script here
+ALTER TABLE posts DROP COLUMN IF EXISTS rescore;
@@ -0,0 +1,4 @@
+-- Add up migration script here
+-- set by score_worker.py backfill; only its cache-bypassing jobs claim these rows, so ordinary
+-- score-posts jobs can't fill them back in from the cache
+ALTER TABLE posts ADD COLUMN rescore BOOLEAN NOT NULL DEFAULT false;
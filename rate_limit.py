@@ -0,0 +1,222 @@
+# Per-host request pacing from rate-limit headers, with Retry-After and backoff on transient failures
+
+import fcntl
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from dotenv import load_dotenv
+
+import metrics
+
+# logger setup
+logger = logging.getLogger("rate limit")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+# 4chan asks for no more than one request per second
+CHAN_MIN_INTERVAL = float(os.environ.get("CHAN_MIN_INTERVAL", 1.0))
+RATE_MAX_RETRIES = int(os.environ.get("RATE_MAX_RETRIES", 4))
+RATE_BACKOFF_BASE = float(os.environ.get("RATE_BACKOFF_BASE", 1.0))
+RATE_BACKOFF_MAX = float(os.environ.get("RATE_BACKOFF_MAX", 60.0))
+# Pacing state shared by every crawler process on the machine (pool processes, supervisor workers)
+RATE_STATE_DIR = os.environ.get("RATE_STATE_DIR") or os.path.join(tempfile.gettempdir(), "crawler-rate-limits")
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# host -> minimum seconds between requests, regardless of what the headers say
+HOST_MIN_INTERVALS = {
+    "a.4cdn.org": CHAN_MIN_INTERVAL,
+}
+
+
+class SharedState:
+    """
+    A small JSON file that every process on the machine reads and rewrites under an
+    exclusive flock. pyfaktory runs jobs in a process pool and the supervisor runs
+    several of those, so a budget kept in process memory would be spent once per process.
+    flock locks belong to the open file, so threads of one process exclude each other too.
+    """
+    def __init__(self, name, directory=RATE_STATE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, re.sub(r"[^\w.-]", "_", name) + ".json")
+
+    """
+    Lock the state for a with-block and yield it as a dict; changes are written back on exit
+    """
+    @contextmanager
+    def update(self):
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RateGovernor:
+    """
+    Paces requests to one host for every process on the machine. Each request reserves
+    the next free slot in the host's SharedState and sleeps outside the lock. When the
+    host reports its remaining budget (X-Ratelimit-Remaining / X-Ratelimit-Reset, as
+    reddit does) the slots are spread evenly over what is left of the window. Times are
+    wall clock, the only clock processes agree on.
+    """
+    def __init__(self, host, min_interval=0.0, state_dir=RATE_STATE_DIR):
+        self.host = host
+        self.min_interval = min_interval
+        self.state = SharedState(f"host-{host}", state_dir)
+
+    """
+    Reserve the next request slot, returning how long the caller has to wait for it
+    """
+    def reserve(self):
+        with self.state.update() as state:
+            now = time.time()
+            start = max(now, state.get("next_allowed", 0.0))
+            interval = self.min_interval
+            remaining, reset_at = state.get("remaining"), state.get("reset_at")
+
+            if remaining is not None and reset_at is not None and reset_at > start:
+                if remaining < 1:
+                    # Budget spent, nothing more until the window resets
+                    start = reset_at
+                    state["remaining"], state["reset_at"] = None, None
+                else:
+                    interval = max(interval, (reset_at - start) / remaining)
+                    state["remaining"] = remaining - 1
+
+            state["next_allowed"] = start + interval
+            return start - now
+
+    def wait(self):
+        wait = self.reserve()
+        if wait > 0:
+            metrics.observe("http_throttle_seconds", wait, host=self.host)
+            time.sleep(wait)
+
+    """
+    Fold a response's rate-limit headers into the budget. Returns the Retry-After delay, if any.
+    """
+    def update(self, response):
+        remaining = response.headers.get("X-Ratelimit-Remaining")
+        reset = response.headers.get("X-Ratelimit-Reset")
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if (remaining is None or reset is None) and retry_after is None:
+            return None
+
+        with self.state.update() as state:
+            now = time.time()
+            if remaining is not None and reset is not None:
+                try:
+                    remaining, reset_at = float(remaining), now + float(reset)
+                except ValueError:
+                    remaining = None
+                if remaining is not None:
+                    # Responses to requests from other processes arrive out of order; within one
+                    # window the lowest count reported (or already reserved against) is the right one
+                    if state.get("remaining") is not None and abs(state.get("reset_at", 0) - reset_at) < 1:
+                        remaining = min(remaining, state["remaining"])
+                    state["remaining"], state["reset_at"] = remaining, reset_at
+            if retry_after is not None:
+                state["next_allowed"] = max(state.get("next_allowed", 0.0), now + retry_after)
+        return retry_after
+
+
+"""
+Retry-After is either a number of seconds or an HTTP date
+"""
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+"""
+Exponential backoff with full jitter for the given retry attempt (0-based)
+"""
+def backoff(attempt):
+    return random.uniform(0, min(RATE_BACKOFF_MAX, RATE_BACKOFF_BASE * 2 ** attempt))
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+"""
+The governor for a URL's host; every process's governor for a host shares its state
+"""
+def get_governor(url):
+    host = urlsplit(url).netloc
+    with _governors_lock:
+        if host not in _governors:
+            _governors[host] = RateGovernor(host, HOST_MIN_INTERVALS.get(host, 0.0))
+        return _governors[host]
+
+
+"""
+Send a request through the host's governor. 429 and 5xx responses and connection
+errors are retried up to RATE_MAX_RETRIES times, waiting for Retry-After when the
+server sends one and backing off exponentially otherwise. The last response is
+returned, or the last connection error re-raised, once retries run out.
+"""
+def governed_request(session, method, url, max_retries=RATE_MAX_RETRIES, **kwargs):
+    governor = get_governor(url)
+
+    for attempt in range(max_retries + 1):
+        governor.wait()
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.inc("http_requests_total", host=governor.host, status="error")
+            if attempt == max_retries:
+                raise
+            delay = backoff(attempt)
+            logger.warning(f"{method} {url} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        metrics.observe("http_request_seconds", time.perf_counter() - started, host=governor.host)
+        metrics.inc("http_requests_total", host=governor.host, status=response.status_code)
+
+        retry_after = governor.update(response)
+        if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+            return response
+
+        # Retry-After already pushed the governor's next slot back for every other caller too
+        delay = retry_after if retry_after is not None else backoff(attempt)
+        logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+        if retry_after is None:
+            time.sleep(delay)
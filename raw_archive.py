@@ -0,0 +1,521 @@
+# Append-only zstd JSONL archive of raw API objects, indexed by source and day, with a parallel COPY replay
+# The crawlers archive every post and comment they fetch that is new to them, including the ones they don't
+# store (image-only 4chan posts, deleted reddit comments); replay applies the same filters as the crawlers.
+# Only the objects are kept, not whole responses: reddit comments are flattened with a depth, and 4chan
+# posts older than a thread's watermark were archived by the crawl that first saw them.
+
+import atexit
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+import zstandard
+from dotenv import load_dotenv
+from psycopg2.extras import Json
+
+import metrics
+from score_worker import push_backlog_jobs
+from storage import (
+    CHAN_POST_COLUMNS, REDDIT_COMMENT_COLUMNS, REDDIT_POST_COLUMNS, chan_post_has_text, chan_post_rows,
+    reddit_comment_is_live, reddit_comment_rows, reddit_post_rows
+)
+
+# logger setup
+logger = logging.getLogger("raw archive")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+# Empty turns archiving off
+RAW_ARCHIVE_DIR = os.environ.get("RAW_ARCHIVE_DIR", "raw_archive")
+# A process starts a new segment once the current one holds this much JSON or is this old
+RAW_ARCHIVE_SEGMENT_MB = float(os.environ.get("RAW_ARCHIVE_SEGMENT_MB", 64))
+RAW_ARCHIVE_SEGMENT_SECONDS = float(os.environ.get("RAW_ARCHIVE_SEGMENT_SECONDS", 3600))
+RAW_ARCHIVE_ZSTD_LEVEL = int(os.environ.get("RAW_ARCHIVE_ZSTD_LEVEL", 3))
+# Record counts are committed to index.sqlite3 when a segment rotates and at most this often in between
+RAW_ARCHIVE_INDEX_FLUSH_SECONDS = float(os.environ.get("RAW_ARCHIVE_INDEX_FLUSH_SECONDS", 30))
+
+# target -> (database url env var, table, columns, conflict target, source of a record,
+#            unix time of a record, rows for a record)
+# Records keep the raw API object plus whatever the crawler knew about it (board, thread, keywords);
+# records the crawler would not have stored give no rows
+ARCHIVE_TARGETS = {
+    "chan-posts": (
+        "CHAN_DATABASE_URL", "posts", CHAN_POST_COLUMNS, "board, thread_number, post_number, posted_at",
+        lambda record: record["board"],
+        lambda record: record["post"]["time"],
+        lambda record: chan_post_rows(
+            record["board"], record["thread_number"], [record["post"]], record["keywords"]
+        ) if chan_post_has_text(record["post"]) else [],
+    ),
+    "reddit-posts": (
+        "REDDIT_DATABASE_URL", "posts", REDDIT_POST_COLUMNS, "subreddit, post_id, posted_at",
+        lambda record: record["subreddit"],
+        lambda record: record["post"]["created_utc"],
+        lambda record: reddit_post_rows(
+            record["subreddit"], [record["post"]], {record["post"]["id"]: record["keywords"]}
+        ),
+    ),
+    "reddit-comments": (
+        "REDDIT_DATABASE_URL", "comments", REDDIT_COMMENT_COLUMNS, "post_id, comment_id, posted_at",
+        lambda record: record["subreddit"],
+        lambda record: record["comment"]["created_utc"],
+        lambda record: reddit_comment_rows(
+            record["subreddit"], record["post_id"], [record["comment"]]
+        ) if reddit_comment_is_live(record["comment"]) else [],
+    ),
+}
+
+
+# Extra conditions on replayed rows: comments stored before the tree harvester have no data and a
+# posted_at borrowed from their post, so ON CONFLICT can't see them (see storage.legacy_comment_ids)
+REPLAY_FILTERS = {
+    "reddit-comments": """
+    WHERE NOT EXISTS (
+        SELECT 1 FROM comments c
+        WHERE c.post_id = replay.post_id AND c.comment_id = replay.comment_id AND c.data IS NULL
+    )
+    """,
+}
+
+
+INDEX_UPSERT = """
+INSERT INTO segments (path, target, source, day, records) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (path, source, day) DO UPDATE SET records = records + excluded.records
+"""
+
+
+def day_of(unix_time):
+    return datetime.fromtimestamp(unix_time, timezone.utc).strftime("%Y-%m-%d")
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RawArchive:
+    """
+    Each process appends to its own segment per target,
+    <root>/<target>/<day>/<pid>-<opened at>.jsonl.zst. Every append is a complete zstd
+    frame, so a segment is readable up to its last append even if the process dies;
+    zstd readers decode concatenated frames as one stream. index.sqlite3 counts the
+    records of every segment per source and posting day, so a replay only opens the
+    segments it needs. Counts are batched in memory and committed when a segment rotates
+    or every `index_flush_seconds`; segments of processes that died before closing them
+    are counted by recover().
+    """
+    def __init__(self, root=RAW_ARCHIVE_DIR, segment_bytes=RAW_ARCHIVE_SEGMENT_MB * 1024 * 1024,
+                 segment_seconds=RAW_ARCHIVE_SEGMENT_SECONDS, level=RAW_ARCHIVE_ZSTD_LEVEL,
+                 index_flush_seconds=RAW_ARCHIVE_INDEX_FLUSH_SECONDS):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.index_flush_seconds = index_flush_seconds
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        # target -> [relative path, bytes written, opened at]
+        self.segments = {}
+        # (path, target, source, day) -> records not yet in the index
+        self.pending = {}
+        self.flushed_at = time.monotonic()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+        os.makedirs(self.root, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(self.root, "index.sqlite3"), check_same_thread=False, timeout=30)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute(
+            """
+            CREATE TABLE IF NOT EXISTS segments (
+                path TEXT NOT NULL,
+                target TEXT NOT NULL,
+                source TEXT NOT NULL,
+                day TEXT NOT NULL,
+                records INTEGER NOT NULL,
+                PRIMARY KEY (path, source, day)
+            )
+            """
+        )
+        self.index.execute("CREATE INDEX IF NOT EXISTS segments_target_source_day_idx ON segments (target, source, day)")
+        # Segments whose writer rotated away from them, so their counts are complete
+        self.index.execute("CREATE TABLE IF NOT EXISTS closed_segments (path TEXT PRIMARY KEY)")
+        self.index.commit()
+
+    def segment(self, target, size):
+        now = time.time()
+        segment = self.segments.get(target)
+        if (
+            segment is None
+            or segment[1] + size > self.segment_bytes
+            or now - segment[2] > self.segment_seconds
+        ):
+            if segment is not None:
+                self.flush_index(closed=[segment[0]])
+            path = os.path.join(target, day_of(now), f"{os.getpid()}-{int(now * 1000)}.jsonl.zst")
+            os.makedirs(os.path.join(self.root, os.path.dirname(path)), exist_ok=True)
+            segment = self.segments[target] = [path, 0, now]
+        segment[1] += size
+        return segment[0]
+
+    def append(self, target, records):
+        if not records:
+            return
+        _, _, _, _, source_of, time_of, _ = ARCHIVE_TARGETS[target]
+        lines = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records).encode("utf-8")
+        counts = {}
+        for record in records:
+            key = (source_of(record), day_of(time_of(record)))
+            counts[key] = counts.get(key, 0) + 1
+
+        frame = self.compressor.compress(lines)
+        with self.lock:
+            path = self.segment(target, len(lines))
+            with open(os.path.join(self.root, path), "ab") as f:
+                f.write(frame)
+            for (source, day), count in counts.items():
+                key = (path, target, source, day)
+                self.pending[key] = self.pending.get(key, 0) + count
+            if time.monotonic() - self.flushed_at >= self.index_flush_seconds:
+                self.flush_index()
+        metrics.inc("raw_archive_records_total", len(records), target=target)
+
+    """
+    Commit the pending record counts, and mark `closed` segments complete, in one transaction.
+    Callers hold self.lock.
+    """
+    def flush_index(self, closed=()):
+        self.index.executemany(INDEX_UPSERT, [key + (count,) for key, count in self.pending.items()])
+        self.index.executemany("INSERT OR IGNORE INTO closed_segments (path) VALUES (?)", [(path,) for path in closed])
+        self.index.commit()
+        self.pending = {}
+        self.flushed_at = time.monotonic()
+
+    """
+    Flush the index and close every open segment; runs at exit of processes that exit normally
+    """
+    def close(self):
+        # A forked child inherits the exit hook, but the counts belong to its parent
+        if os.getpid() != self.pid:
+            return
+        with self.lock:
+            self.flush_index(closed=[segment[0] for segment in self.segments.values()])
+            self.segments = {}
+
+    """
+    Recount the segments of a target whose writer exited without closing them (pyfaktory's pool
+    processes never run exit hooks), so counts it hadn't flushed yet still reach the index.
+    Segments of running processes are left to their writer. Returns how many were recounted.
+    """
+    def recover(self, target):
+        _, _, _, _, source_of, time_of, _ = ARCHIVE_TARGETS[target]
+        with self.lock:
+            self.flush_index()
+            closed = {path for (path,) in self.index.execute("SELECT path FROM closed_segments")}
+
+        target_dir = os.path.join(self.root, target)
+        days = sorted(os.listdir(target_dir)) if os.path.isdir(target_dir) else []
+        recovered = 0
+        for day in days:
+            for name in sorted(os.listdir(os.path.join(target_dir, day))):
+                path = os.path.join(target, day, name)
+                if path in closed or not name.endswith(".jsonl.zst") or _is_running(int(name.split("-")[0])):
+                    continue
+                counts = {}
+                for record in read_segment(os.path.join(self.root, path)):
+                    key = (source_of(record), day_of(time_of(record)))
+                    counts[key] = counts.get(key, 0) + 1
+                with self.lock:
+                    self.index.execute("DELETE FROM segments WHERE path = ?", (path,))
+                    self.index.executemany(INDEX_UPSERT, [
+                        (path, target, source, record_day, count) for (source, record_day), count in counts.items()
+                    ])
+                    self.index.execute("INSERT OR IGNORE INTO closed_segments (path) VALUES (?)", (path,))
+                    self.index.commit()
+                recovered += 1
+        if recovered:
+            logger.info(f"Recounted {recovered} {target} segments left open by exited processes")
+        return recovered
+
+    """
+    Segments holding records of a target, optionally only for some sources and for
+    posting days in [since, until) (YYYY-MM-DD), as (path, records)
+    """
+    def find(self, target, sources=None, since=None, until=None):
+        filters = ["target = ?"]
+        params = [target]
+        if sources:
+            filters.append(f"source IN ({', '.join('?' for _ in sources)})")
+            params.extend(sources)
+        if since:
+            filters.append("day >= ?")
+            params.append(since)
+        if until:
+            filters.append("day < ?")
+            params.append(until)
+        with self.lock:
+            self.flush_index()
+            return self.index.execute(
+                f"SELECT path, sum(records) FROM segments WHERE {' AND '.join(filters)} GROUP BY path ORDER BY path",
+                params,
+            ).fetchall()
+
+    """
+    Records per source and day, for `python raw_archive.py list`
+    """
+    def summary(self, target):
+        with self.lock:
+            self.flush_index()
+            return self.index.execute(
+                """
+                SELECT source, day, sum(records), count(DISTINCT path) FROM segments
+                WHERE target = ? GROUP BY source, day ORDER BY source, day
+                """,
+                (target,),
+            ).fetchall()
+
+
+"""
+Records of one segment. A segment whose writer died mid-append ends in a torn frame;
+everything before it is still returned.
+"""
+def read_segment(path):
+    records = []
+    with open(path, "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        try:
+            for line in io.TextIOWrapper(reader, encoding="utf-8"):
+                records.append(json.loads(line))
+        except (zstandard.ZstdError, ValueError) as e:
+            logger.warning(f"Stopped reading {path} after {len(records)} records: {e}")
+    return records
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+"""
+Process-wide archive, or None when RAW_ARCHIVE_DIR is empty
+"""
+def get_archive():
+    global _archive
+    if not RAW_ARCHIVE_DIR:
+        return None
+    with _archive_lock:
+        if _archive is None:
+            _archive = RawArchive()
+            atexit.register(_archive.close)
+        return _archive
+
+
+"""
+The archive to read from for replay and list. Unlike get_archive() this refuses to run
+without one instead of returning None or starting an empty archive.
+"""
+def existing_archive():
+    if not RAW_ARCHIVE_DIR:
+        raise SystemExit("RAW_ARCHIVE_DIR is empty, set it to the archive directory to read")
+    if not os.path.isfile(os.path.join(RAW_ARCHIVE_DIR, "index.sqlite3")):
+        raise SystemExit(f"No raw archive in {RAW_ARCHIVE_DIR} (index.sqlite3 is missing)")
+    return get_archive()
+
+
+# pyfaktory's pool processes are forked; each needs its own segments and index connection
+def _reset_after_fork():
+    global _archive, _archive_lock
+    _archive = None
+    _archive_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+"""
+Archive records for a target. Archiving never fails a crawl: errors are logged and dropped.
+"""
+def archive(target, records):
+    try:
+        raw_archive = get_archive()
+        if raw_archive is not None:
+            raw_archive.append(target, records)
+    except Exception as e:
+        logger.error(f"Could not archive {len(records)} {target} records: {e}")
+
+
+def archive_chan_posts(board, thread_number, posts, keywords=None):
+    archive("chan-posts", [
+        {"board": board, "thread_number": thread_number, "keywords": list(keywords or []), "post": post}
+        for post in posts
+    ])
+
+
+def archive_reddit_posts(subreddit, posts, keywords=None):
+    keywords = keywords or {}
+    archive("reddit-posts", [
+        {"subreddit": subreddit, "keywords": keywords.get(post["id"], []), "post": post}
+        for post in posts
+    ])
+
+
+def archive_reddit_comments(subreddit, post_id, comments):
+    archive("reddit-comments", [
+        {"subreddit": subreddit, "post_id": post_id, "comment": comment}
+        for comment in comments
+    ])
+
+
+# COPY text format: tab separated, \N for NULL, backslash escapes
+def copy_value(value, sql_type):
+    if value is None:
+        return "\\N"
+    if isinstance(value, Json):
+        value = json.dumps(value.adapted)
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    elif sql_type == "text[]":
+        value = "{" + ",".join(
+            '"' + str(item).replace("\\", "\\\\").replace('"', '\\"') + '"' for item in value
+        ) + "}"
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+"""
+Load one segment into Postgres: COPY into a temporary table, then insert what isn't
+there yet. Only records from `sources` and posting days in [since, until) are loaded.
+Returns (records, inserted, unix time of the oldest record loaded or None).
+"""
+def replay_segment(target, path, dsn, sources=None, since=None, until=None):
+    _, table, columns, conflict, source_of, time_of, rows_of = ARCHIVE_TARGETS[target]
+    records = [
+        record for record in read_segment(path)
+        if (not sources or source_of(record) in sources)
+        and (not since or day_of(time_of(record)) >= since)
+        and (not until or day_of(time_of(record)) < until)
+    ]
+    if not records:
+        return 0, 0, None
+
+    buffer = io.StringIO()
+    for record in records:
+        for row in rows_of(record):
+            buffer.write("\t".join(copy_value(value, sql_type) for value, (_, sql_type) in zip(row, columns)) + "\n")
+    buffer.seek(0)
+
+    names = ", ".join(name for name, _ in columns)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE replay ON COMMIT DROP AS SELECT {names} FROM {table} WITH NO DATA")
+            cur.copy_expert(f"COPY replay ({names}) FROM STDIN", buffer)
+            cur.execute(
+                f"""
+                INSERT INTO {table} ({names})
+                SELECT {names} FROM replay
+                {REPLAY_FILTERS.get(target, "")}
+                ON CONFLICT ({conflict}) DO NOTHING
+                """
+            )
+            inserted = cur.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return len(records), inserted, min(time_of(record) for record in records)
+
+
+def _replay_segment(args):
+    target, path, dsn, sources, since, until = args
+    try:
+        return path, replay_segment(target, path, dsn, sources, since, until), None
+    except Exception as e:
+        return path, (0, 0, None), e
+
+
+"""
+Bulk-load a target's archived records back into its database, one segment per process.
+Existing rows are left alone, so replaying twice (or over a live database) is safe.
+Rows come back unscored, so score-posts jobs are pushed for what was inserted.
+"""
+def replay(target, sources=None, since=None, until=None, processes=None, dsn=None):
+    dsn_env = ARCHIVE_TARGETS[target][0]
+    dsn = dsn or os.environ.get(dsn_env) or os.environ.get("DATABASE_URL")
+    raw_archive = existing_archive()
+    raw_archive.recover(target)
+    segments = raw_archive.find(target, sources, since, until)
+    logger.info(f"Replaying {sum(records for _, records in segments)} {target} records from {len(segments)} segments")
+
+    jobs = [
+        (target, os.path.join(raw_archive.root, path), dsn, sources, since, until)
+        for path, _ in segments
+    ]
+    total_records, total_inserted, failed = 0, 0, 0
+    oldest = None
+    started = time.monotonic()
+    with multiprocessing.get_context("spawn").Pool(processes or os.cpu_count()) as pool:
+        for path, (records, inserted, oldest_record), error in pool.imap_unordered(_replay_segment, jobs):
+            if error:
+                failed += 1
+                logger.error(f"Replay of {path} failed: {error}")
+                continue
+            total_records += records
+            total_inserted += inserted
+            if inserted and oldest_record is not None:
+                oldest = oldest_record if oldest is None else min(oldest, oldest_record)
+            logger.info(f"Replayed {path}: {records} records, {inserted} new rows")
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Replayed {total_records} records ({total_inserted} new rows) in {elapsed:.1f}s, {failed} segments failed"
+    )
+    if total_inserted:
+        lookback_days = int((time.time() - oldest) // 86400) + 1 if oldest is not None else 0
+        push_backlog_jobs(target, total_inserted, lookback_days=lookback_days)
+        logger.info(f"Pushed score-posts jobs for {total_inserted} replayed {target} rows")
+    return total_records, total_inserted
+
+
+if __name__ == "__main__":
+    # python raw_archive.py replay <target> [--source name ...] [--since YYYY-MM-DD] [--until YYYY-MM-DD] [--processes N]
+    # python raw_archive.py list <target>
+    args = sys.argv[1:]
+    if len(args) >= 2 and args[0] in ("replay", "list") and args[1] in ARCHIVE_TARGETS:
+        command, target = args[0], args[1]
+        options = {"--source": [], "--since": None, "--until": None, "--processes": None}
+        for flag, value in zip(args[2::2], args[3::2]):
+            if flag == "--source":
+                options[flag].append(value)
+            elif flag in options:
+                options[flag] = value
+
+        if command == "list":
+            raw_archive = existing_archive()
+            raw_archive.recover(target)
+            for source, day, records, segments in raw_archive.summary(target):
+                print(f"{source} {day} {records} records in {segments} segments")
+        else:
+            processes = int(options["--processes"]) if options["--processes"] else None
+            replay(target, options["--source"], options["--since"], options["--until"], processes)
+    else:
+        print("Usage: python raw_archive.py replay <target> [--source name ...] [--since YYYY-MM-DD] "
+              "[--until YYYY-MM-DD] [--processes N]")
+        print("       python raw_archive.py list <target>")
+        print(f"Targets: {', '.join(ARCHIVE_TARGETS)}")
@@ -1,5 +1,6 @@
 import requests
 import time
+from keyword_matcher import KeywordMatcher
 from datetime import datetime, timedelta
 
 def fetch_today_reddit_posts(subreddit, keyword=None, limit=100):
@@ -9,6 +10,7 @@ def fetch_today_reddit_posts(subreddit, keyword=None, limit=100):
     url = f'https://www.reddit.com/r/{subreddit}/new.json'
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
     
+    matcher = KeywordMatcher([keyword]) if keyword else None
     all_posts = []
     after = None
     fetched_posts = 0
@@ -40,7 +42,7 @@ def fetch_today_reddit_posts(subreddit, keyword=None, limit=100):
                 link = f"https://reddit.com{post_info.get('permalink', '')}"
                 
                 # If keyword filtering is enabled
-                if keyword is None or keyword.lower() in title.lower():
+                if matcher is None or matcher.search(title, post_info.get('selftext')):
                     all_posts.append({'title': title, 'link': link})
                     fetched_posts += 1
             
@@ -1,8 +1,15 @@
+import asyncio
+import fcntl
+import json
 import logging
 import os
-import requests
+import threading
+import time
+from functools import partial
 from requests.auth import HTTPBasicAuth
 from dotenv import load_dotenv
+from rate_limit import governed_request
+from http_session import HTTP_TIMEOUT, NOT_MODIFIED, ValidatorCache, build_session, conditional_get
 
 logger = logging.getLogger("RedditClient")
 logger.propagate = False
@@ -19,18 +26,82 @@ fh.setLevel(logging.INFO)
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
-class RedditClient:
-    API_BASE = "https://oauth.reddit.com"
-    TOKEN_URL = "https://www.reddit.com/api/v1/access_token"
+REDDIT_MAX_PAGES = int(os.environ.get("REDDIT_MAX_PAGES", 10))
+# Optional file so every worker process on a machine shares one token
+REDDIT_TOKEN_CACHE = os.environ.get("REDDIT_TOKEN_CACHE")
+# Refresh this many seconds before the token actually expires
+REDDIT_TOKEN_REFRESH_MARGIN = float(os.environ.get("REDDIT_TOKEN_REFRESH_MARGIN", 300))
 
-    def __init__(self):
-        self.headers = {
-            "User-Agent": os.environ.get("REDDIT_USER_AGENT", "reddit-crawler"),
-            "Authorization": f"Bearer {self.get_token()}"
-        }
+# Shared by every RedditClient in the process so connections and validators outlive a single job
+session = build_session()
+validators = ValidatorCache()
+
+class TokenManager:
+    """
+    Caches the OAuth token and its expiry in memory, and in REDDIT_TOKEN_CACHE when set,
+    so workers only hit the token endpoint about once an hour instead of once per job.
+    The disk cache is read and refreshed under an flock so concurrent processes don't
+    all refresh at the same time.
+    """
+    def __init__(self, cache_path=REDDIT_TOKEN_CACHE, refresh_margin=REDDIT_TOKEN_REFRESH_MARGIN):
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def is_fresh(self, expires_at):
+        return time.time() < expires_at - self.refresh_margin
 
     def get_token(self):
-        auth = requests.auth.HTTPBasicAuth(os.environ.get("REDDIT_CLIENT_ID"), os.environ.get("REDDIT_CLIENT_SECRET"))
+        with self.lock:
+            if self.token and self.is_fresh(self.expires_at):
+                return self.token
+            if self.cache_path:
+                self.token, self.expires_at = self.refresh_shared()
+            else:
+                self.token, self.expires_at = self.fetch_token()
+            return self.token
+
+    # Drop a token reddit rejected (401) so the next get_token fetches a new one
+    def invalidate(self, token):
+        with self.lock:
+            if self.token != token:
+                return
+            self.token, self.expires_at = None, 0
+            if self.cache_path:
+                with open(f"{self.cache_path}.lock", "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    cached = self.read_cache()
+                    if cached and cached[0] == token:
+                        os.remove(self.cache_path)
+
+    def refresh_shared(self):
+        with open(f"{self.cache_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have refreshed while we waited for the lock
+            cached = self.read_cache()
+            if cached and self.is_fresh(cached[1]):
+                return cached
+
+            token, expires_at = self.fetch_token()
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"access_token": token, "expires_at": expires_at}, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.cache_path)
+            return token, expires_at
+
+    def read_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            return cached["access_token"], cached["expires_at"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def fetch_token(self):
+        auth = HTTPBasicAuth(os.environ.get("REDDIT_CLIENT_ID"), os.environ.get("REDDIT_CLIENT_SECRET"))
 
         data = {
             "grant_type": "password",
@@ -41,30 +112,259 @@ class RedditClient:
             "User-Agent": os.environ.get("REDDIT_USER_AGENT", "reddit-crawler")
         }
 
-        response = requests.post(self.TOKEN_URL, auth=auth, data=data, headers=headers)
+        requested_at = time.time()
+        response = governed_request(session, "POST", RedditClient.TOKEN_URL, auth=auth, data=data, headers=headers, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
-        token = response.json().get("access_token")
-        return token
-        
-    def get_subreddit_posts(self, subreddit, limit=10):
-        api_call = f"{self.API_BASE}/r/{subreddit}/new.json?limit={limit}"
-        response = requests.get(api_call, headers=self.headers)
-        if response.status_code == 200:
-            logger.info(f"Successfully fetched posts from {subreddit}")
-            return response.json().get("data", {}).get("children", [])
+        token_data = response.json()
+        logger.info("Fetched a new reddit access token")
+        return token_data.get("access_token"), requested_at + token_data.get("expires_in", 3600)
+
+token_manager = TokenManager()
+
+class Fetch:
+    """
+    A client call a walk needs answered before it can go on: the name of a
+    RedditClient/AsyncRedditClient method and its arguments
+    """
+    def __init__(self, method, *args, **kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+
+    def call(self, reddit_client):
+        return getattr(reddit_client, self.method)(*self.args, **self.kwargs)
+
+
+"""
+Drive a walk, a generator that yields Fetch requests (sent back their result) and items
+(sent back None), on a RedditClient, yielding its items. Walks never do I/O themselves,
+so one walk serves both clients.
+"""
+def run_walk(reddit_client, walk):
+    result = None
+    while True:
+        try:
+            item = walk.send(result)
+        except StopIteration:
+            return
+        if isinstance(item, Fetch):
+            result = item.call(reddit_client)
+        else:
+            result = None
+            yield item
+
+
+"""
+run_walk for AsyncRedditClient, as an async generator
+"""
+async def run_walk_async(reddit_client, walk):
+    result = None
+    while True:
+        try:
+            item = walk.send(result)
+        except StopIteration:
+            return
+        if isinstance(item, Fetch):
+            result = await item.call(reddit_client)
+        else:
+            result = None
+            yield item
+
+
+class ListingTruncated(Exception):
+    """
+    Raised by walk_new_posts when max_pages ran out before the watermark was reached
+    """
+
+
+# Walks /new newest-first, 100 posts per request, and stops at the watermark: the fullname
+# of the newest post we stored last time or anything created before it. Without a watermark
+# it stops after max_pages (reddit listings end at ~1000 posts anyway). A failed page
+# raises the client's HTTP error, and running out of pages before the watermark raises
+# ListingTruncated, so callers know the listing is incomplete.
+def walk_new_posts(api_base, subreddit, last_created_utc, last_fullname, max_pages):
+    after = None
+    for page in range(max_pages):
+        api_call = f"{api_base}/r/{subreddit}/new.json?limit=100"
+        if after:
+            api_call += f"&after={after}"
+            response = yield Fetch("get", api_call)
         else:
+            # Only the first page can be unchanged since last time
+            response = yield Fetch("get", api_call, conditional=True)
+            if response.status_code == 304:
+                logger.info(f"No new posts in {subreddit} since last fetch")
+                return
+
+        if response.status_code != 200:
             logger.error(f"Failed to fetch posts from {subreddit}. Status code: {response.status_code}")
-            return []
+            response.raise_for_status()
+
+        listing = response.json().get("data", {})
+        for post in listing.get("children", []):
+            post_data = post["data"]
+            if post_data["name"] == last_fullname:
+                return
+            if last_created_utc is not None and post_data["created_utc"] < last_created_utc:
+                return
+            yield post
+
+        after = listing.get("after")
+        logger.info(f"Fetched page {page + 1} of new posts from {subreddit}")
+        if not after:
+            return
+
+    if last_fullname is not None or last_created_utc is not None:
+        raise ListingTruncated(f"{max_pages} pages of {subreddit} did not reach the last stored post")
 
-    def get_post_comments(self, subreddit, post_id, limit=10):
+class RedditClient:
+    # Overridable so benchmark.py can point the client at a local stand-in
+    API_BASE = os.environ.get("REDDIT_API_BASE", "https://oauth.reddit.com")
+    TOKEN_URL = os.environ.get("REDDIT_TOKEN_URL", "https://www.reddit.com/api/v1/access_token")
+
+    def get_token(self):
+        return token_manager.get_token()
+
+    def headers(self, token):
+        return {
+            "User-Agent": os.environ.get("REDDIT_USER_AGENT", "reddit-crawler"),
+            "Authorization": f"Bearer {token}"
+        }
+
+    # GET with the current token, refreshing it and retrying once if reddit answers 401
+    def get(self, api_call, conditional=False, **kwargs):
+        for attempt in range(2):
+            token = self.get_token()
+            if conditional:
+                response = conditional_get(session, validators, api_call, headers=self.headers(token), **kwargs)
+            else:
+                response = governed_request(
+                    session, "GET", api_call, headers=self.headers(token), timeout=HTTP_TIMEOUT, **kwargs
+                )
+            if response.status_code != 401 or attempt:
+                return response
+            logger.info("Reddit rejected the access token, refreshing")
+            token_manager.invalidate(token)
+
+    # GET and hand the response to read; the endpoint methods below build the URL and the
+    # reader, so AsyncRedditClient only has to override this (and get) to await the GET
+    def fetch(self, read, api_call, conditional=False, **kwargs):
+        return read(self.get(api_call, conditional, **kwargs))
+
+    def get_subreddit_posts(self, subreddit, limit=10):
+        api_call = f"{self.API_BASE}/r/{subreddit}/new.json?limit={limit}"
+        return self.fetch(partial(read_subreddit_posts, subreddit), api_call, conditional=True)
+
+    def iter_new_posts(self, subreddit, last_created_utc=None, last_fullname=None, max_pages=REDDIT_MAX_PAGES):
+        return run_walk(self, walk_new_posts(self.API_BASE, subreddit, last_created_utc, last_fullname, max_pages))
+
+    # Returns the top-level comment things of a post (with nested replies). With comment set,
+    # returns the subtree rooted at that comment, which is how "continue this thread" stubs expand.
+    # None if the fetch failed.
+    def get_post_comments(self, subreddit, post_id, limit=500, comment=None):
         api_call = f"{self.API_BASE}/r/{subreddit}/comments/{post_id}.json?limit={limit}"
-        response = requests.get(api_call, headers=self.headers)
-        if response.status_code == 200:
-            logger.info(f"Successfully fetched comments for post {post_id} in {subreddit}")
-            return response.json()[1].get("data", {}).get("children", [])
-        else:
-            logger.error(f"Failed to fetch comments for post {post_id} in {subreddit}. Status code: {response.status_code}")
-            return []
+        if comment:
+            api_call = f"{self.API_BASE}/r/{subreddit}/comments/{post_id}/_/{comment}.json?limit={limit}"
+        return self.fetch(partial(read_post_comments, subreddit, post_id), api_call, conditional=True)
+
+    # Expands up to 100 comment ids from "more" stubs; returns a flat list of things, or None if the fetch failed
+    def get_more_children(self, post_id, children):
+        api_call = f"{self.API_BASE}/api/morechildren.json"
+        params = {
+            "api_type": "json",
+            "link_id": f"t3_{post_id}",
+            "children": ",".join(children),
+            "limit_children": "false",
+        }
+        return self.fetch(partial(read_more_children, post_id, children), api_call, params=params)
+
+    # Forget the validators of a subreddit's first /new page (see walk_new_posts), so the next
+    # crawl pages it again; crawlers call this when they could not store the posts
+    def forget_new_posts(self, subreddit):
+        validators.forget(f"{self.API_BASE}/r/{subreddit}/new.json?limit=100")
+
+    # Same for every comment page of a post: the listing and "continue this thread" subtrees
+    def forget_post_comments(self, subreddit, post_id):
+        prefix = f"{self.API_BASE}/r/{subreddit}/comments/{post_id}"
+        validators.forget_prefix((f"{prefix}.json", f"{prefix}/"))
+
+    # Current listing data for up to 100 posts by id, used to check num_comments
+    def get_posts_by_id(self, post_ids):
+        fullnames = ",".join(f"t3_{post_id}" for post_id in post_ids)
+        api_call = f"{self.API_BASE}/by_id/{fullnames}.json"
+        return self.fetch(partial(read_posts_by_id, post_ids), api_call)
+
+# Readers for RedditClient.fetch: what each endpoint method returns for a response
+
+def read_subreddit_posts(subreddit, response):
+    if response.status_code == 304:
+        logger.info(f"No new posts in {subreddit} since last fetch")
+        return NOT_MODIFIED
+    if response.status_code == 200:
+        logger.info(f"Successfully fetched posts from {subreddit}")
+        return response.json().get("data", {}).get("children", [])
+    else:
+        logger.error(f"Failed to fetch posts from {subreddit}. Status code: {response.status_code}")
+        return []
+
+def read_post_comments(subreddit, post_id, response):
+    if response.status_code == 304:
+        logger.info(f"No new comments for post {post_id} in {subreddit} since last fetch")
+        return NOT_MODIFIED
+    if response.status_code == 200:
+        logger.info(f"Successfully fetched comments for post {post_id} in {subreddit}")
+        return response.json()[1].get("data", {}).get("children", [])
+    else:
+        logger.error(f"Failed to fetch comments for post {post_id} in {subreddit}. Status code: {response.status_code}")
+        return None
+
+def read_more_children(post_id, children, response):
+    if response.status_code == 200:
+        return response.json().get("json", {}).get("data", {}).get("things", [])
+    else:
+        logger.error(f"Failed to expand {len(children)} comments for post {post_id}. Status code: {response.status_code}")
+        return None
+
+def read_posts_by_id(post_ids, response):
+    if response.status_code == 200:
+        return response.json().get("data", {}).get("children", [])
+    else:
+        logger.error(f"Failed to fetch {len(post_ids)} posts by id. Status code: {response.status_code}")
+        return []
+
+class AsyncRedditClient(RedditClient):
+    """
+    RedditClient for the async crawl mode. Only the GET differs, so every RedditClient
+    method returns a coroutine here, with the same return values (iter_new_posts is an
+    async generator). http is an open async_http.AsyncHttp. The token still comes from
+    the shared token_manager, fetched in a thread when it expires.
+    """
+    def __init__(self, http):
+        self.http = http
+
+    async def get_token(self):
+        return await asyncio.to_thread(token_manager.get_token)
+
+    async def get(self, api_call, conditional=False, **kwargs):
+        for attempt in range(2):
+            token = await self.get_token()
+            if conditional:
+                response = await self.http.conditional_get(validators, api_call, headers=self.headers(token), **kwargs)
+            else:
+                response = await self.http.request("GET", api_call, headers=self.headers(token), **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+            logger.info("Reddit rejected the access token, refreshing")
+            token_manager.invalidate(token)
+
+    async def fetch(self, read, api_call, conditional=False, **kwargs):
+        return read(await self.get(api_call, conditional, **kwargs))
+
+    # A failed page raises async_http.HTTPStatusError
+    def iter_new_posts(self, subreddit, last_created_utc=None, last_fullname=None, max_pages=REDDIT_MAX_PAGES):
+        return run_walk_async(
+            self, walk_new_posts(self.API_BASE, subreddit, last_created_utc, last_fullname, max_pages)
+        )
 
 if __name__ == "__main__":
     client = RedditClient()
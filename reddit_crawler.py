@@ -1,11 +1,28 @@
+import asyncio
 import logging
 import time
 import datetime
+import aiohttp
 from pyfaktory import Client, Producer, Consumer, Job
-from reddit_client import RedditClient
+from reddit_client import AsyncRedditClient, ListingTruncated, RedditClient
+from async_http import AsyncHttp
+from async_jobs import ScoreNotifier, job_queue, run_workers
+import async_storage
+from http_session import NOT_MODIFIED
+from score_worker import push_score_jobs
+from storage import (
+    clear_comments_queued, clear_subreddit_queued, get_subreddit_watermark, insert_reddit_comments,
+    insert_reddit_posts, mark_comments_queued, mark_subreddit_queued, recent_reddit_posts,
+    reddit_comment_is_live, reddit_posts_since, save_comments_seen, save_subreddit_watermark
+)
+from comment_harvester import INCOMPLETE, harvest_comments, harvest_comments_async
+from keyword_matcher import get_matcher
+from raw_archive import archive_reddit_comments, archive_reddit_posts
+import metrics
+from db_pool import CONSUMER_CONCURRENCY, get_pool
+from scheduler import Scheduler, Source, parse_sources
 from dotenv import load_dotenv
 import os
-import psycopg2
 from psycopg2.extras import Json
 from psycopg2.extensions import register_adapter
 import requests
@@ -23,6 +40,12 @@ load_dotenv()
 
 FAKTORY_SERVER_URL = os.environ.get("FAKTORY_SERVER_URL")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# How long after posting we keep checking a post for new comments
+REDDIT_COMMENT_REFRESH_HOURS = float(os.environ.get("REDDIT_COMMENT_REFRESH_HOURS", 24))
+# A crawl-subreddit / crawl-comments job isn't pushed again while one is queued, unless it
+# was queued longer ago than this (the job was lost)
+CRAWL_QUEUED_TIMEOUT = int(os.environ.get("CRAWL_QUEUED_TIMEOUT", 3600))
+COMMENTS_CONCURRENCY = int(os.environ.get("COMMENTS_CONCURRENCY", CONSUMER_CONCURRENCY))
 
 register_adapter(dict, Json)
 
@@ -31,135 +54,395 @@ fh.setLevel(logging.DEBUG)
 fh.setFormatter(formatter)
 logger.addHandler(fh)
                 
-def get_toxicity_score(comment):
-    API_URL = "https://api.moderatehatespeech.com/api/v1/moderate/"
+# Keywords each post's title/selftext matched, by post id
+def post_keywords(post_data):
+    matcher = get_matcher()
+    return {post["id"]: matcher.matches(post.get("title"), post.get("selftext")) for post in post_data}
+
+def store_posts(subreddit, posts):
+    post_data = [post["data"] for post in posts]
+    keywords = post_keywords(post_data)
+    archive_reddit_posts(subreddit, post_data, keywords)
 
-    data = {
-        "token": os.environ.get("MODERATE_HATE_SPEECH_API_KEY"),
-        "text": comment
-    }
     try:
-        response = requests.post(API_URL, json=data).json()
-        return response["class"]
+        with get_pool().connection() as conn:
+            inserted, skipped = insert_reddit_posts(conn, subreddit, post_data, keywords)
+        logger.info(f"Inserted {inserted} posts, skipped {skipped} existing for {subreddit}")
     except Exception as e:
-        logger.error(f"Failed to fetch toxicity score: {e}")
-        return None
-    except ValueError as e:
-        logger.error(f"Failed to parse JSON response: {e}")
+        logger.error(f"Error inserting posts for {subreddit}: {e}")
         return None
 
-def store_post(subreddit, post):
-    conn = psycopg2.connect(dsn=DATABASE_URL)
-    cur = conn.cursor()
+    if inserted:
+        push_score_jobs("reddit-posts")
+    return inserted
 
-    post_id = post["data"]["id"]
-    post_title = post["data"]["title"]
-    post_data = post["data"]
-    toxicity_score = post_data.get("toxicity_score")
+# Comments that still have a body
+def live_comments(comments):
+    comment_data = []
+    for comment in comments:
+        if not reddit_comment_is_live(comment):
+            logger.debug(f"Skipping deleted/removed comment: {comment.get('id')}")
+            continue
+        comment_data.append(comment)
+    return comment_data
 
-    logger.debug(f"Storing post with Post ID: {post_id}, Toxicity: {toxicity_score}")
+def store_comments(subreddit, post_id, comments):
+    # Deleted and removed comments are archived too, only the database skips them
+    archive_reddit_comments(subreddit, post_id, comments)
+    comment_data = live_comments(comments)
 
-    cur.execute("SELECT 1 FROM posts WHERE subreddit = %s AND post_id = %s", (subreddit, post_id),)
-    if cur.fetchone():
-        logger.info(f"Post already exists: {subreddit}/{post_id}")
-    else:
-        query = "INSERT INTO posts (subreddit, post_id, post_title, data, toxicity_score) VALUES (%s, %s, %s, %s, %s) RETURNING post_id"
-        cur.execute(query, (subreddit, post_id, post_title, post_data, toxicity_score))
-        conn.commit()
-        db_id = cur.fetchone()[0]
-        logger.info(f"Inserted DB id: {db_id} for post {subreddit}/{post_id} with toxicity: {toxicity_score}")
+    try:
+        with get_pool().connection() as conn:
+            inserted, skipped = insert_reddit_comments(conn, subreddit, post_id, comment_data)
+        logger.info(f"Inserted {inserted} comments, skipped {skipped} existing for post {post_id}")
+    except Exception as e:
+        logger.error(f"Error inserting comments for post {post_id}: {e}")
+        return None
 
-    cur.close()
-    conn.close()
+    if inserted:
+        push_score_jobs("reddit-comments")
+    return inserted
 
-def store_comment(post_id, comment):
-    conn = psycopg2.connect(dsn=DATABASE_URL)
-    cur = conn.cursor()
+# Harvest a post's whole comment tree and remember the num_comments it was harvested at
+def crawl_comments(subreddit, post_id, num_comments=None, reddit_client=None):
+    reddit_client = reddit_client or RedditClient()
+    comments = list(harvest_comments(reddit_client, subreddit, post_id))
+    if comments == [NOT_MODIFIED]:
+        # The tree hasn't changed since we last stored it, so this count is as harvested as it gets;
+        # without saving it the post would be re-harvested on every crawl
+        with get_pool().connection() as conn:
+            if num_comments is not None:
+                save_comments_seen(conn, subreddit, post_id, num_comments)
+            else:
+                clear_comments_queued(conn, subreddit, post_id)
+        return
+    comments, complete = split_incomplete(comments)
+    if store_comments(subreddit, post_id, comments) is None or not complete:
+        # Otherwise the next harvest gets a 304 and these comments are never stored
+        reddit_client.forget_post_comments(subreddit, post_id)
+        with get_pool().connection() as conn:
+            clear_comments_queued(conn, subreddit, post_id)
+        return
 
-    comment_id = comment["data"]["id"]
-    comment_body = comment["data"].get("body")
-    toxicity_score = comment["data"].get("toxicity")
+    with get_pool().connection() as conn:
+        if num_comments is not None:
+            save_comments_seen(conn, subreddit, post_id, num_comments)
+        else:
+            clear_comments_queued(conn, subreddit, post_id)
 
-    if comment_body in ["[deleted]", "[removed]", None]:
-        logger.info(f"Skipping deleted/removed comment: {comment}")
-        return
+# A harvest's comments and whether it got the whole tree. A partial harvest is still stored,
+# but the post's count isn't recorded, so the next crawl harvests it again for what is missing.
+def split_incomplete(comments):
+    if comments and comments[-1] is INCOMPLETE:
+        return comments[:-1], False
+    return comments, True
 
-    logger.debug(f"Storing comment with ID: {comment_id}, Post ID: {post_id}, Toxicity: {toxicity_score}")
+# Posts from the last REDDIT_COMMENT_REFRESH_HOURS whose num_comments moved since we last harvested them.
+# Posts that already have a crawl-comments job waiting are skipped without asking reddit about them.
+def posts_with_new_comments(reddit_client, subreddit, since_utc):
+    with get_pool().connection() as conn:
+        comments_seen = recent_reddit_posts(conn, subreddit, since_utc, CRAWL_QUEUED_TIMEOUT)
 
-    cur.execute("SELECT 1 FROM comments WHERE post_id = %s AND comment_id = %s", (post_id, comment_id),)
-    if cur.fetchone():
-        logger.info(f"Comment already exists: {post_id}/{comment_id}")
-    else:
-        query = "INSERT INTO comments (post_id, comment_id, comment_body, toxicity_score) VALUES (%s, %s, %s, %s) RETURNING comment_id"
-        cur.execute(query, (post_id, comment_id, comment_body, toxicity_score))
-        conn.commit()
-        db_id = cur.fetchone()[0]
-        logger.info(f"Inserted DB id: {db_id} for comment {post_id}/{comment_id}")
-    
-    cur.close()
-    conn.close()
+    post_ids = list(comments_seen)
+    changed = []
+    for start in range(0, len(post_ids), 100):
+        posts = reddit_client.get_posts_by_id(post_ids[start:start + 100])
+        changed.extend(comment_count_changes(posts, comments_seen))
+    return changed
 
-def crawl_subreddit(subreddit, previous_post_ids=[]):
-    reddit_client = RedditClient()
-    posts = reddit_client.get_subreddit_posts(subreddit, limit=10)
+def comment_count_changes(posts, comments_seen):
+    changed = []
     for post in posts:
         post_id = post["data"]["id"]
-        post_title = post["data"]["title"]
-        post_body = post["data"].get("selftext", "")
-        full_text = f"{post_title}\n{post_body}"
-
-        toxicity_score = get_toxicity_score(full_text)
-        post["data"]["toxicity_score"] = toxicity_score
-        store_post(subreddit, post)
-        
-        comments = reddit_client.get_post_comments(subreddit, post_id, limit=10)
-        for comment in comments:
-            comment_body = comment["data"].get("body", "")
-
-            if comment_body not in ["[deleted]", "[removed]", None]:
-                comment_toxicity = get_toxicity_score(comment_body)
-                comment["data"]["toxicity"] = comment_toxicity
-            
-            store_comment(post_id, comment)
+        num_comments = post["data"].get("num_comments", 0)
+        if num_comments and num_comments != comments_seen.get(post_id):
+            changed.append((post_id, num_comments))
+    return changed
+
+# previous_post_ids is unused; the subreddit_watermarks table tracks where the last crawl stopped
+def crawl_subreddit(subreddit, previous_post_ids=[]):
+    reddit_client = RedditClient()
+
+    with get_pool().connection() as conn:
+        # This crawl sees everything posted so far, so the next poll may queue another one
+        clear_subreddit_queued(conn, subreddit)
+        last_created_utc, last_fullname = get_subreddit_watermark(conn, subreddit)
+
+    # Page through /new until we reach what the last crawl already stored
+    posts = []
+    complete = True
+    try:
+        for post in reddit_client.iter_new_posts(subreddit, last_created_utc, last_fullname):
+            posts.append(post)
+    except (requests.RequestException, ListingTruncated) as e:
+        logger.error(f"Stopped paging {subreddit} early: {e}")
+        complete = False
+
+    logger.info(f"Found {len(posts)} new posts in {subreddit}")
+
+    stored = not posts or store_posts(subreddit, posts) is not None
+    if not stored or not complete:
+        # The watermark stays put, so the next crawl has to page back over these posts
+        reddit_client.forget_new_posts(subreddit)
+    if not stored:
+        return
+
+    # Listings are newest first; only move the watermark once everything up to it is stored,
+    # otherwise the next crawl pages back over the gap
+    if posts and complete:
+        newest = posts[0]["data"]
+        with get_pool().connection() as conn:
+            save_subreddit_watermark(conn, subreddit, newest["created_utc"], newest["name"])
+
+    # New and recent posts whose comment count moved get their comment tree (re)harvested,
+    # each in its own crawl-comments job so one busy subreddit spreads across all workers
+    since_utc = time.time() - REDDIT_COMMENT_REFRESH_HOURS * 3600
+    changed = posts_with_new_comments(reddit_client, subreddit, since_utc)
+    crawl_comments_jobs = [
+        Job(jobtype="crawl-comments", args=(subreddit, post_id, num_comments), queue="crawl-comments")
+        for post_id, num_comments in changed
+    ]
+    if crawl_comments_jobs:
+        # Marked before the push so a job that finishes right away can't be marked after it ran
+        with get_pool().connection() as conn:
+            mark_comments_queued(conn, subreddit, [post_id for post_id, _ in changed], since_utc)
+            try:
+                with Client(faktory_url=FAKTORY_SERVER_URL, role="producer") as client:
+                    producer = Producer(client=client)
+                    with metrics.timer("faktory_push_seconds", queue="crawl-comments"):
+                        producer.push_bulk(crawl_comments_jobs)
+            except Exception:
+                for post_id, _ in changed:
+                    clear_comments_queued(conn, subreddit, post_id)
+                raise
+        metrics.inc("faktory_jobs_pushed_total", len(crawl_comments_jobs), queue="crawl-comments")
+        logger.info(f"Pushed {len(crawl_comments_jobs)} jobs to 'crawl-comments' queue.")
+
+# Newest created_utc each subreddit's crawls had stored at the last producer poll
+last_seen_created = {}
+
+def poll_subreddit(subreddit):
+    with get_pool().connection() as conn:
+        # Crawl every poll even without new posts, recent posts may still have new comments,
+        # unless the crawl pushed last time is still waiting in the queue
+        if mark_subreddit_queued(conn, subreddit, CRAWL_QUEUED_TIMEOUT):
+            try:
+                produce_jobs([subreddit])
+            except Exception:
+                clear_subreddit_queued(conn, subreddit)
+                raise
+        else:
+            logger.info(f"crawl-subreddit job still queued for: {subreddit}")
+        return count_new_posts(conn, subreddit)
+
+# How many posts the crawl-subreddit jobs stored since the last poll (the scheduler's churn signal).
+# Read from the database rather than from a /new fetch here, which would double the listing calls
+# against reddit's rate budget; the count lags one poll behind the jobs.
+def count_new_posts(conn, subreddit):
+    previous = last_seen_created.get(subreddit, time.time())
+    new_posts, newest = reddit_posts_since(conn, subreddit, previous)
+    last_seen_created[subreddit] = max(previous, newest or previous)
+    return new_posts
 
 def produce_jobs(subreddits):
     with Client(faktory_url=FAKTORY_SERVER_URL, role="producer") as client:
         producer = Producer(client=client)
         for subreddit in subreddits:
             job = Job(jobtype="crawl-subreddit", args=(subreddit,), queue="crawl-subreddit")
-            producer.push(job)
+            with metrics.timer("faktory_push_seconds", queue="crawl-subreddit"):
+                producer.push(job)
+            metrics.inc("faktory_jobs_pushed_total", queue="crawl-subreddit")
             logger.info(f"Pushed job for subreddit: {subreddit}")
 
 
+# store_posts for the async mode
+async def store_posts_async(pool, scores, subreddit, posts):
+    post_data = [post["data"] for post in posts]
+    keywords = post_keywords(post_data)
+    await asyncio.to_thread(archive_reddit_posts, subreddit, post_data, keywords)
+    try:
+        async with pool.acquire() as conn:
+            inserted, skipped = await async_storage.insert_reddit_posts(conn, subreddit, post_data, keywords)
+        logger.info(f"Inserted {inserted} posts, skipped {skipped} existing for {subreddit}")
+    except Exception as e:
+        logger.error(f"Error inserting posts for {subreddit}: {e}")
+        return None
+
+    if inserted:
+        scores.notify("reddit-posts")
+    return inserted
+
+# crawl_comments for the async mode
+async def crawl_comments_async(reddit_client, pool, scores, subreddit, post_id, num_comments=None):
+    comments = [comment async for comment in harvest_comments_async(reddit_client, subreddit, post_id)]
+    if comments == [NOT_MODIFIED]:
+        async with pool.acquire() as conn:
+            if num_comments is not None:
+                await async_storage.save_comments_seen(conn, subreddit, post_id, num_comments)
+            else:
+                await async_storage.clear_comments_queued(conn, subreddit, post_id)
+        return
+    comments, complete = split_incomplete(comments)
+    await asyncio.to_thread(archive_reddit_comments, subreddit, post_id, comments)
+    comment_data = live_comments(comments)
+    try:
+        async with pool.acquire() as conn:
+            inserted, skipped = await async_storage.insert_reddit_comments(conn, subreddit, post_id, comment_data)
+            if num_comments is not None and complete:
+                await async_storage.save_comments_seen(conn, subreddit, post_id, num_comments)
+            else:
+                await async_storage.clear_comments_queued(conn, subreddit, post_id)
+        logger.info(f"Inserted {inserted} comments, skipped {skipped} existing for post {post_id}")
+        if not complete:
+            reddit_client.forget_post_comments(subreddit, post_id)
+    except Exception as e:
+        logger.error(f"Error inserting comments for post {post_id}: {e}")
+        reddit_client.forget_post_comments(subreddit, post_id)
+        async with pool.acquire() as conn:
+            await async_storage.clear_comments_queued(conn, subreddit, post_id)
+        return
+
+    if inserted:
+        scores.notify("reddit-comments")
+
+# crawl_subreddit for the async mode; comment harvests go onto the in-process comments queue.
+# Returns how many new posts it found (the scheduler's churn signal), or None if they could not be stored.
+async def crawl_subreddit_async(reddit_client, pool, scores, comments_queue, subreddit):
+    async with pool.acquire() as conn:
+        last_created_utc, last_fullname = await async_storage.get_subreddit_watermark(conn, subreddit)
+
+    posts = []
+    complete = True
+    try:
+        async for post in reddit_client.iter_new_posts(subreddit, last_created_utc, last_fullname):
+            posts.append(post)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ListingTruncated) as e:
+        logger.error(f"Stopped paging {subreddit} early: {e}")
+        complete = False
+
+    logger.info(f"Found {len(posts)} new posts in {subreddit}")
+
+    stored = not posts or await store_posts_async(pool, scores, subreddit, posts) is not None
+    if not stored or not complete:
+        reddit_client.forget_new_posts(subreddit)
+    if not stored:
+        return None
+
+    async with pool.acquire() as conn:
+        if posts and complete:
+            newest = posts[0]["data"]
+            await async_storage.save_subreddit_watermark(conn, subreddit, newest["created_utc"], newest["name"])
+        since_utc = time.time() - REDDIT_COMMENT_REFRESH_HOURS * 3600
+        comments_seen = await async_storage.recent_reddit_posts(conn, subreddit, since_utc, CRAWL_QUEUED_TIMEOUT)
+
+    post_ids = list(comments_seen)
+    for start in range(0, len(post_ids), 100):
+        recent_posts = await reddit_client.get_posts_by_id(post_ids[start:start + 100])
+        changed = comment_count_changes(recent_posts, comments_seen)
+        async with pool.acquire() as conn:
+            await async_storage.mark_comments_queued(conn, subreddit, [post_id for post_id, _ in changed], since_utc)
+        for post_id, num_comments in changed:
+            await comments_queue.put((subreddit, post_id, num_comments))
+    return len(posts)
+
+"""
+Listing polls and comment harvests in one process. Each poll crawls the subreddit's new
+posts right away (one listing crawl per subreddit at a time, as in the Faktory producer)
+and ASYNC_WORKERS coroutines harvest comment trees off a queue of ASYNC_QUEUE_SIZE.
+"""
+async def run_async(subreddits):
+    async with AsyncHttp() as http, async_storage.create_pool() as pool:
+        reddit_client = AsyncRedditClient(http)
+        scores = ScoreNotifier()
+        comments_queue = job_queue("crawl-comments")
+        crawl_subreddit = metrics.track_job("crawl-subreddit", crawl_subreddit_async)
+
+        # Crawl every poll even without new posts, recent posts may still have new comments
+        async def poll(subreddit):
+            return await crawl_subreddit(reddit_client, pool, scores, comments_queue, subreddit)
+
+        async def crawl(*args):
+            await crawl_comments_async(reddit_client, pool, scores, *args)
+
+        scheduler = Scheduler([
+            Source(name, poll, min_interval, max_interval)
+            for name, min_interval, max_interval in subreddits
+        ])
+        await asyncio.gather(
+            scheduler.run_async(),
+            run_workers(comments_queue, "crawl-comments", crawl),
+            scores.run(),
+        )
+
+
 if __name__ == "__main__":
     import sys
-    subreddits = ["climatechange", "climateactionplan", "EnvironmentalPolitics", "conspiracy"]
+    # SUBREDDITS takes the same "name:min_interval:max_interval" entries as CHAN_BOARDS
+    subreddits = parse_sources(os.environ.get(
+        "SUBREDDITS", "climatechange,climateactionplan,EnvironmentalPolitics,conspiracy"
+    ))
     if "produce" in sys.argv:
         logger.info("Starting continuous job production . . .")
+        metrics.start_server()
+        metrics.register_queue_depth(FAKTORY_SERVER_URL, ["crawl-subreddit", "crawl-comments", "score-posts"])
+
+        scheduler = Scheduler([
+            Source(name, poll_subreddit, min_interval, max_interval)
+            for name, min_interval, max_interval in subreddits
+        ])
 
         try:
-            while True:
-                produce_jobs(subreddits)
-                time.sleep(300)
+            scheduler.run()
         except Exception as e:
             logger.error(f"Error in producer loop: {e}")
         except KeyboardInterrupt:
             logger.info("Producer stopped manually.")
     
+    elif "async" in sys.argv:
+        logger.info("Starting async listing and comment crawling...")
+        metrics.start_server()
+
+        try:
+            asyncio.run(run_async(subreddits))
+        except KeyboardInterrupt:
+            logger.info("Async crawler stopped manually.")
+
+    elif "consume-comments" in sys.argv:
+        logger.info("Starting crawl-comments consumer...")
+        metrics.start_server()
+
+        # Comment-only workers, e.g. on extra machines
+        with Client(faktory_url=FAKTORY_SERVER_URL, role="consumer") as client:
+            consumer = Consumer(
+                client=client,
+                queues=["crawl-comments"],
+                concurrency=COMMENTS_CONCURRENCY
+            )
+            consumer.register("crawl-comments", metrics.track_job("crawl-comments", crawl_comments))
+
+            try:
+                consumer.run()
+            except KeyboardInterrupt:
+                logger.info("Consumer stopped manually.")
+
     elif "consume" in sys.argv:
         logger.info("Starting continuous Faktory consumer...")
+        metrics.start_server()
 
         with Client(faktory_url=FAKTORY_SERVER_URL, role="consumer") as client:
+            # Strict priority: listings are cheap and feed the comment queue, so they go first
             consumer = Consumer(
                 client=client,
-                queues=["crawl-subreddit"],
-                concurrency=5
+                queues=["crawl-subreddit", "crawl-comments"],
+                priority="strict",
+                concurrency=CONSUMER_CONCURRENCY
             )
-            consumer.register("crawl-subreddit", crawl_subreddit)
+            consumer.register("crawl-subreddit", metrics.track_job("crawl-subreddit", crawl_subreddit))
+            consumer.register("crawl-comments", metrics.track_job("crawl-comments", crawl_comments))
 
             try:
                 consumer.run() 
             except KeyboardInterrupt:
                 logger.info("Consumer stopped manually.")
     else:
-        print("Usage: python reddit_crawler.py [produce|consume]")
+        print("Usage: python reddit_crawler.py [produce|consume|consume-comments|async]")
@@ -0,0 +1,17 @@
+-- Add up migration script here
+CREATE TABLE IF NOT EXISTS posts (
+   id BIGSERIAL PRIMARY KEY,
+   subreddit TEXT NOT NULL,
+   post_id TEXT NOT NULL,
+   post_title TEXT,
+   data JSONB NOT NULL, -- this is the `data` object from the reddit listing
+   toxicity_score TEXT
+);
+
+CREATE TABLE IF NOT EXISTS comments (
+   id BIGSERIAL PRIMARY KEY,
+   post_id TEXT NOT NULL,
+   comment_id TEXT NOT NULL,
+   comment_body TEXT,
+   toxicity_score TEXT
+);
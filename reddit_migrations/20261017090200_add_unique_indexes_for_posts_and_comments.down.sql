@@ -0,0 +1,3 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS comments_post_id_comment_id_idx;
+DROP INDEX IF EXISTS posts_subreddit_post_id_idx;
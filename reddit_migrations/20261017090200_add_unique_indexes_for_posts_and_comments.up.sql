@@ -0,0 +1,4 @@
+-- Add up migration script here
+-- the bulk insert path relies on these for ON CONFLICT DO NOTHING
+CREATE UNIQUE INDEX IF NOT EXISTS posts_subreddit_post_id_idx ON posts (subreddit, post_id);
+CREATE UNIQUE INDEX IF NOT EXISTS comments_post_id_comment_id_idx ON comments (post_id, comment_id);
@@ -0,0 +1,5 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS comments_pending_score_idx;
+DROP INDEX IF EXISTS posts_pending_score_idx;
+ALTER TABLE comments DROP COLUMN IF EXISTS score_attempts;
+ALTER TABLE posts DROP COLUMN IF EXISTS score_attempts;
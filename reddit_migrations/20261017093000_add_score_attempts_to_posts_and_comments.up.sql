@@ -0,0 +1,6 @@
+-- Add up migration script here
+-- rows are inserted with toxicity_score NULL and claimed by the score-posts workers
+ALTER TABLE posts ADD COLUMN score_attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE comments ADD COLUMN score_attempts INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX posts_pending_score_idx ON posts (id) WHERE toxicity_score IS NULL;
+CREATE INDEX comments_pending_score_idx ON comments (id) WHERE toxicity_score IS NULL;
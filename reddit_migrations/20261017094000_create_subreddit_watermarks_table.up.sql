@@ -0,0 +1,8 @@
+-- Add up migration script here
+-- newest post stored per subreddit, crawl_subreddit pages through /new until it reaches it
+CREATE TABLE subreddit_watermarks (
+   subreddit TEXT PRIMARY KEY,
+   last_created_utc DOUBLE PRECISION NOT NULL,
+   last_fullname TEXT NOT NULL,
+   updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
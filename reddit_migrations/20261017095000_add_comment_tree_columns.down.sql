@@ -0,0 +1,7 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS posts_subreddit_created_utc_idx;
+ALTER TABLE posts DROP COLUMN IF EXISTS comments_seen;
+ALTER TABLE comments DROP COLUMN IF EXISTS data;
+ALTER TABLE comments DROP COLUMN IF EXISTS depth;
+ALTER TABLE comments DROP COLUMN IF EXISTS parent_id;
+ALTER TABLE comments DROP COLUMN IF EXISTS subreddit;
@@ -0,0 +1,9 @@
+-- Add up migration script here
+-- comments are now harvested from the whole tree, keep where each one hangs
+ALTER TABLE comments ADD COLUMN subreddit TEXT;
+ALTER TABLE comments ADD COLUMN parent_id TEXT; -- fullname: t3_ for top-level, t1_ for replies
+ALTER TABLE comments ADD COLUMN depth INTEGER;
+ALTER TABLE comments ADD COLUMN data JSONB;
+-- num_comments the post had when its comments were last harvested
+ALTER TABLE posts ADD COLUMN comments_seen INTEGER;
+CREATE INDEX posts_subreddit_created_utc_idx ON posts (subreddit, ((data->>'created_utc')::double precision));
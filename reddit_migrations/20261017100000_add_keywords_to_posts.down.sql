@@ -0,0 +1,3 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS posts_keywords_idx;
+ALTER TABLE posts DROP COLUMN IF EXISTS keywords;
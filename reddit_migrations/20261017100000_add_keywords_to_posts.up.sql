@@ -0,0 +1,4 @@
+-- Add up migration script here
+-- keywords from KEYWORDS the title or selftext matched, for per-keyword counts
+ALTER TABLE posts ADD COLUMN keywords TEXT[] NOT NULL DEFAULT '{}';
+CREATE INDEX posts_keywords_idx ON posts USING GIN (keywords);
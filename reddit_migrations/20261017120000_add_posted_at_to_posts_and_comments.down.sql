@@ -0,0 +1,14 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS comments_post_id_comment_id_posted_at_idx;
+CREATE UNIQUE INDEX comments_post_id_comment_id_idx ON comments (post_id, comment_id);
+ALTER TABLE comments DROP CONSTRAINT comments_pkey;
+ALTER TABLE comments ADD PRIMARY KEY (id);
+ALTER TABLE comments DROP COLUMN IF EXISTS posted_at;
+
+DROP INDEX IF EXISTS posts_subreddit_posted_at_idx;
+CREATE INDEX posts_subreddit_created_utc_idx ON posts (subreddit, ((data->>'created_utc')::double precision));
+DROP INDEX IF EXISTS posts_subreddit_post_id_posted_at_idx;
+CREATE UNIQUE INDEX posts_subreddit_post_id_idx ON posts (subreddit, post_id);
+ALTER TABLE posts DROP CONSTRAINT posts_pkey;
+ALTER TABLE posts ADD PRIMARY KEY (id);
+ALTER TABLE posts DROP COLUMN IF EXISTS posted_at;
@@ -0,0 +1,28 @@
+-- Add up migration script here
+-- typed created time, so time-range queries don't have to parse data->>'created_utc'
+ALTER TABLE posts ADD COLUMN posted_at TIMESTAMPTZ;
+UPDATE posts SET posted_at = to_timestamp((data->>'created_utc')::double precision);
+ALTER TABLE posts ALTER COLUMN posted_at SET NOT NULL;
+
+-- comments stored before the tree harvester have no data, they get the time of their post
+ALTER TABLE comments ADD COLUMN posted_at TIMESTAMPTZ;
+UPDATE comments SET posted_at = coalesce(
+   to_timestamp((comments.data->>'created_utc')::double precision),
+   (SELECT posts.posted_at FROM posts WHERE posts.post_id = comments.post_id LIMIT 1),
+   now()
+);
+ALTER TABLE comments ALTER COLUMN posted_at SET NOT NULL;
+
+-- a hypertable's unique indexes must include the time column; created_utc never
+-- changes, so these are still one row per post / comment
+ALTER TABLE posts DROP CONSTRAINT posts_pkey;
+ALTER TABLE posts ADD PRIMARY KEY (id, posted_at);
+DROP INDEX IF EXISTS posts_subreddit_post_id_idx;
+CREATE UNIQUE INDEX posts_subreddit_post_id_posted_at_idx ON posts (subreddit, post_id, posted_at);
+DROP INDEX IF EXISTS posts_subreddit_created_utc_idx;
+CREATE INDEX posts_subreddit_posted_at_idx ON posts (subreddit, posted_at DESC);
+
+ALTER TABLE comments DROP CONSTRAINT comments_pkey;
+ALTER TABLE comments ADD PRIMARY KEY (id, posted_at);
+DROP INDEX IF EXISTS comments_post_id_comment_id_idx;
+CREATE UNIQUE INDEX comments_post_id_comment_id_posted_at_idx ON comments (post_id, comment_id, posted_at);
@@ -0,0 +1,42 @@
+-- Add down migration script here
+-- a hypertable can't be turned back in place, so copy the rows into plain tables
+DO $$
+BEGIN
+   IF NOT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'timescaledb') THEN
+      RETURN;
+   END IF;
+   IF EXISTS (SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = 'posts') THEN
+      PERFORM remove_retention_policy('posts', if_exists => true);
+      PERFORM remove_compression_policy('posts', if_exists => true);
+
+      ALTER SEQUENCE posts_id_seq OWNED BY NONE;
+      CREATE TABLE posts_plain (LIKE posts INCLUDING DEFAULTS);
+      INSERT INTO posts_plain SELECT * FROM posts;
+      DROP TABLE posts;
+      ALTER TABLE posts_plain RENAME TO posts;
+      ALTER SEQUENCE posts_id_seq OWNED BY posts.id;
+
+      ALTER TABLE posts ADD PRIMARY KEY (id, posted_at);
+      CREATE UNIQUE INDEX posts_subreddit_post_id_posted_at_idx ON posts (subreddit, post_id, posted_at);
+      CREATE INDEX posts_subreddit_posted_at_idx ON posts (subreddit, posted_at DESC);
+      CREATE INDEX posts_pending_score_idx ON posts (id) WHERE toxicity_score IS NULL;
+      CREATE INDEX posts_keywords_idx ON posts USING GIN (keywords);
+   END IF;
+
+   IF EXISTS (SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = 'comments') THEN
+      PERFORM remove_retention_policy('comments', if_exists => true);
+      PERFORM remove_compression_policy('comments', if_exists => true);
+
+      ALTER SEQUENCE comments_id_seq OWNED BY NONE;
+      CREATE TABLE comments_plain (LIKE comments INCLUDING DEFAULTS);
+      INSERT INTO comments_plain SELECT * FROM comments;
+      DROP TABLE comments;
+      ALTER TABLE comments_plain RENAME TO comments;
+      ALTER SEQUENCE comments_id_seq OWNED BY comments.id;
+
+      ALTER TABLE comments ADD PRIMARY KEY (id, posted_at);
+      CREATE UNIQUE INDEX comments_post_id_comment_id_posted_at_idx ON comments (post_id, comment_id, posted_at);
+      CREATE INDEX comments_pending_score_idx ON comments (id) WHERE toxicity_score IS NULL;
+   END IF;
+END
+$$;
@@ -0,0 +1,31 @@
+-- Add up migration script here
+-- partition posts and comments by posted_at, compress chunks once they stop changing and drop the oldest ones.
+-- skipped on a plain Postgres without the timescaledb extension
+DO $$
+BEGIN
+   IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb') THEN
+      CREATE EXTENSION IF NOT EXISTS timescaledb;
+      PERFORM create_hypertable('posts', 'posted_at', chunk_time_interval => INTERVAL '7 days', migrate_data => true);
+      PERFORM create_hypertable('comments', 'posted_at', chunk_time_interval => INTERVAL '7 days', migrate_data => true);
+      EXECUTE $sql$
+         ALTER TABLE posts SET (
+            timescaledb.compress,
+            timescaledb.compress_segmentby = 'subreddit',
+            timescaledb.compress_orderby = 'posted_at DESC, post_id'
+         )
+      $sql$;
+      EXECUTE $sql$
+         ALTER TABLE comments SET (
+            timescaledb.compress,
+            timescaledb.compress_segmentby = 'subreddit',
+            timescaledb.compress_orderby = 'posted_at DESC, post_id, comment_id'
+         )
+      $sql$;
+      -- comments are re-harvested for REDDIT_COMMENT_REFRESH_HOURS, scoring is done well before this
+      PERFORM add_compression_policy('posts', INTERVAL '30 days');
+      PERFORM add_compression_policy('comments', INTERVAL '30 days');
+      PERFORM add_retention_policy('posts', INTERVAL '730 days');
+      PERFORM add_retention_policy('comments', INTERVAL '730 days');
+   END IF;
+END
+$$;
@@ -0,0 +1,88 @@
+-- Add up migration script here
+-- posts (per keyword set) and comments per subreddit, toxicity class and hour for the dashboard (see rollups.py).
+-- with timescaledb these are continuous aggregates refreshed by a policy, otherwise plain tables
+-- that refresh_toxicity_hourly() rebuilds for a time window
+DO $$
+BEGIN
+   IF NOT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'timescaledb') THEN
+      RETURN;
+   END IF;
+   IF EXISTS (SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = 'posts')
+      AND EXISTS (SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = 'comments') THEN
+      EXECUTE $sql$
+         CREATE MATERIALIZED VIEW toxicity_hourly
+         WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+         SELECT time_bucket(INTERVAL '1 hour', posted_at) AS bucket,
+                subreddit AS source,
+                keywords,
+                toxicity_score,
+                count(*) AS posts
+         FROM posts
+         GROUP BY bucket, subreddit, keywords, toxicity_score
+         WITH NO DATA
+      $sql$;
+      EXECUTE $sql$
+         CREATE MATERIALIZED VIEW comment_toxicity_hourly
+         WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+         SELECT time_bucket(INTERVAL '1 hour', posted_at) AS bucket,
+                subreddit AS source,
+                toxicity_score,
+                count(*) AS posts
+         FROM comments
+         GROUP BY bucket, subreddit, toxicity_score
+         WITH NO DATA
+      $sql$;
+      -- scores land minutes after the posts, re-scoring further back needs rollups.py refresh
+      PERFORM add_continuous_aggregate_policy('toxicity_hourly',
+         start_offset => INTERVAL '3 days',
+         end_offset => INTERVAL '1 hour',
+         schedule_interval => INTERVAL '15 minutes');
+      PERFORM add_continuous_aggregate_policy('comment_toxicity_hourly',
+         start_offset => INTERVAL '3 days',
+         end_offset => INTERVAL '1 hour',
+         schedule_interval => INTERVAL '15 minutes');
+   END IF;
+END
+$$;
+
+DO $$
+BEGIN
+   IF to_regclass('toxicity_hourly') IS NULL THEN
+      CREATE TABLE toxicity_hourly (
+         bucket TIMESTAMPTZ NOT NULL,
+         source TEXT NOT NULL,
+         keywords TEXT[] NOT NULL,
+         toxicity_score TEXT,
+         posts BIGINT NOT NULL
+      );
+      CREATE INDEX toxicity_hourly_bucket_idx ON toxicity_hourly (bucket, source);
+
+      CREATE TABLE comment_toxicity_hourly (
+         bucket TIMESTAMPTZ NOT NULL,
+         source TEXT,
+         toxicity_score TEXT,
+         posts BIGINT NOT NULL
+      );
+      CREATE INDEX comment_toxicity_hourly_bucket_idx ON comment_toxicity_hourly (bucket, source);
+
+      CREATE FUNCTION refresh_toxicity_hourly(window_start TIMESTAMPTZ, window_end TIMESTAMPTZ)
+      RETURNS VOID LANGUAGE SQL AS $fn$
+         DELETE FROM toxicity_hourly
+         WHERE bucket >= date_trunc('hour', window_start) AND bucket < window_end;
+         INSERT INTO toxicity_hourly (bucket, source, keywords, toxicity_score, posts)
+         SELECT date_trunc('hour', posted_at), subreddit, keywords, toxicity_score, count(*)
+         FROM posts
+         WHERE posted_at >= date_trunc('hour', window_start) AND posted_at < window_end
+         GROUP BY 1, 2, 3, 4;
+
+         DELETE FROM comment_toxicity_hourly
+         WHERE bucket >= date_trunc('hour', window_start) AND bucket < window_end;
+         INSERT INTO comment_toxicity_hourly (bucket, source, toxicity_score, posts)
+         SELECT date_trunc('hour', posted_at), subreddit, toxicity_score, count(*)
+         FROM comments
+         WHERE posted_at >= date_trunc('hour', window_start) AND posted_at < window_end
+         GROUP BY 1, 2, 3;
+      $fn$;
+   END IF;
+END
+$$;
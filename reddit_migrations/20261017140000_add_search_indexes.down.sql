@@ -0,0 +1,3 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS comments_search_idx;
+DROP INDEX IF EXISTS posts_search_idx;
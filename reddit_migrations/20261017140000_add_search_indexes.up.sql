@@ -0,0 +1,9 @@
+-- Add up migration script here
+-- full-text search over titles, selftext and comments (search.py must use these exact expressions to hit the indexes).
+-- expression indexes rather than generated columns, because compressed hypertables
+-- can't take new computed columns
+CREATE INDEX posts_search_idx ON posts
+   USING GIN ((setweight(to_tsvector('english', coalesce(post_title, '')), 'A')
+      || setweight(to_tsvector('english', coalesce(data->>'selftext', '')), 'B')));
+CREATE INDEX comments_search_idx ON comments
+   USING GIN (to_tsvector('english', coalesce(comment_body, '')));
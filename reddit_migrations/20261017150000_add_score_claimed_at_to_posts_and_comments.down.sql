@@ -0,0 +1,3 @@
+-- Add down migration script here
+ALTER TABLE comments DROP COLUMN IF EXISTS score_claimed_at;
+ALTER TABLE posts DROP COLUMN IF EXISTS score_claimed_at;
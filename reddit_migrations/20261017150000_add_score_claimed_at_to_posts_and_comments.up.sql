@@ -0,0 +1,5 @@
+-- Add up migration script here
+-- score workers lease a batch by stamping it, then score it outside the claiming transaction;
+-- a lease older than SCORE_CLAIM_TIMEOUT belongs to a worker that died and can be taken over
+ALTER TABLE posts ADD COLUMN score_claimed_at TIMESTAMPTZ;
+ALTER TABLE comments ADD COLUMN score_claimed_at TIMESTAMPTZ;
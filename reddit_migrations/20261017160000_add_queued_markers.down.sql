@@ -0,0 +1,6 @@
+-- Add down migration script here
+DELETE FROM subreddit_watermarks WHERE last_created_utc IS NULL OR last_fullname IS NULL;
+ALTER TABLE subreddit_watermarks ALTER COLUMN last_fullname SET NOT NULL;
+ALTER TABLE subreddit_watermarks ALTER COLUMN last_created_utc SET NOT NULL;
+ALTER TABLE subreddit_watermarks DROP COLUMN IF EXISTS crawl_queued_at;
+ALTER TABLE posts DROP COLUMN IF EXISTS comments_queued_at;
@@ -0,0 +1,9 @@
+-- Add up migration script here
+-- set when a crawl-subreddit / crawl-comments job is pushed and cleared when it runs, so the producer
+-- doesn't push the same crawl again while one is still waiting; a marker older than CRAWL_QUEUED_TIMEOUT
+-- belongs to a lost job and is ignored
+ALTER TABLE posts ADD COLUMN comments_queued_at TIMESTAMPTZ;
+ALTER TABLE subreddit_watermarks ADD COLUMN crawl_queued_at TIMESTAMPTZ;
+-- a subreddit can be queued before its first crawl stored anything
+ALTER TABLE subreddit_watermarks ALTER COLUMN last_created_utc DROP NOT NULL;
+ALTER TABLE subreddit_watermarks ALTER COLUMN last_fullname DROP NOT NULL;
@@ -0,0 +1,2 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS comments_without_data_post_id_idx;
@@ -0,0 +1,4 @@
+-- Add up migration script here
+-- comments stored before the tree harvester have no data and a posted_at borrowed from their post, so the
+-- (post_id, comment_id, posted_at) index never matches them again; the insert path looks them up by post instead
+CREATE INDEX comments_without_data_post_id_idx ON comments (post_id) WHERE data IS NULL;
@@ -0,0 +1,3 @@
+-- Add down migration script here
+ALTER TABLE comments DROP COLUMN IF EXISTS rescore;
+ALTER TABLE posts DROP COLUMN IF EXISTS rescore;
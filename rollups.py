@@ -0,0 +1,142 @@
+# Toxicity counts per source, keyword, class and time bucket, read from the hourly rollups
+
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from db_pool import get_pool
+
+# logger setup
+logger = logging.getLogger("rollups")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+# How often `python rollups.py loop` refreshes, and how far back each refresh reaches
+ROLLUP_REFRESH_INTERVAL = float(os.environ.get("ROLLUP_REFRESH_INTERVAL", 900))
+ROLLUP_REFRESH_WINDOW_HOURS = float(os.environ.get("ROLLUP_REFRESH_WINDOW_HOURS", 72))
+
+# target -> (database url env var, rollup view or table, whether it has keywords)
+ROLLUP_TARGETS = {
+    "chan-posts": ("CHAN_DATABASE_URL", "toxicity_hourly", True),
+    "reddit-posts": ("REDDIT_DATABASE_URL", "toxicity_hourly", True),
+    "reddit-comments": ("REDDIT_DATABASE_URL", "comment_toxicity_hourly", False),
+}
+
+BUCKETS = ("hour", "day", "week", "month")
+
+
+def target_pool(target):
+    dsn_env, _, _ = ROLLUP_TARGETS[target]
+    return get_pool(os.environ.get(dsn_env) or os.environ.get("DATABASE_URL"))
+
+
+"""
+Counts from the hourly rollup as (bucket, source, keyword, toxicity_score, posts) rows,
+oldest bucket first. bucket is hour/day/week/month; keyword is None unless by_keyword,
+in which case a post that matched two keywords is counted under both. Unscored posts
+have toxicity_score None.
+"""
+def toxicity_counts(target, start, end=None, bucket="hour", sources=None, keyword=None, by_keyword=False):
+    _, rollup, has_keywords = ROLLUP_TARGETS[target]
+    if bucket not in BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(BUCKETS)}")
+    if (keyword or by_keyword) and not has_keywords:
+        raise ValueError(f"{target} has no keywords")
+
+    keyword_sql = "unnest(keywords)" if by_keyword else "NULL::text"
+    filters = ["bucket >= %s", "bucket < %s"]
+    params = [bucket, start, end or datetime.now(timezone.utc)]
+    if sources:
+        filters.append("source = ANY(%s)")
+        params.append(list(sources))
+    if keyword:
+        filters.append("keywords @> ARRAY[%s]")
+        params.append(keyword)
+
+    with target_pool(target).connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT bucket, source, keyword, toxicity_score, sum(posts)::bigint
+                FROM (
+                    SELECT date_trunc(%s, bucket) AS bucket, source, {keyword_sql} AS keyword, toxicity_score, posts
+                    FROM {rollup}
+                    WHERE {" AND ".join(filters)}
+                ) hourly
+                GROUP BY 1, 2, 3, 4
+                ORDER BY 1, 2, 3, 4
+                """,
+                params,
+            )
+            rows = cur.fetchall()
+        conn.rollback()
+    return rows
+
+
+"""
+Recompute the rollup for [start, end). With Timescale this refreshes the continuous
+aggregate (needed after re-scoring older than the policy's 3 day window); without it,
+this is the only thing that fills the rollup tables.
+"""
+def refresh(target, start=None, end=None):
+    _, rollup, _ = ROLLUP_TARGETS[target]
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(hours=ROLLUP_REFRESH_WINDOW_HOURS)
+
+    with target_pool(target).connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regprocedure('refresh_toxicity_hourly(timestamptz, timestamptz)') IS NOT NULL")
+            plain_tables = cur.fetchone()[0]
+        conn.rollback()
+
+        if plain_tables:
+            with conn.cursor() as cur:
+                cur.execute("SELECT refresh_toxicity_hourly(%s, %s)", (start, end))
+            conn.commit()
+        else:
+            # refresh_continuous_aggregate refuses to run inside a transaction
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("CALL refresh_continuous_aggregate(%s, %s, %s)", (rollup, start, end))
+            finally:
+                conn.autocommit = False
+    logger.info(f"Refreshed {rollup} for {target} from {start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}")
+
+
+if __name__ == "__main__":
+    targets = [arg for arg in sys.argv[2:] if arg in ROLLUP_TARGETS] or list(ROLLUP_TARGETS)
+
+    if "refresh" in sys.argv:
+        # python rollups.py refresh [target ...] [--all]  (--all rebuilds from the first post)
+        start = datetime(1970, 1, 1, tzinfo=timezone.utc) if "--all" in sys.argv else None
+        for target in targets:
+            refresh(target, start)
+
+    elif "loop" in sys.argv:
+        # Keeps the plain rollup tables current where Timescale isn't available
+        logger.info(f"Refreshing rollups every {ROLLUP_REFRESH_INTERVAL:.0f}s...")
+        try:
+            while True:
+                for target in targets:
+                    try:
+                        refresh(target)
+                    except Exception as e:
+                        logger.error(f"Refresh failed for {target}: {e}")
+                time.sleep(ROLLUP_REFRESH_INTERVAL)
+        except KeyboardInterrupt:
+            logger.info("Refresh loop stopped manually.")
+
+    else:
+        print("Usage: python rollups.py [refresh [target ...] [--all]|loop [target ...]]")
+        print(f"Targets: {', '.join(ROLLUP_TARGETS)}")
@@ -0,0 +1,141 @@
+# Adaptive polling scheduler for 4chan boards and subreddits
+
+import asyncio
+import heapq
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+# logger setup
+logger = logging.getLogger("scheduler")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", 60))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", 900))
+# How many new items we'd like each poll to pick up; busier sources get polled sooner
+POLL_TARGET_ITEMS = float(os.environ.get("POLL_TARGET_ITEMS", 10))
+# Weight of the newest churn observation in the moving average
+POLL_SMOOTHING = float(os.environ.get("POLL_SMOOTHING", 0.3))
+
+
+class Source:
+    """
+    One board or subreddit. `poll` does the work for one cycle and returns how many
+    new items (threads/posts) it saw, or None if the poll failed.
+    """
+    def __init__(self, name, poll, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+        self.name = name
+        self.poll = poll
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.items_per_minute = None
+        self.last_polled = None
+
+    """
+    Fold the latest observation into the churn estimate and pick the next interval
+    """
+    def observe(self, new_items, now):
+        if self.last_polled is None or new_items is None:
+            # First poll has nothing to compare against, and failures tell us nothing about churn
+            self.last_polled = now
+            return self.interval
+
+        elapsed_minutes = max((now - self.last_polled) / 60, 1 / 60)
+        self.last_polled = now
+        rate = new_items / elapsed_minutes
+        if self.items_per_minute is None:
+            self.items_per_minute = rate
+        else:
+            self.items_per_minute = POLL_SMOOTHING * rate + (1 - POLL_SMOOTHING) * self.items_per_minute
+
+        if self.items_per_minute > 0:
+            interval = POLL_TARGET_ITEMS / self.items_per_minute * 60
+        else:
+            interval = self.interval * 2
+        self.interval = min(self.max_interval, max(self.min_interval, interval))
+        return self.interval
+
+
+"""
+Parse a source list like "pol:60:600,sci" into (name, min_interval, max_interval)
+"""
+def parse_sources(value, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+    sources = []
+    for entry in value.split(","):
+        pieces = [piece.strip() for piece in entry.split(":")]
+        if not pieces[0]:
+            continue
+        source_min = float(pieces[1]) if len(pieces) > 1 and pieces[1] else min_interval
+        source_max = float(pieces[2]) if len(pieces) > 2 and pieces[2] else max_interval
+        sources.append((pieces[0], source_min, max(source_min, source_max)))
+    return sources
+
+
+class Scheduler:
+    """
+    Every source sits in the heap exactly once, so a source can never have more than
+    one poll pending, no matter how long its previous poll took.
+    """
+    def __init__(self, sources):
+        self.sources = sources
+        self.heap = []
+        now = time.time()
+        for order, source in enumerate(sources):
+            heapq.heappush(self.heap, (now, order, source))
+
+    """
+    Run the next due poll, sleeping until it is due
+    """
+    def run_once(self):
+        due_at, order, source = heapq.heappop(self.heap)
+        wait = due_at - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        try:
+            new_items = source.poll(source.name)
+        except Exception as e:
+            logger.error(f"Poll failed for {source.name}: {e}")
+            new_items = None
+
+        now = time.time()
+        interval = source.observe(new_items, now)
+        logger.info(
+            f"Polled {source.name}: {new_items} new items, next poll in {interval:.0f}s"
+        )
+        heapq.heappush(self.heap, (now + interval, order, source))
+
+    def run(self):
+        while True:
+            self.run_once()
+
+    """
+    Poll every source on the event loop, for the async crawl mode where Source.poll is a
+    coroutine function. Each source has one loop, so it still never has two polls pending.
+    """
+    async def run_async(self):
+        await asyncio.gather(*(self.poll_forever(source) for source in self.sources))
+
+    async def poll_forever(self, source):
+        while True:
+            try:
+                new_items = await source.poll(source.name)
+            except Exception as e:
+                logger.error(f"Poll failed for {source.name}: {e!r}")
+                new_items = None
+
+            interval = source.observe(new_items, time.time())
+            logger.info(
+                f"Polled {source.name}: {new_items} new items, next poll in {interval:.0f}s"
+            )
+            await asyncio.sleep(interval)
@@ -0,0 +1,234 @@
+# Scoring stage: claims unscored rows in batches and writes ModerateHateSpeech classes back
+
+import logging
+import os
+import sys
+
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+from pyfaktory import Client, Consumer, Job, Producer
+
+import metrics
+from db_pool import CONSUMER_CONCURRENCY, get_pool
+from scoring import ScoringEngine
+
+# logger setup
+logger = logging.getLogger("score worker")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+FAKTORY_SERVER_URL = os.environ.get("FAKTORY_SERVER_URL")
+SCORE_BATCH_SIZE = int(os.environ.get("SCORE_BATCH_SIZE", 100))
+# A job stops after this many batches so one job can't hog a worker forever
+SCORE_MAX_BATCHES = int(os.environ.get("SCORE_MAX_BATCHES", 50))
+# Rows that failed this many times stay unscored until a backfill resets them
+SCORE_MAX_ATTEMPTS = int(os.environ.get("SCORE_MAX_ATTEMPTS", 5))
+# A claimed batch that isn't written back within this many seconds (the worker died) is claimed again
+SCORE_CLAIM_TIMEOUT = int(os.environ.get("SCORE_CLAIM_TIMEOUT", 600))
+# Only rows posted within this many days are claimed, so the claim only touches the newest
+# posts chunks; backfill jobs widen it to cover the rows they reset
+SCORE_LOOKBACK_DAYS = int(os.environ.get("SCORE_LOOKBACK_DAYS", 30))
+SCORE_CONCURRENCY = int(os.environ.get("SCORE_CONCURRENCY", CONSUMER_CONCURRENCY))
+
+scoring_engine = ScoringEngine(
+    os.environ.get("MODERATE_HATESPEECH_API_KEY") or os.environ.get("MODERATE_HATE_SPEECH_API_KEY")
+)
+
+# target -> (database url env var, table, SQL expression for the text to score)
+# The 4chan and Reddit crawlers write to separate databases, so a worker serving both
+# needs CHAN_DATABASE_URL and REDDIT_DATABASE_URL; otherwise DATABASE_URL is used.
+SCORE_TARGETS = {
+    "chan-posts": ("CHAN_DATABASE_URL", "posts", "coalesce(clean_text, data->>'com')"),
+    "reddit-posts": ("REDDIT_DATABASE_URL", "posts", "concat_ws(E'\\n', post_title, data->>'selftext')"),
+    "reddit-comments": ("REDDIT_DATABASE_URL", "comments", "comment_body"),
+}
+
+
+def target_pool(target):
+    dsn_env, _, _ = SCORE_TARGETS[target]
+    return get_pool(os.environ.get(dsn_env) or os.environ.get("DATABASE_URL"))
+
+
+"""
+Lease one batch of unscored rows, score them and write the classes back.
+The claim is its own short transaction (SKIP LOCKED, then a score_claimed_at stamp), so no
+row locks are held while the API is called; the stamp keeps other workers off the batch until
+SCORE_CLAIM_TIMEOUT. Only rows that were sent and failed use up an attempt.
+use_cache=False jobs (pushed by backfill) claim only the rows backfill marked for rescoring,
+and other jobs never claim those, so the cache can't answer for a backfilled row.
+Returns (claimed, sent, failed) row counts; rows with no text are claimed but not sent.
+"""
+def score_batch(target, batch_size=SCORE_BATCH_SIZE, use_cache=True, lookback_days=SCORE_LOOKBACK_DAYS):
+    _, table, text_sql = SCORE_TARGETS[target]
+
+    with target_pool(target).connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE {table} SET score_claimed_at = now()
+                WHERE (id, posted_at) IN (
+                    SELECT id, posted_at FROM {table}
+                    WHERE toxicity_score IS NULL AND score_attempts < %s AND rescore = %s
+                      AND posted_at >= now() - make_interval(days => %s)
+                      AND (score_claimed_at IS NULL OR score_claimed_at < now() - make_interval(secs => %s))
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                  AND posted_at >= now() - make_interval(days => %s)
+                RETURNING id, posted_at, score_attempts, {text_sql}
+                """,
+                (SCORE_MAX_ATTEMPTS, not use_cache, lookback_days, SCORE_CLAIM_TIMEOUT, batch_size, lookback_days),
+            )
+            rows = cur.fetchall()
+        conn.commit()
+        if not rows:
+            return 0, 0, 0
+
+        # Quote-link-only posts clean to "": there is nothing to send, so they are closed
+        # out at SCORE_MAX_ATTEMPTS without an API call and stay unscored
+        texts = [(text or "").strip() for _, _, _, text in rows]
+        sent = [text for text in texts if text]
+        scores_by_text = dict(zip(sent, scoring_engine.score_texts(sent, use_cache)))
+
+        updates = []
+        for (row_id, row_posted_at, attempts, _), text in zip(rows, texts):
+            score = scores_by_text.get(text)
+            if not text:
+                attempts = SCORE_MAX_ATTEMPTS
+            elif score is None:
+                attempts += 1
+            updates.append((row_id, row_posted_at, score, attempts))
+
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                f"""
+                UPDATE {table} AS t
+                SET toxicity_score = v.score, score_attempts = v.attempts, score_claimed_at = NULL,
+                    rescore = t.rescore AND v.score IS NULL
+                FROM (VALUES %s) AS v(id, posted_at, score, attempts)
+                WHERE t.id = v.id AND t.posted_at = v.posted_at
+                  AND t.posted_at >= now() - make_interval(days => {int(lookback_days) + 1})
+                """,
+                updates,
+                template="(%s, %s::timestamptz, %s::text, %s)",
+                page_size=len(updates),
+            )
+        conn.commit()
+
+    failed = sum(1 for text in sent if scores_by_text.get(text) is None)
+    logger.info(f"Scored {len(sent) - failed} {target} rows, {failed} failed, {len(rows) - len(sent)} empty")
+    return len(rows), len(sent), failed
+
+
+"""
+Faktory job: keep claiming batches until there is nothing left to score
+"""
+def score_posts(target, use_cache=True, lookback_days=SCORE_LOOKBACK_DAYS):
+    for _ in range(SCORE_MAX_BATCHES):
+        claimed, sent, failed = score_batch(target, use_cache=use_cache, lookback_days=lookback_days)
+        if claimed < SCORE_BATCH_SIZE:
+            return
+        if sent and failed == sent:
+            # The API is failing outright; stop rather than spend an attempt on every pending row
+            logger.error(f"Whole {target} batch failed, stopping")
+            return
+    # Still more pending, hand the rest to another worker
+    push_score_jobs(target, 1, use_cache, lookback_days)
+
+
+"""
+Enqueue score-posts jobs; the crawlers call this after inserting new rows
+"""
+def push_score_jobs(target, count=1, use_cache=True, lookback_days=SCORE_LOOKBACK_DAYS):
+    with Client(faktory_url=FAKTORY_SERVER_URL, role="producer") as client:
+        producer = Producer(client=client)
+        jobs = [
+            Job(jobtype="score-posts", args=(target, use_cache, lookback_days), queue="score-posts")
+            for _ in range(count)
+        ]
+        with metrics.timer("faktory_push_seconds", queue="score-posts"):
+            producer.push_bulk(jobs)
+    metrics.inc("faktory_jobs_pushed_total", count, queue="score-posts")
+
+
+"""
+Mark scored rows as pending again so the workers re-score them against the API
+(bypassing the cache). only_score limits it to one class, e.g. the old "normal" fallbacks.
+"""
+def backfill(target, only_score=None, chunk_size=10_000):
+    _, table, _ = SCORE_TARGETS[target]
+    score_filter = "AND toxicity_score = %s" if only_score else ""
+
+    with target_pool(target).connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT min(id), max(id), extract(day FROM now() - min(posted_at))::int + 1 FROM {table}")
+            min_id, max_id, lookback_days = cur.fetchone()
+        conn.rollback()
+        if min_id is None:
+            logger.info(f"Nothing to backfill in {target}")
+            return
+
+        reset = 0
+        for chunk_start in range(min_id, max_id + 1, chunk_size):
+            params = [chunk_start, chunk_start + chunk_size] + ([only_score] if only_score else [])
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    UPDATE {table} SET toxicity_score = NULL, score_attempts = 0, rescore = true
+                    WHERE id >= %s AND id < %s {score_filter}
+                    """,
+                    params,
+                )
+                reset += cur.rowcount
+            conn.commit()
+
+    logger.info(f"Reset {reset} {target} rows for re-scoring")
+    if reset:
+        push_backlog_jobs(target, reset, use_cache=False, lookback_days=lookback_days)
+
+
+"""
+Enqueue enough score-posts jobs, up to SCORE_CONCURRENCY, for `rows` unscored rows at once,
+e.g. after a backfill or a raw archive replay. lookback_days has to reach the oldest of them.
+"""
+def push_backlog_jobs(target, rows, use_cache=True, lookback_days=SCORE_LOOKBACK_DAYS):
+    jobs = min(SCORE_CONCURRENCY, -(-rows // (SCORE_BATCH_SIZE * SCORE_MAX_BATCHES)))
+    push_score_jobs(target, max(jobs, 1), use_cache, max(lookback_days, SCORE_LOOKBACK_DAYS))
+
+
+if __name__ == "__main__":
+    if "consume" in sys.argv:
+        logger.info("Starting score-posts consumer...")
+        metrics.start_server()
+        metrics.register_queue_depth(FAKTORY_SERVER_URL, ["score-posts"])
+
+        with Client(faktory_url=FAKTORY_SERVER_URL, role="consumer") as client:
+            consumer = Consumer(
+                client=client,
+                queues=["score-posts"],
+                concurrency=SCORE_CONCURRENCY  # scales separately from the crawlers
+            )
+            consumer.register("score-posts", metrics.track_job("score-posts", score_posts))
+
+            try:
+                consumer.run()
+            except KeyboardInterrupt:
+                logger.info("Consumer stopped manually.")
+
+    elif "backfill" in sys.argv and len(sys.argv) >= 3:
+        # python score_worker.py backfill <target> [only_score]
+        target = sys.argv[2]
+        only_score = sys.argv[3] if len(sys.argv) > 3 else None
+        backfill(target, only_score)
+
+    else:
+        print("Usage: python score_worker.py [consume|backfill <target> [only_score]]")
+        print(f"Targets: {', '.join(SCORE_TARGETS)}")
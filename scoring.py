@@ -0,0 +1,190 @@
+# Concurrent, rate-limited ModerateHateSpeech scoring for batches of texts
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import Counter
+
+import aiohttp
+from dotenv import load_dotenv
+
+import metrics
+from rate_limit import RATE_STATE_DIR, SharedState
+from toxicity_cache import get_cache
+
+# logger setup
+logger = logging.getLogger("scoring engine")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+MODERATE_HATESPEECH_API_URL = os.environ.get(
+    "MODERATE_HATESPEECH_API_URL", "https://api.moderatehatespeech.com/api/v1/moderate/"
+)
+SCORING_MAX_IN_FLIGHT = int(os.environ.get("SCORING_MAX_IN_FLIGHT", 10))
+SCORING_RATE_PER_SECOND = float(os.environ.get("SCORING_RATE_PER_SECOND", 10))
+SCORING_BURST = int(os.environ.get("SCORING_BURST", 20))
+SCORING_MAX_RETRIES = int(os.environ.get("SCORING_MAX_RETRIES", 3))
+SCORING_TIMEOUT = float(os.environ.get("SCORING_TIMEOUT", 10))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every scoring process on the machine. score-posts jobs run in
+    pyfaktory's pool processes, several per supervisor worker, so the tokens live in a
+    rate_limit.SharedState file rather than in memory. Callers take a token under the
+    file lock and sleep on their own event loop until it is usable.
+    """
+    def __init__(self, rate, capacity, name="moderatehatespeech", state_dir=RATE_STATE_DIR):
+        self.rate = rate
+        self.capacity = capacity
+        self.state = SharedState(f"bucket-{name}", state_dir)
+
+    """
+    Take one token, returning how long the caller has to wait before using it
+    """
+    def reserve(self):
+        with self.state.update() as state:
+            now = time.time()
+            tokens = state.get("tokens", self.capacity)
+            tokens = min(self.capacity, tokens + (now - state.get("updated_at", now)) * self.rate)
+            state["tokens"] = tokens - 1
+            state["updated_at"] = now
+            if tokens >= 1:
+                return 0.0
+            return (1 - tokens) / self.rate
+
+    async def acquire(self):
+        # reserve() blocks on the file lock, which must not stall the other requests in flight
+        wait = await asyncio.to_thread(self.reserve)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_bucket = TokenBucket(SCORING_RATE_PER_SECOND, SCORING_BURST)
+
+
+class ScoringError(Exception):
+    pass
+
+
+class ScoringEngine:
+    """
+    Scores a batch of texts concurrently. Cached texts never reach the API, duplicate
+    texts in a batch are scored once, and any item that still fails after retries
+    gets `fallback` instead of failing the whole batch.
+    """
+    def __init__(self, api_key, fallback=None, max_in_flight=SCORING_MAX_IN_FLIGHT,
+                 max_retries=SCORING_MAX_RETRIES, timeout=SCORING_TIMEOUT, bucket=_bucket):
+        self.api_key = api_key
+        self.fallback = fallback
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.bucket = bucket
+
+    """
+    Blocking entry point for the Faktory job functions
+    """
+    def score_texts(self, texts, use_cache=True):
+        if not texts:
+            return []
+        return asyncio.run(self.score_texts_async(texts, use_cache))
+
+    """
+    Return one toxicity class per input text, in input order. With use_cache=False
+    every text goes to the API and the fresh answers overwrite the cache.
+    """
+    async def score_texts_async(self, texts, use_cache=True):
+        cache = get_cache()
+        # The cache is SQLite, so the whole batch is looked up in one thread before the fan-out
+        scores, missing = await asyncio.to_thread(self._lookup, cache, texts, use_cache)
+
+        if missing:
+            semaphore = asyncio.Semaphore(self.max_in_flight)
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                results = await asyncio.gather(
+                    *(self._score_one(session, semaphore, text) for text in missing)
+                )
+            await asyncio.to_thread(self._store, cache, missing, results)
+            scores.update(zip(missing, results))
+
+            failed = sum(1 for score in results if score is None)
+            logger.info(
+                f"Scored {len(missing)} texts ({len(texts) - len(missing)} cached, {failed} failed)"
+            )
+
+        return [self.fallback if scores[text] is None else scores[text] for text in texts]
+
+    """
+    Cached scores of texts, {text: score}, and the texts left for the API
+    """
+    def _lookup(self, cache, texts, use_cache):
+        scores = {}
+        missing = []
+        lookups = Counter()
+        for text in dict.fromkeys(texts):
+            score = cache.get(text) if use_cache else None
+            lookup = "hit"
+            if score is None and use_cache:
+                # Copypasta with a changed word or link reuses the score of its near-duplicate
+                score = cache.get_similar(text)
+                lookup = "near_duplicate"
+            if score is None:
+                missing.append(text)
+                lookup = "miss"
+            else:
+                scores[text] = score
+            lookups[lookup] += 1
+        if use_cache:
+            # Stored with the cache so the hit rate is kept without METRICS_PORT; the metric mirrors it
+            cache.record_lookups(lookups)
+            for lookup, count in lookups.items():
+                metrics.inc("toxicity_cache_lookups_total", count, result=lookup)
+        return scores, missing
+
+    def _store(self, cache, texts, results):
+        for text, score in zip(texts, results):
+            if score is not None:
+                cache.set(text, score)
+
+    async def _score_one(self, session, semaphore, text):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.bucket.acquire()
+                async with semaphore:
+                    with metrics.timer("scoring_request_seconds"):
+                        score = await self._request(session, text)
+                metrics.inc("scoring_requests_total", outcome="ok")
+                return score
+            except Exception as e:
+                metrics.inc("scoring_requests_total", outcome="error")
+                if attempt == self.max_retries:
+                    logger.error(f"Failed to fetch toxicity score after {attempt + 1} attempts: {e}")
+                    return None
+                # Full jitter so retries from concurrent items don't line up
+                backoff = random.uniform(0, min(30, 0.5 * 2 ** attempt))
+                logger.debug(f"Retrying toxicity score in {backoff:.2f}s: {e}")
+                await asyncio.sleep(backoff)
+
+    async def _request(self, session, text):
+        payload = {"token": self.api_key, "text": text}
+        async with session.post(MODERATE_HATESPEECH_API_URL, json=payload) as response:
+            if response.status in RETRY_STATUSES:
+                raise ScoringError(f"retryable status code {response.status}")
+            response_data = await response.json(content_type=None)
+            toxicity_class = response_data.get("class")
+            if toxicity_class is None:
+                # A 200 without a class (bad token, quota message) won't improve on retry
+                logger.error(f"No toxicity class in API response: {response_data}")
+            return toxicity_class
@@ -0,0 +1,136 @@
+# Ranked full-text search over collected posts and comments, with keyset pagination
+
+import logging
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from db_pool import get_pool
+
+# logger setup
+logger = logging.getLogger("search")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", 50))
+
+# target -> (database url env var, table, source column, reference SQL, document SQL, tsvector SQL)
+# The tsvector SQL must match the expression indexes in the search index migrations exactly.
+SEARCH_TARGETS = {
+    "chan-posts": (
+        "CHAN_DATABASE_URL", "posts", "board",
+        "thread_number || '/' || post_number",
+        "coalesce(clean_text, data->>'com', '')",
+        "to_tsvector('english', coalesce(clean_text, data->>'com', ''))",
+    ),
+    "reddit-posts": (
+        "REDDIT_DATABASE_URL", "posts", "subreddit",
+        "post_id",
+        "concat_ws(E'\\n', post_title, data->>'selftext')",
+        "(setweight(to_tsvector('english', coalesce(post_title, '')), 'A')"
+        " || setweight(to_tsvector('english', coalesce(data->>'selftext', '')), 'B'))",
+    ),
+    "reddit-comments": (
+        "REDDIT_DATABASE_URL", "comments", "subreddit",
+        "post_id || '/' || comment_id",
+        "coalesce(comment_body, '')",
+        "to_tsvector('english', coalesce(comment_body, ''))",
+    ),
+}
+
+ORDERS = ("rank", "recent")
+
+
+def target_pool(target):
+    dsn_env = SEARCH_TARGETS[target][0]
+    return get_pool(os.environ.get(dsn_env) or os.environ.get("DATABASE_URL"))
+
+
+"""
+Search a target with web-search syntax ("climate change" -hoax OR warming).
+Returns (rows, cursor): rows are (id, source, reference, posted_at, toxicity_score, rank, headline)
+and cursor is passed back to get the next page, None on the last page.
+order is "rank" (best match first) or "recent" (newest first); both page on the last row
+seen instead of OFFSET, so deep pages cost the same as the first.
+"""
+def search(target, query, sources=None, start=None, end=None, toxicity_score=None,
+           order="rank", limit=SEARCH_PAGE_SIZE, cursor=None):
+    _, table, source_sql, reference_sql, document_sql, vector_sql = SEARCH_TARGETS[target]
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {', '.join(ORDERS)}")
+
+    rank_sql = f"ts_rank({vector_sql}, websearch_to_tsquery('english', %(query)s))"
+    filters = [f"{vector_sql} @@ websearch_to_tsquery('english', %(query)s)"]
+    params = {"query": query, "limit": limit + 1}
+    if sources:
+        filters.append(f"{source_sql} = ANY(%(sources)s)")
+        params["sources"] = list(sources)
+    if start:
+        filters.append("posted_at >= %(start)s")
+        params["start"] = start
+    if end:
+        filters.append("posted_at < %(end)s")
+        params["end"] = end
+    if toxicity_score:
+        filters.append("toxicity_score = %(toxicity_score)s")
+        params["toxicity_score"] = toxicity_score
+
+    if order == "rank":
+        # ts_rank is a real; the cursor value is cast back so the comparison is exact
+        sort_sql = f"{rank_sql} DESC, id DESC"
+        page_sort_sql = "rank DESC, id DESC"
+        if cursor:
+            filters.append(f"({rank_sql}, id) < (%(after_key)s::real, %(after_id)s)")
+    else:
+        sort_sql = page_sort_sql = "posted_at DESC, id DESC"
+        if cursor:
+            filters.append("(posted_at, id) < (%(after_key)s, %(after_id)s)")
+    if cursor:
+        params["after_key"], params["after_id"] = cursor
+
+    with target_pool(target).connection() as conn:
+        with conn.cursor() as cur:
+            # Headlines are only built for the page, not for every match that was ranked
+            cur.execute(
+                f"""
+                SELECT id, source, reference, posted_at, toxicity_score, rank,
+                       ts_headline('english', document, websearch_to_tsquery('english', %(query)s))
+                FROM (
+                    SELECT id, {source_sql} AS source, {reference_sql} AS reference, posted_at,
+                           toxicity_score, {rank_sql} AS rank, {document_sql} AS document
+                    FROM {table}
+                    WHERE {" AND ".join(filters)}
+                    ORDER BY {sort_sql}
+                    LIMIT %(limit)s
+                ) page
+                ORDER BY {page_sort_sql}
+                """,
+                params,
+            )
+            rows = cur.fetchall()
+        conn.rollback()
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    next_cursor = (last[5], last[0]) if order == "rank" else (last[3], last[0])
+    return rows, next_cursor
+
+
+if __name__ == "__main__":
+    # python search.py <target> <query>
+    if len(sys.argv) >= 3 and sys.argv[1] in SEARCH_TARGETS:
+        rows, _ = search(sys.argv[1], " ".join(sys.argv[2:]))
+        for row_id, source, reference, posted_at, toxicity_score, rank, headline in rows:
+            print(f"{posted_at:%Y-%m-%d %H:%M} {source} {reference} [{toxicity_score}] {rank:.3f} {headline}")
+    else:
+        print("Usage: python search.py <target> <query>")
+        print(f"Targets: {', '.join(SEARCH_TARGETS)}")
@@ -0,0 +1,344 @@
+# Bulk write layer shared by the 4chan and Reddit crawlers
+# Rows normally go in with toxicity_score NULL and score_worker.py fills it in later
+
+import logging
+from datetime import datetime, timezone
+
+from psycopg2.extras import Json, execute_values
+
+import metrics
+from text_normalize import clean_chan_comment
+
+# logger setup
+logger = logging.getLogger("storage")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# Rows per INSERT statement; a 4chan thread tops out around 300-400 posts so one page covers it
+PAGE_SIZE = 1000
+
+
+# (column, type) in the order the row helpers below build them, for writers that can't use execute_values
+# (async_storage.py, raw_archive.py)
+CHAN_POST_COLUMNS = [
+    ("board", "text"), ("thread_number", "bigint"), ("post_number", "bigint"), ("posted_at", "timestamptz"),
+    ("data", "jsonb"), ("clean_text", "text"), ("toxicity_score", "text"), ("keywords", "text[]"),
+]
+REDDIT_POST_COLUMNS = [
+    ("subreddit", "text"), ("post_id", "text"), ("post_title", "text"), ("posted_at", "timestamptz"),
+    ("data", "jsonb"), ("toxicity_score", "text"), ("keywords", "text[]"),
+]
+REDDIT_COMMENT_COLUMNS = [
+    ("subreddit", "text"), ("post_id", "text"), ("comment_id", "text"), ("parent_id", "text"),
+    ("depth", "integer"), ("posted_at", "timestamptz"), ("comment_body", "text"), ("data", "jsonb"),
+    ("toxicity_score", "text"),
+]
+
+
+"""
+posted_at value for a unix time (4chan `time`, reddit `created_utc`). It is part of every
+unique index on the hypertables, and never changes for a post, so duplicates still conflict.
+"""
+def posted_at(unix_time):
+    return datetime.fromtimestamp(unix_time, timezone.utc)
+
+
+"""
+Insert rows with ON CONFLICT DO NOTHING and a single commit.
+Returns (inserted, skipped) where skipped rows were already in the table.
+target labels the write in the metrics (chan-posts, reddit-posts, reddit-comments).
+"""
+def bulk_insert(conn, query, rows, target="rows"):
+    if not rows:
+        return 0, 0
+
+    with metrics.timer("db_write_seconds", target=target):
+        with conn.cursor() as cur:
+            inserted = execute_values(cur, query, rows, page_size=PAGE_SIZE, fetch=True)
+        conn.commit()
+    metrics.inc("db_rows_inserted_total", len(inserted), target=target)
+    metrics.inc("db_rows_skipped_total", len(rows) - len(inserted), target=target)
+    return len(inserted), len(rows) - len(inserted)
+
+
+"""
+Rows for a batch of 4chan posts from one thread, tagged with the keywords the thread matched.
+The raw post stays in data; clean_text is the plain-text comment that gets scored.
+Shared with async_storage.py, so both write paths store exactly the same columns.
+"""
+def chan_post_rows(board, thread_number, posts, keywords=None):
+    return [
+        (
+            board, thread_number, post["no"], posted_at(post["time"]), Json(post),
+            clean_chan_comment(post.get("com")), post.get("toxicity_score"), list(keywords or []),
+        )
+        for post in posts
+    ]
+
+
+"""
+Whether a 4chan post is stored at all; image-only posts have no comment to score.
+Shared with raw_archive.py, whose archive also keeps the posts the crawler skips.
+"""
+def chan_post_has_text(post):
+    return bool(post.get("com", ""))
+
+
+def insert_chan_posts(conn, board, thread_number, posts, keywords=None):
+    rows = chan_post_rows(board, thread_number, posts, keywords)
+    query = """
+    INSERT INTO posts (board, thread_number, post_number, posted_at, data, clean_text, toxicity_score, keywords)
+    VALUES %s
+    ON CONFLICT (board, thread_number, post_number, posted_at) DO NOTHING
+    RETURNING id
+    """
+    return bulk_insert(conn, query, rows, "chan-posts")
+
+
+"""
+Highest post number already crawled for a thread, or None if we have none yet.
+Kept in catalog_threads so the lookup doesn't have to search every posts chunk.
+"""
+def latest_chan_post_number(conn, board, thread_number):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT last_post_number FROM catalog_threads WHERE board = %s AND thread_number = %s",
+            (board, thread_number),
+        )
+        row = cur.fetchone()
+    conn.rollback()
+    return row[0] if row else None
+
+
+"""
+Advance a thread's watermark; call it only once the posts up to post_number are committed.
+Upserts, since a crawl-thread job can run before the catalog crawl that pushed it has
+saved the thread's snapshot.
+"""
+def save_chan_watermark(conn, board, thread_number, post_number):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO catalog_threads (board, thread_number, last_post_number)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (board, thread_number) DO UPDATE SET
+                last_post_number = greatest(catalog_threads.last_post_number, EXCLUDED.last_post_number)
+            """,
+            (board, thread_number, post_number),
+        )
+    conn.commit()
+
+
+"""
+Rows for a batch of reddit posts (the `data` object of each listing child).
+keywords maps post id to the keywords its title/selftext matched.
+"""
+def reddit_post_rows(subreddit, posts, keywords=None):
+    keywords = keywords or {}
+    return [
+        (
+            subreddit, post["id"], post["title"], posted_at(post["created_utc"]), Json(post),
+            post.get("toxicity_score"), keywords.get(post["id"], []),
+        )
+        for post in posts
+    ]
+
+
+def insert_reddit_posts(conn, subreddit, posts, keywords=None):
+    rows = reddit_post_rows(subreddit, posts, keywords)
+    query = """
+    INSERT INTO posts (subreddit, post_id, post_title, posted_at, data, toxicity_score, keywords)
+    VALUES %s
+    ON CONFLICT (subreddit, post_id, posted_at) DO NOTHING
+    RETURNING id
+    """
+    return bulk_insert(conn, query, rows, "reddit-posts")
+
+
+"""
+Rows for a batch of flat reddit comment records (see comment_harvester) for one post
+"""
+def reddit_comment_rows(subreddit, post_id, comments):
+    return [
+        (
+            subreddit, post_id, comment["id"], comment.get("parent_id"), comment.get("depth"),
+            posted_at(comment["created_utc"]), comment["body"], Json(comment), comment.get("toxicity"),
+        )
+        for comment in comments
+    ]
+
+
+"""
+Whether a reddit comment is stored at all; deleted and removed ones have no body left.
+Shared with raw_archive.py, like chan_post_has_text.
+"""
+def reddit_comment_is_live(comment):
+    return comment.get("body") not in ("[deleted]", "[removed]", None)
+
+
+"""
+Ids of a post's comments stored before the tree harvester. They have no data and a posted_at
+borrowed from their post, so ON CONFLICT can't see them; the insert skips them by id instead.
+"""
+def legacy_comment_ids(conn, post_id):
+    with conn.cursor() as cur:
+        cur.execute("SELECT comment_id FROM comments WHERE post_id = %s AND data IS NULL", (post_id,))
+        ids = {row[0] for row in cur.fetchall()}
+    conn.rollback()
+    return ids
+
+
+def insert_reddit_comments(conn, subreddit, post_id, comments):
+    legacy = legacy_comment_ids(conn, post_id)
+    fresh = [comment for comment in comments if comment["id"] not in legacy]
+    rows = reddit_comment_rows(subreddit, post_id, fresh)
+    query = """
+    INSERT INTO comments (
+        subreddit, post_id, comment_id, parent_id, depth, posted_at, comment_body, data, toxicity_score
+    )
+    VALUES %s
+    ON CONFLICT (post_id, comment_id, posted_at) DO NOTHING
+    RETURNING id
+    """
+    inserted, skipped = bulk_insert(conn, query, rows, "reddit-comments")
+    return inserted, skipped + len(comments) - len(fresh)
+
+
+"""
+Recently created posts of a subreddit with the num_comments we last harvested at
+(None if never harvested). Posts with a crawl-comments job queued in the last
+queued_timeout seconds are left out.
+"""
+def recent_reddit_posts(conn, subreddit, since_utc, queued_timeout):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT post_id, comments_seen FROM posts
+            WHERE subreddit = %s AND posted_at >= to_timestamp(%s)
+              AND (comments_queued_at IS NULL OR comments_queued_at < now() - make_interval(secs => %s))
+            """,
+            (subreddit, since_utc, queued_timeout),
+        )
+        rows = cur.fetchall()
+    conn.rollback()
+    return dict(rows)
+
+
+"""
+How many stored posts of a subreddit were created after since_utc, and the newest one's
+created_utc (None if there are none)
+"""
+def reddit_posts_since(conn, subreddit, since_utc):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT count(*), extract(epoch FROM max(posted_at)) FROM posts
+            WHERE subreddit = %s AND posted_at > to_timestamp(%s)
+            """,
+            (subreddit, since_utc),
+        )
+        count, newest = cur.fetchone()
+    conn.rollback()
+    return count, float(newest) if newest is not None else None
+
+
+"""
+Mark posts created after since_utc as having a crawl-comments job queued
+"""
+def mark_comments_queued(conn, subreddit, post_ids, since_utc):
+    if not post_ids:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE posts SET comments_queued_at = now()
+            WHERE subreddit = %s AND post_id = ANY(%s) AND posted_at >= to_timestamp(%s)
+            """,
+            (subreddit, list(post_ids), since_utc),
+        )
+    conn.commit()
+
+
+"""
+Record the num_comments a post was harvested at; its crawl-comments job is done
+"""
+def save_comments_seen(conn, subreddit, post_id, num_comments):
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE posts SET comments_seen = %s, comments_queued_at = NULL WHERE subreddit = %s AND post_id = %s",
+            (num_comments, subreddit, post_id),
+        )
+    conn.commit()
+
+
+"""
+Drop a post's queued marker without recording a harvest, so the next crawl queues it again
+"""
+def clear_comments_queued(conn, subreddit, post_id):
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE posts SET comments_queued_at = NULL WHERE subreddit = %s AND post_id = %s",
+            (subreddit, post_id),
+        )
+    conn.commit()
+
+
+"""
+Newest post we stored for a subreddit as (created_utc, fullname), or (None, None)
+"""
+def get_subreddit_watermark(conn, subreddit):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT last_created_utc, last_fullname FROM subreddit_watermarks WHERE subreddit = %s",
+            (subreddit,),
+        )
+        row = cur.fetchone()
+    conn.rollback()
+    return row if row else (None, None)
+
+
+def save_subreddit_watermark(conn, subreddit, created_utc, fullname):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO subreddit_watermarks (subreddit, last_created_utc, last_fullname)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (subreddit) DO UPDATE SET
+                last_created_utc = EXCLUDED.last_created_utc,
+                last_fullname = EXCLUDED.last_fullname,
+                updated_at = now()
+            """,
+            (subreddit, created_utc, fullname),
+        )
+    conn.commit()
+
+
+"""
+Mark a subreddit as having a crawl-subreddit job queued. Returns False when one was
+already queued in the last queued_timeout seconds, in which case nothing should be pushed.
+"""
+def mark_subreddit_queued(conn, subreddit, queued_timeout):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO subreddit_watermarks (subreddit, crawl_queued_at) VALUES (%s, now())
+            ON CONFLICT (subreddit) DO UPDATE SET crawl_queued_at = now()
+            WHERE subreddit_watermarks.crawl_queued_at IS NULL
+               OR subreddit_watermarks.crawl_queued_at < now() - make_interval(secs => %s)
+            RETURNING subreddit
+            """,
+            (subreddit, queued_timeout),
+        )
+        marked = cur.fetchone() is not None
+    conn.commit()
+    return marked
+
+
+def clear_subreddit_queued(conn, subreddit):
+    with conn.cursor() as cur:
+        cur.execute("UPDATE subreddit_watermarks SET crawl_queued_at = NULL WHERE subreddit = %s", (subreddit,))
+    conn.commit()
@@ -0,0 +1,223 @@
+# Runs a machine's Faktory consumers as supervised worker processes with per-queue concurrency
+
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from dotenv import load_dotenv
+from pyfaktory import Client, Consumer
+
+import metrics
+from db_pool import CONSUMER_CONCURRENCY
+
+# logger setup
+logger = logging.getLogger("supervisor")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+FAKTORY_SERVER_URL = os.environ.get("FAKTORY_SERVER_URL")
+# Workers per machine; every worker gets one consumer process (slot) per queue it serves
+SUPERVISOR_WORKERS = int(os.environ.get("SUPERVISOR_WORKERS") or os.cpu_count() or 1)
+# How long SIGTERM waits for in-flight jobs before killing what is left (pyfaktory's grace period is 25s)
+SUPERVISOR_DRAIN_TIMEOUT = float(os.environ.get("SUPERVISOR_DRAIN_TIMEOUT", 30))
+# A consumer that exits sooner than this after starting counts as crashing and is restarted with backoff
+SUPERVISOR_MIN_UPTIME = float(os.environ.get("SUPERVISOR_MIN_UPTIME", 30))
+SUPERVISOR_MAX_RESTART_DELAY = float(os.environ.get("SUPERVISOR_MAX_RESTART_DELAY", 60))
+
+# queue -> (module, job function); every jobtype is named after its queue
+QUEUE_HANDLERS = {
+    "crawl-thread": ("chan_crawler", "crawl_thread"),
+    "crawl-catalog": ("chan_crawler", "crawl_catalog"),
+    "crawl-subreddit": ("reddit_crawler", "crawl_subreddit"),
+    "crawl-comments": ("reddit_crawler", "crawl_comments"),
+    "score-posts": ("score_worker", "score_posts"),
+}
+
+# Jobs each slot (one worker's consumer for a queue) runs at once
+QUEUE_CONCURRENCY = {
+    "crawl-thread": int(os.environ.get("CRAWL_THREAD_CONCURRENCY", CONSUMER_CONCURRENCY)),
+    # Catalogs are polled by the chan_crawler.py scheduler, so only jobs already sitting in
+    # the queue from before need a consumer; set it to drain them
+    "crawl-catalog": int(os.environ.get("CRAWL_CATALOG_CONCURRENCY", 0)),
+    "crawl-subreddit": int(os.environ.get("CRAWL_SUBREDDIT_CONCURRENCY", CONSUMER_CONCURRENCY)),
+    "crawl-comments": int(os.environ.get("COMMENTS_CONCURRENCY", CONSUMER_CONCURRENCY)),
+    "score-posts": int(os.environ.get("SCORE_CONCURRENCY", CONSUMER_CONCURRENCY)),
+}
+
+# The chan and reddit crawlers write to different databases (DATABASE_URL), so a supervisor runs one group
+QUEUE_GROUPS = {
+    "chan": ["crawl-thread", "crawl-catalog"],
+    "reddit": ["crawl-subreddit", "crawl-comments"],
+    "score": ["score-posts"],
+}
+
+
+def raise_keyboard_interrupt(*_):
+    raise KeyboardInterrupt
+
+
+"""
+Body of one worker process: a pyfaktory consumer for a single queue. SIGTERM stops it
+fetching, it waits out its grace period for jobs in flight, then exits.
+"""
+def run_consumer(queue, concurrency, slot):
+    # Its own process group, so the supervisor can kill the consumer together with the pool
+    # processes running its jobs; that also keeps a terminal's Ctrl-C away from it, the
+    # supervisor acts on that and sends SIGTERM
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    module_name, function_name = QUEUE_HANDLERS[queue]
+    job = getattr(importlib.import_module(module_name), function_name)
+    signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+
+    metrics.start_server(port_offset=slot)
+    if slot == 1:
+        metrics.register_queue_depth(FAKTORY_SERVER_URL, list(QUEUE_HANDLERS))
+
+    with Client(faktory_url=FAKTORY_SERVER_URL, role="consumer") as client:
+        consumer = Consumer(client=client, queues=[queue], concurrency=concurrency)
+        consumer.register(queue, metrics.track_job(queue, job))
+        consumer.run()
+
+
+class Supervisor:
+    """
+    Forks one consumer process per (worker, queue) slot, `workers` × len(queues) in all,
+    each with that queue's concurrency and its own process group, which holds the
+    consumer and its job processes. Consumers that exit are restarted, with exponential backoff
+    while they keep exiting within SUPERVISOR_MIN_UPTIME. SIGTERM or Ctrl-C drains:
+    every consumer is asked to stop and gets SUPERVISOR_DRAIN_TIMEOUT to finish its jobs.
+    """
+    def __init__(self, queues, workers=SUPERVISOR_WORKERS):
+        # Slot numbers start at 1 and double as metrics port offsets
+        self.slots = {}
+        for worker in range(workers):
+            for queue, concurrency in queues.items():
+                self.slots[len(self.slots) + 1] = (worker, queue, concurrency)
+        self.processes = {}
+        self.started_at = {}
+        self.crashes = {}
+        self.restart_at = {}
+        self.stopping = False
+        self.context = multiprocessing.get_context("fork")
+
+    def start(self, slot):
+        worker, queue, concurrency = self.slots[slot]
+        process = self.context.Process(
+            target=run_consumer, args=(queue, concurrency, slot), name=f"worker-{worker}-{queue}"
+        )
+        process.start()
+        self.processes[slot] = process
+        self.started_at[slot] = time.monotonic()
+        logger.info(f"Started {process.name} (pid {process.pid}, concurrency {concurrency})")
+
+    def stop(self, *_):
+        self.stopping = True
+
+    """
+    SIGKILL a consumer's whole process group. Its job processes would otherwise be left
+    running, holding DB connections and advisory locks while the restarted slot competes with them.
+    """
+    def kill(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # Nothing left in the group, or the child had not called setsid yet
+            if process.is_alive():
+                process.kill()
+        process.join()
+
+    """
+    Restart consumers that exited, once their backoff has passed
+    """
+    def check(self):
+        now = time.monotonic()
+        for slot, process in self.processes.items():
+            if process.is_alive() or slot in self.restart_at:
+                continue
+
+            # The consumer is gone but its job processes may not be
+            self.kill(process)
+            uptime = now - self.started_at[slot]
+            if uptime < SUPERVISOR_MIN_UPTIME:
+                self.crashes[slot] = self.crashes.get(slot, 0) + 1
+            else:
+                self.crashes[slot] = 0
+            delay = min(SUPERVISOR_MAX_RESTART_DELAY, 2 ** self.crashes[slot])
+            self.restart_at[slot] = now + delay
+            logger.error(
+                f"{process.name} exited with {process.exitcode} after {uptime:.0f}s, restarting in {delay:.0f}s"
+            )
+
+        for slot, due_at in list(self.restart_at.items()):
+            if due_at <= now:
+                del self.restart_at[slot]
+                self.start(slot)
+
+    def drain(self):
+        alive = [process for process in self.processes.values() if process.is_alive()]
+        logger.info(f"Draining {len(alive)} consumers...")
+        for process in alive:
+            os.kill(process.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + SUPERVISOR_DRAIN_TIMEOUT
+        for process in alive:
+            process.join(max(0, deadline - time.monotonic()))
+        for process in alive:
+            if process.is_alive():
+                logger.error(f"{process.name} did not finish in time, killing it")
+            # Also clears job processes left behind by a consumer that did exit
+            self.kill(process)
+        logger.info("All consumers stopped.")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in self.slots:
+            self.start(slot)
+
+        while not self.stopping:
+            self.check()
+            time.sleep(1)
+        self.drain()
+
+
+"""
+Parse "crawl-thread:16" style overrides on top of a group's default concurrency
+"""
+def parse_queues(group, overrides):
+    queues = {queue: QUEUE_CONCURRENCY[queue] for queue in QUEUE_GROUPS[group]}
+    for override in overrides:
+        queue, _, concurrency = override.partition(":")
+        if queue not in QUEUE_HANDLERS or not concurrency:
+            raise ValueError(f"Expected queue:concurrency for one of {', '.join(QUEUE_HANDLERS)}, got {override}")
+        queues[queue] = int(concurrency)
+    return {queue: concurrency for queue, concurrency in queues.items() if concurrency > 0}
+
+
+if __name__ == "__main__":
+    # python supervisor.py <chan|reddit|score> [--workers N] [queue:concurrency ...]
+    if len(sys.argv) >= 2 and sys.argv[1] in QUEUE_GROUPS:
+        args = sys.argv[2:]
+        workers = SUPERVISOR_WORKERS
+        if "--workers" in args:
+            index = args.index("--workers")
+            workers = int(args[index + 1])
+            del args[index:index + 2]
+
+        queues = parse_queues(sys.argv[1], args)
+        logger.info(f"Supervising {workers} workers for {queues}")
+        Supervisor(queues, workers).run()
+    else:
+        print("Usage: python supervisor.py <chan|reddit|score> [--workers N] [queue:concurrency ...]")
+        print(f"Queues: {', '.join(QUEUE_HANDLERS)} (a concurrency of 0 leaves a queue out)")
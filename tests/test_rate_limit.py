@@ -0,0 +1,53 @@
+# python -m pytest tests
+# Governors in separate processes (pyfaktory pool processes, supervisor workers) must share one pace per host
+
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limit import RateGovernor  # noqa: E402
+
+INTERVAL = 0.2
+REQUESTS_PER_PROCESS = 5
+
+
+def send_requests(state_dir, sent):
+    governor = RateGovernor("a.4cdn.org", INTERVAL, state_dir)
+    for _ in range(REQUESTS_PER_PROCESS):
+        governor.wait()
+        sent.put(time.time())
+
+
+def test_min_interval_holds_across_processes(tmp_path):
+    context = multiprocessing.get_context("fork")
+    sent = context.Queue()
+    processes = [context.Process(target=send_requests, args=(str(tmp_path), sent)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    times = sorted(sent.get(timeout=30) for _ in range(2 * REQUESTS_PER_PROCESS))
+    for process in processes:
+        process.join()
+
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    # A little slack for sleep() waking a few milliseconds early or late
+    assert min(gaps) >= INTERVAL - 0.02
+    assert times[-1] - times[0] >= (len(times) - 1) * INTERVAL - 0.02
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_reported_budget_is_shared_across_processes(tmp_path):
+    first = RateGovernor("oauth.reddit.com", 0.0, str(tmp_path))
+    second = RateGovernor("oauth.reddit.com", 0.0, str(tmp_path))
+    first.update(FakeResponse({"X-Ratelimit-Remaining": "2", "X-Ratelimit-Reset": "60"}))
+
+    assert first.reserve() == 0
+    # The second governor sees the slot the first one took, and the budget it spent
+    assert second.reserve() > 0
+    assert second.reserve() >= 55
@@ -0,0 +1,85 @@
+# Cleanup of 4chan comment HTML and MinHash fingerprints for near-duplicate posts
+
+import hashlib
+import html
+import random
+import re
+
+BR_RE = re.compile(r"<br\s*/?>", re.IGNORECASE)
+WBR_RE = re.compile(r"<wbr\s*/?>", re.IGNORECASE)
+# >>123456 and >>>/board/123 links; the numbers differ between copies of the same copypasta
+QUOTELINK_RE = re.compile(r"<a\b[^>]*class=\"quotelink\"[^>]*>.*?</a>", re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r"<[^>]+>")
+SPACES_RE = re.compile(r"[ \t\r\f\v]+")
+TOKEN_RE = re.compile(r"\w+")
+
+# MinHash signature length, split into bands of MINHASH_PERMUTATIONS // MINHASH_BANDS rows for LSH
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+SHINGLE_SIZE = 3
+MERSENNE_PRIME = (1 << 61) - 1
+
+# Fixed seed so every process computes the same signatures for the shared cache
+_random = random.Random(4)
+PERMUTATIONS = [
+    (_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+
+"""
+Plain text of a 4chan `com` (or `sub`) field: line breaks kept, quote links dropped,
+greentext and spoiler markup stripped down to their text, entities unescaped
+"""
+def clean_chan_comment(com):
+    if not com:
+        return ""
+    text = BR_RE.sub("\n", com)
+    text = WBR_RE.sub("", text)
+    text = QUOTELINK_RE.sub("", text)
+    text = html.unescape(TAG_RE.sub("", text))
+    lines = (SPACES_RE.sub(" ", line).strip() for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+"""
+Lowercased word tokens of a text
+"""
+def tokens(text):
+    return TOKEN_RE.findall((text or "").casefold())
+
+
+def hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+"""
+MinHash signature over 3-word shingles. The share of equal positions in two
+signatures estimates the Jaccard similarity of the texts; returns None for texts
+too short to fingerprint reliably.
+"""
+def minhash(text, min_tokens=8):
+    words = tokens(text)
+    if len(words) < min_tokens:
+        return None
+
+    shingles = {hash64(" ".join(words[i:i + SHINGLE_SIZE])) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return [
+        min((a * shingle + b) % MERSENNE_PRIME for shingle in shingles)
+        for a, b in PERMUTATIONS
+    ]
+
+
+def similarity(signature, other):
+    return sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+
+
+"""
+One key per band of the signature; similar texts very likely share at least one
+"""
+def band_keys(signature):
+    rows = len(signature) // MINHASH_BANDS
+    return [
+        hash64(f"{band}:" + ",".join(map(str, signature[band * rows:(band + 1) * rows]))) >> 1
+        for band in range(MINHASH_BANDS)
+    ]
@@ -0,0 +1,284 @@
+# Content-hash cache for toxicity scores shared by the 4chan and Reddit crawlers
+
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from text_normalize import band_keys, minhash, similarity
+
+# logger setup
+logger = logging.getLogger("toxicity cache")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+load_dotenv()
+
+TOXICITY_CACHE_PATH = os.environ.get("TOXICITY_CACHE_PATH", "toxicity_cache.sqlite3")
+TOXICITY_CACHE_TTL = int(os.environ.get("TOXICITY_CACHE_TTL", 30 * 24 * 60 * 60))
+TOXICITY_CACHE_MAX_ROWS = int(os.environ.get("TOXICITY_CACHE_MAX_ROWS", 1_000_000))
+TOXICITY_CACHE_LRU_SIZE = int(os.environ.get("TOXICITY_CACHE_LRU_SIZE", 10_000))
+# Texts at least this similar (estimated Jaccard over 3-word shingles) reuse each other's score,
+# 0 turns near-duplicate matching off
+NEAR_DUP_MIN_SIMILARITY = float(os.environ.get("NEAR_DUP_MIN_SIMILARITY", 0.7))
+# Shorter texts are too easy to confuse, they only ever hit on exact matches
+NEAR_DUP_MIN_TOKENS = int(os.environ.get("NEAR_DUP_MIN_TOKENS", 8))
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+"""
+Normalize text so trivially different copies of the same post share a cache entry
+"""
+def normalize_text(text):
+    text = unicodedata.normalize("NFC", text or "")
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+
+"""
+Hash of the normalized text, used as the cache key
+"""
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class ToxicityCache:
+    """
+    In-process LRU in front of a SQLite store. Entries older than `ttl` seconds are
+    treated as misses, and the store is trimmed back to `max_rows` oldest-first.
+    Scored texts also get a MinHash signature, indexed by LSH band, so near-duplicates
+    (copypasta with a changed word or quote link) can reuse a score.
+    """
+    def __init__(self, path=TOXICITY_CACHE_PATH, ttl=TOXICITY_CACHE_TTL,
+                 max_rows=TOXICITY_CACHE_MAX_ROWS, lru_size=TOXICITY_CACHE_LRU_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.writes_since_evict = 0
+
+        # Jobs run one at a time per pool process, but benchmark.py runs them in threads, so the
+        # one connection is shared behind the lock
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS scores (
+                key TEXT PRIMARY KEY,
+                score TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS scores_created_at_idx ON scores (created_at)")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                key TEXT PRIMARY KEY,
+                signature BLOB NOT NULL,
+                score TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fingerprints_created_at_idx ON fingerprints (created_at)")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprint_bands (
+                band_key INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fingerprint_bands_band_key_idx ON fingerprint_bands (band_key)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fingerprint_bands_key_idx ON fingerprint_bands (key)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fingerprint_bands_created_at_idx ON fingerprint_bands (created_at)")
+        # Lookup counts by result (hit, near_duplicate, miss), summed over every process using this file
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS lookups (
+                result TEXT PRIMARY KEY,
+                count INTEGER NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    """
+    Return the cached score for text, or None on a miss
+    """
+    def get(self, text):
+        key = text_key(text)
+        now = time.time()
+        with self.lock:
+            entry = self.lru.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.lru.move_to_end(key)
+                return entry[0]
+
+            row = self.conn.execute(
+                "SELECT score, created_at FROM scores WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] >= self.ttl:
+                self.lru.pop(key, None)
+                return None
+
+            self._remember(key, row[0], row[1])
+            return row[0]
+
+    """
+    Return the score of a stored text at least NEAR_DUP_MIN_SIMILARITY similar to text,
+    or None. Called after get() missed.
+    """
+    def get_similar(self, text):
+        signature = minhash(text, NEAR_DUP_MIN_TOKENS) if NEAR_DUP_MIN_SIMILARITY else None
+        if signature is None:
+            return None
+
+        keys = band_keys(signature)
+        with self.lock:
+            candidates = self.conn.execute(
+                f"""
+                SELECT signature, score FROM fingerprints
+                WHERE created_at >= ? AND key IN (
+                    SELECT key FROM fingerprint_bands WHERE band_key IN ({", ".join("?" * len(keys))})
+                )
+                """,
+                [time.time() - self.ttl] + keys,
+            ).fetchall()
+            for candidate, score in candidates:
+                if similarity(unpack_signature(candidate), signature) >= NEAR_DUP_MIN_SIMILARITY:
+                    return score
+        return None
+
+    """
+    Store a score for text. Only real API answers should be stored, never fallbacks.
+    """
+    def set(self, text, score):
+        key = text_key(text)
+        now = time.time()
+        signature = minhash(text, NEAR_DUP_MIN_TOKENS) if NEAR_DUP_MIN_SIMILARITY else None
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO scores (key, score, created_at) VALUES (?, ?, ?)",
+                (key, score, now),
+            )
+            if signature is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO fingerprints (key, signature, score, created_at) VALUES (?, ?, ?, ?)",
+                    (key, pack_signature(signature), score, now),
+                )
+                # A re-scored text replaces its band rows rather than adding a second set
+                self.conn.execute("DELETE FROM fingerprint_bands WHERE key = ?", (key,))
+                self.conn.executemany(
+                    "INSERT INTO fingerprint_bands (band_key, key, created_at) VALUES (?, ?, ?)",
+                    [(band_key, key, now) for band_key in band_keys(signature)],
+                )
+            self.conn.commit()
+            self._remember(key, score, now)
+
+            self.writes_since_evict += 1
+            if self.writes_since_evict >= 1000:
+                self.writes_since_evict = 0
+                self._evict(now)
+
+    """
+    Add a batch's lookup counts, {result: count}, to the stored totals. One write per
+    batch, so counting stays on even when metrics are off.
+    """
+    def record_lookups(self, counts):
+        counts = [(result, count) for result, count in counts.items() if count]
+        if not counts:
+            return
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO lookups (result, count) VALUES (?, ?)
+                ON CONFLICT (result) DO UPDATE SET count = count + excluded.count
+                """,
+                counts,
+            )
+            self.conn.commit()
+
+    def _remember(self, key, score, created_at):
+        self.lru[key] = (score, created_at)
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def _evict(self, now):
+        for table in ("scores", "fingerprints"):
+            self.conn.execute(f"DELETE FROM {table} WHERE created_at < ?", (now - self.ttl,))
+            self.conn.execute(
+                f"""
+                DELETE FROM {table} WHERE key IN (
+                    SELECT key FROM {table} ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_rows,),
+            )
+        # Band rows are trimmed by age alongside their fingerprints; stale ones only cost a lookup
+        oldest = self.conn.execute("SELECT min(created_at) FROM fingerprints").fetchone()[0]
+        self.conn.execute("DELETE FROM fingerprint_bands WHERE created_at < ?", (oldest or now,))
+        self.conn.commit()
+
+    """
+    Lookup totals across every process and the size of the cache; every hit is one
+    moderation API call we did not make
+    """
+    def stats(self):
+        with self.lock:
+            lookups = dict(self.conn.execute("SELECT result, count FROM lookups").fetchall())
+            stored_scores = self.conn.execute("SELECT count(*) FROM scores").fetchone()[0]
+        hits = lookups.get("hit", 0) + lookups.get("near_duplicate", 0)
+        total = hits + lookups.get("miss", 0)
+        return {
+            "hits": lookups.get("hit", 0),
+            "near_duplicate_hits": lookups.get("near_duplicate", 0),
+            "misses": lookups.get("miss", 0),
+            "hit_rate": hits / total if total else 0.0,
+            "lru_entries": len(self.lru),
+            "stored_scores": stored_scores,
+        }
+
+
+def pack_signature(signature):
+    return struct.pack(f">{len(signature)}Q", *signature)
+
+
+def unpack_signature(blob):
+    return list(struct.unpack(f">{len(blob) // 8}Q", blob))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+"""
+Process-wide cache shared by every crawler job
+"""
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ToxicityCache()
+        return _cache
+
+
+if __name__ == "__main__":
+    print(get_cache().stats())